@@ -0,0 +1,11 @@
+import os
+
+if __name__ == '__main__':
+    from microns_materialization.minnie_materialization.minnie65_materialization import audit_external_stores
+    n_workers = os.getenv('MICRONS_N_WORKERS')
+    audit_external_stores(
+        n_workers=int(n_workers) if n_workers is not None else 32,
+        quarantine=os.getenv('MICRONS_QUARANTINE_ORPHANS', 'false').lower() == 'true',
+        report_dir=os.getenv('MICRONS_AUDIT_REPORT_DIR'),
+        loglevel=os.getenv('MICRONS_LOGLEVEL')
+    )
@@ -0,0 +1,6 @@
+import os
+
+if __name__ == '__main__':
+    from microns_materialization.minnie_materialization.minnie65_materialization import compute_pcg_skeleton_metrics
+    n_workers = os.getenv('MICRONS_N_WORKERS')
+    compute_pcg_skeleton_metrics(n_workers=int(n_workers) if n_workers is not None else None, loglevel=os.getenv('MICRONS_LOGLEVEL'))
@@ -2,4 +2,4 @@ import os
 
 if __name__ == '__main__':
     from microns_materialization.minnie_materialization.minnie65_materialization import download_materialization
-    download_materialization(ver=os.getenv('MICRONS_MAT_VER_TO_DL'), download_meshes=True, download_synapses=False, loglevel=os.getenv('MICRONS_LOGLEVEL'))
\ No newline at end of file
+    download_materialization(ver=os.getenv('MICRONS_MAT_VER_TO_DL'), download_meshes=True, download_synapses=False, compress_meshes=os.getenv('MICRONS_COMPRESS_MESHES', 'false').lower() == 'true', loglevel=os.getenv('MICRONS_LOGLEVEL'))
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+
+if __name__ == '__main__':
+    from microns_materialization.minnie_materialization.minnie65_materialization import export_materialization
+    export_materialization(ver=os.getenv('MICRONS_MAT_VER_TO_EXPORT'), target_dir=os.getenv('MICRONS_EXPORT_DIR'), loglevel=os.getenv('MICRONS_LOGLEVEL'))
@@ -0,0 +1,5 @@
+import os
+
+if __name__ == '__main__':
+    from microns_materialization.minnie_materialization.minnie65_materialization import fill_segment_summaries
+    fill_segment_summaries(ver=os.getenv('MICRONS_MAT_VER'), loglevel=os.getenv('MICRONS_LOGLEVEL'))
@@ -0,0 +1,5 @@
+import os
+
+if __name__ == '__main__':
+    from microns_materialization.minnie_materialization.minnie65_materialization import make_synapse_connectomes
+    make_synapse_connectomes(loglevel=os.getenv('MICRONS_LOGLEVEL'))
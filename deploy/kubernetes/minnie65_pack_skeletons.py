@@ -0,0 +1,5 @@
+import os
+
+if __name__ == '__main__':
+    from microns_materialization.minnie_materialization.minnie65_materialization import pack_skeletons
+    pack_skeletons(loglevel=os.getenv('MICRONS_LOGLEVEL'))
@@ -0,0 +1,15 @@
+import os
+
+if __name__ == '__main__':
+    from microns_materialization.minnie_materialization.minnie65_materialization import recompress_external_store
+    n_workers = os.getenv('MICRONS_N_WORKERS')
+    limit = os.getenv('MICRONS_LIMIT')
+    recompress_external_store(
+        store=os.getenv('MICRONS_STORE'),
+        compression=os.getenv('MICRONS_COMPRESSION', 'gzip'),
+        n_workers=int(n_workers) if n_workers is not None else None,
+        limit=int(limit) if limit is not None else None,
+        dry_run=os.getenv('MICRONS_DRY_RUN', 'false').lower() == 'true',
+        report_dir=os.getenv('MICRONS_REPORT_DIR'),
+        loglevel=os.getenv('MICRONS_LOGLEVEL')
+    )
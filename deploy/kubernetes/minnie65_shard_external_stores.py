@@ -0,0 +1,10 @@
+import os
+
+if __name__ == '__main__':
+    from microns_materialization.minnie_materialization.minnie65_materialization import shard_external_stores
+    n_workers = os.getenv('MICRONS_N_WORKERS')
+    shard_external_stores(
+        n_workers=int(n_workers) if n_workers is not None else 32,
+        dry_run=os.getenv('MICRONS_DRY_RUN', 'false').lower() == 'true',
+        loglevel=os.getenv('MICRONS_LOGLEVEL')
+    )
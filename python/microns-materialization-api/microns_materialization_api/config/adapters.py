@@ -2,23 +2,29 @@
 Adapters for DataJoint tables.
 """
 
-import json
+from microns_utils.adapter_utils import FilePathAdapter, NumpyAdapter
 
-import h5py
-import trimesh
-from meshparty import meshwork, skeleton
-from microns_utils.adapter_utils import FilePathAdapter, NumpyAdapter, adapt_mesh_hdf5
+try:
+    import hdf5plugin  # registers the blosc filter, for files rewritten by utils.recompress_utils with blosc
+except ImportError:
+    pass
+
+from ..utils.connectivity_utils import Connectome
+from ..utils.mesh_utils import MeshLOD, load_trimesh
+from ..utils.meshwork_utils import load_pcg_skeleton
+from ..utils.pack_utils import open_skeleton_pack
+from ..utils.spatial_utils import GridIndex
 
 
 class TrimeshAdapter(FilePathAdapter):
     def get(self, filepath):
         filepath = super().get(filepath)
-        mesh = adapt_mesh_hdf5(filepath, parse_filepath_stem=False, return_type='namedtuple')
-        return trimesh.Trimesh(vertices=mesh.vertices, faces=mesh.faces)
+        return load_trimesh(filepath)
 
 
 class MeshworkAdapter(FilePathAdapter):
     def get(self, filepath):
+        from meshparty import meshwork
         filepath = super().get(filepath)
         return meshwork.load_meshwork(filepath)
 
@@ -26,26 +32,51 @@ class MeshworkAdapter(FilePathAdapter):
 class PCGSkelAdapter(FilePathAdapter):
     def get(self, filepath):
         filepath = super().get(filepath)
-        with h5py.File(filepath, 'r') as f:
-            vertices = f['vertices'][()]
-            edges = f['edges'][()]
-            mesh_to_skel_map = f['mesh_to_skel_map'][()]
-            root = f['root'][()]
-            meta = json.loads(f['meta'][()])
-            skel = skeleton.Skeleton(vertices=vertices, edges=edges, mesh_to_skel_map=mesh_to_skel_map, root=root, meta=meta)
-        return skel
+        return load_pcg_skeleton(filepath, include_mesh_to_skel_map=True)
+
+
+class ConnectomeAdapter(FilePathAdapter):
+    def get(self, filepath):
+        filepath = super().get(filepath)
+        return Connectome.load(filepath)
+
+
+class GridIndexAdapter(FilePathAdapter):
+    def get(self, filepath):
+        filepath = super().get(filepath)
+        return GridIndex.load(filepath)
+
+
+class MeshLODAdapter(FilePathAdapter):
+    def get(self, filepath):
+        filepath = super().get(filepath)
+        return MeshLOD.load(filepath)
+
+
+class SkeletonPackAdapter(FilePathAdapter):
+    def get(self, filepath):
+        filepath = super().get(filepath)
+        return open_skeleton_pack(str(filepath))
 
 # M65
 minnie65_meshes = TrimeshAdapter('filepath@minnie65_meshes')
 minnie65_meshwork = MeshworkAdapter('filepath@minnie65_meshwork')
 minnie65_pcg_skeletons = PCGSkelAdapter('filepath@minnie65_pcg_skeletons')
 minnie65_meshwork_axon_dendrite_skeletons = NumpyAdapter('filepath@minnie65_meshwork_axon_dendrite_skeletons')
+minnie65_connectomes = ConnectomeAdapter('filepath@minnie65_connectomes')
+minnie65_spatial_indexes = GridIndexAdapter('filepath@minnie65_spatial_indexes')
+minnie65_mesh_lods = MeshLODAdapter('filepath@minnie65_mesh_lods')
+minnie65_skeleton_packs = SkeletonPackAdapter('filepath@minnie65_skeleton_packs')
 
 minnie65_materialization = {
     'minnie65_meshes': minnie65_meshes,
     'minnie65_meshwork': minnie65_meshwork,
     'minnie65_pcg_skeletons': minnie65_pcg_skeletons,
     'minnie65_meshwork_axon_dendrite_skeletons': minnie65_meshwork_axon_dendrite_skeletons,
+    'minnie65_connectomes': minnie65_connectomes,
+    'minnie65_spatial_indexes': minnie65_spatial_indexes,
+    'minnie65_mesh_lods': minnie65_mesh_lods,
+    'minnie65_skeleton_packs': minnie65_skeleton_packs,
 }
 
 # H01
@@ -19,10 +19,21 @@ minnie65_materialization_external_meshes_path = base_path / 'minnie65' / 'meshes
 minnie65_materialization_external_meshwork_path = base_path / 'minnie65' / 'meshwork'
 minnie65_materialization_external_pcg_skeletons_path = base_path / 'minnie65' / 'pcg_skeletons'
 minnie65_materialization_external_meshwork_axon_dendrite_skeletons_path = base_path / 'minnie65' / 'meshwork_axon_dendrite_skeletons'
+minnie65_materialization_external_connectomes_path = base_path / 'minnie65' / 'connectomes'
+minnie65_materialization_external_spatial_indexes_path = base_path / 'minnie65' / 'spatial_indexes'
+minnie65_materialization_external_mesh_lods_path = base_path / 'minnie65' / 'mesh_lods'
+minnie65_materialization_external_skeleton_packs_path = base_path / 'minnie65' / 'skeleton_packs'
 
 minnie65_materialization = {
     'minnie65_meshes': djp.make_store_dict(minnie65_materialization_external_meshes_path),
     'minnie65_meshwork': djp.make_store_dict(minnie65_materialization_external_meshwork_path),
     'minnie65_pcg_skeletons': djp.make_store_dict(minnie65_materialization_external_pcg_skeletons_path),
     'minnie65_meshwork_axon_dendrite_skeletons': djp.make_store_dict(minnie65_materialization_external_meshwork_axon_dendrite_skeletons_path),
+    'minnie65_connectomes': djp.make_store_dict(minnie65_materialization_external_connectomes_path),
+    'minnie65_spatial_indexes': djp.make_store_dict(minnie65_materialization_external_spatial_indexes_path),
+    'minnie65_mesh_lods': djp.make_store_dict(minnie65_materialization_external_mesh_lods_path),
+    'minnie65_skeleton_packs': djp.make_store_dict(minnie65_materialization_external_skeleton_packs_path),
 }
+
+#minnie65_materialization exports (not registered as a DataJoint store)
+minnie65_materialization_exports_path = base_path / 'minnie65' / 'exports'
@@ -1,11 +1,30 @@
 """
 DataJoint tables for importing minnie65 from CAVE.
 """
+import os
+import uuid
+from pathlib import Path
+
 import datajoint as dj
 import datajoint_plus as djp
-from microns_utils.misc_utils import classproperty
+import numpy as np
+import pandas as pd
+from microns_utils.misc_utils import classproperty, wrap
 import microns_utils.datajoint_utils as dju
 from ..config import minnie65_materialization_config as config
+from ..utils.cache_utils import QueryCache, cached_filepath, local_file_cache
+from ..utils.connectivity_utils import Connectome as SparseConnectome
+from ..utils.filepath_utils import BulkFetchMixin, bulk_load, fetch_filepaths
+from ..utils.lineage_utils import NucleusLineage
+from ..utils.mesh_utils import MeshLOD
+from ..utils.metrics_utils import collector as metrics_collector
+from ..utils.meshwork_utils import (load_meshwork_annotations,
+                                    load_meshwork_mesh_indices,
+                                    load_meshwork_skeleton, load_pcg_skeleton,
+                                    read_h5_datasets)
+from ..utils.pack_utils import open_skeleton_pack, read_skeleton_file
+from ..utils.spatial_utils import GridIndex, voxels_to_nm
+from ..utils.synapse_utils import to_primary_secondary
 
 config.register_externals()
 config.register_adapters(context=locals())
@@ -89,6 +108,27 @@ class ImportMethod(djp.Lookup):
         ts_inserted=CURRENT_TIMESTAMP : timestamp
         """
 
+    class MeshPartyMesh3(djp.Part):
+        enable_hashing = True
+        hash_name = 'import_method'
+        hashed_attrs = 'meshparty_version', 'caveclient_version', 'datastack', 'ver', 'cloudvolume_version', 'cloudvolume_path', 'download_meshes_kwargs', 'storage_kwargs', 'target_dir'
+        definition = """
+        # meshes downloaded as in MeshPartyMesh2, then stored as compressed hdf5 with optionally quantized vertices
+        -> master
+        ---
+        description : varchar(1000) # details
+        meshparty_version: varchar(48) # version of meshparty installed when method was created
+        caveclient_version: varchar(48) # version of caveclient installed when method was created
+        datastack: varchar(250) # name of datastack
+        ver: smallint # client materialization version
+        cloudvolume_version: varchar(48) # version of cloudvolume installed when method was created
+        cloudvolume_path: varchar(250) # cloudvolume path used to download meshes
+        download_meshes_kwargs: varchar(1000) # JSON array passed to meshparty.trimesh_io.download_meshes. Note: use json.loads to recover dict.
+        storage_kwargs: varchar(1000) # JSON array passed to mesh_utils.compress_mesh_file. Note: use json.loads to recover dict.
+        target_dir: varchar(1000) # target directory for mesh files
+        ts_inserted=CURRENT_TIMESTAMP : timestamp
+        """
+
     class Synapse(djp.Part):
         enable_hashing = True
         hash_name = 'import_method'
@@ -190,6 +230,52 @@ class MakeMethod(djp.Lookup):
         -> Tag
         """
 
+    class SynapseConnectome(djp.Part):
+        enable_hashing = True
+        hash_name = 'make_method'
+        hashed_attrs = Tag.attr_name,
+        definition = """
+        -> master
+        ---
+        target_dir: varchar(1000) # target directory for file
+        -> Tag
+        """
+
+    class MeshLOD(djp.Part):
+        enable_hashing = True
+        hash_name = 'make_method'
+        hashed_attrs = 'fractions', Tag.attr_name
+        definition = """
+        -> master
+        ---
+        fractions : varchar(128) # JSON list of the target fraction of faces of each level, e.g. [0.1, 0.01, 0.001]
+        target_dir: varchar(1000) # target directory for file
+        -> Tag
+        """
+
+    class SynapseSpatialIndex(djp.Part):
+        enable_hashing = True
+        hash_name = 'make_method'
+        hashed_attrs = 'cell_size', Tag.attr_name
+        definition = """
+        -> master
+        ---
+        cell_size : float # size of a grid cell in nm
+        target_dir: varchar(1000) # target directory for file
+        -> Tag
+        """
+
+    class SkeletonPack(djp.Part):
+        enable_hashing = True
+        hash_name = 'make_method'
+        hashed_attrs = Tag.attr_name,
+        definition = """
+        -> master
+        ---
+        target_dir: varchar(1000) # target directory for file
+        -> Tag
+        """
+
 
 
 @schema
@@ -299,6 +385,76 @@ class Nucleus(djp.Lookup):
         ts_inserted=CURRENT_TIMESTAMP : timestamp # timestamp inserted
         """
 
+    class Lineage(djp.Part):
+        definition = """
+        # segment of each nucleus in a materialization version, compared with the previous imported version
+        -> master.Info
+        ---
+        prev_ver=NULL        : decimal(6,2)                 # previous materialization version in Nucleus.CAVE that has the nucleus
+        prev_segment_id=NULL : bigint unsigned              # segment_id of the nucleus in prev_ver
+        n_nuclei             : smallint unsigned            # number of nuclei with segment_id in ver
+        segment_changed      : tinyint                      # 1 if segment_id differs from prev_segment_id
+        split                : tinyint                      # 1 if the nuclei of prev_segment_id are in more than one segment in ver
+        merge                : tinyint                      # 1 if segment_id has nuclei from more than one segment in prev_ver
+        index (nucleus_id)
+        index (segment_id)
+        """
+
+    class LineageMaker(djp.Part, dj.Computed):
+        definition = """
+        -> Materialization
+        ---
+        ts_inserted=CURRENT_TIMESTAMP : timestamp # timestamp inserted
+        """
+
+    @classmethod
+    def lineage(cls, ver=None):
+        """
+        Loads the nucleus lineage for in-memory lookups of segment ids by nucleus id across versions and the reverse.
+
+        Rows are fetched through the local query cache.
+
+        :param ver: materialization version(s) to load. If None, all versions in Nucleus.LineageMaker.
+
+        :returns: utils.lineage_utils.NucleusLineage
+        """
+        rel = cls.Lineage if ver is None else cls.Lineage & [{'ver': v} for v in wrap(ver)]
+        df = fetch_cached(rel.proj(*NucleusLineage.flags), cls.LineageMaker, ver=ver).reset_index()
+        return NucleusLineage(df)
+
+    _spatial_indexes = {}
+
+    @classmethod
+    def spatial_index(cls, ver, cell_size=50_000):
+        """
+        Grid index of the nucleus centroids of a materialization version. Query coordinates are in nm and queries return nucleus_id.
+
+        The index is built on first use and cached on local disk in MICRONS_SPATIAL_INDEX_CACHE_DIR.
+            It is rebuilt when Nucleus.CAVE has inserted rows for ver since it was cached.
+
+        :param ver: materialization version
+        :param cell_size: (float) size of a grid cell in nm
+
+        :returns: utils.spatial_utils.GridIndex
+        """
+        ver = (Materialization & {'ver': ver}).fetch1('ver')
+        n_rows = len(cls.CAVE & {'ver': ver})
+        filepath = spatial_index_cache_dir / f'nucleus_{ver}_{n_rows}_{cell_size}.npz'
+        if filepath not in cls._spatial_indexes:
+            if not filepath.exists():
+                for stale_filepath in spatial_index_cache_dir.glob(f'nucleus_{ver}_*_{cell_size}.npz'):
+                    stale_filepath.unlink(missing_ok=True)
+                df = (cls.Info & {'ver': ver}).proj('nucleus_x', 'nucleus_y', 'nucleus_z').fetch(format='frame').reset_index()
+                assert len(df) > 0, f'No nuclei found for ver {ver}.'
+                points = voxels_to_nm(df[['nucleus_x', 'nucleus_y', 'nucleus_z']].values)
+                spatial_index_cache_dir.mkdir(parents=True, exist_ok=True)
+                # build under a unique name so concurrent processes never load a partial file
+                tmp_filepath = filepath.with_name(f'.{uuid.uuid4().hex}.npz')
+                GridIndex.build(tmp_filepath, lambda: iter([(df['nucleus_id'].values, points)]), bounds=[points.min(0), points.max(0)], cell_size=cell_size)
+                os.replace(tmp_filepath, filepath)
+            cls._spatial_indexes[filepath] = GridIndex.load(filepath)
+        return cls._spatial_indexes[filepath]
+
 
 
 @schema
@@ -323,6 +479,23 @@ class Segment(djp.Lookup):
         ts_inserted=CURRENT_TIMESTAMP : timestamp
         """
 
+    class Summary(djp.Part):
+        definition = """
+        # summary statistics of each segment in a materialization version
+        -> Materialization
+        -> master
+        ---
+        n_nuclei                      : smallint unsigned    # number of nuclei of the segment in Nucleus.Info
+        n_presyn=NULL                 : int unsigned         # number of synapses in Synapse.Info2 where the segment is presynaptic. NULL if synapses are not imported yet.
+        n_postsyn=NULL                : int unsigned         # number of synapses in Synapse.Info2 where the segment is postsynaptic. NULL if synapses are not imported yet.
+        n_vertices=NULL               : int unsigned         # number of vertices of the latest mesh in Mesh.Object
+        n_faces=NULL                  : int unsigned         # number of faces of the latest mesh in Mesh.Object
+        split_score=NULL              : float                # split_score of the latest axon/dendrite skeleton in Skeleton.MeshworkAxonDendriteSkeleton
+        has_meshwork                  : tinyint              # 1 if the segment has a meshwork in Meshwork.PCGMeshwork
+        has_pcg_skeleton              : tinyint              # 1 if the segment has a skeleton in Skeleton.PCGSkeleton
+        ts_inserted=CURRENT_TIMESTAMP : timestamp
+        """
+
 
 @schema
 class Exclusion(djp.Lookup):
@@ -346,6 +519,14 @@ class Synapse(djp.Lookup):
     definition = """
     synapse_id           : bigint unsigned              # synapse index within the segmentation
     """
+
+    @classproperty
+    def complete(cls):
+        """
+        Materialization versions where every nucleus segment has been imported by Synapse.CAVE2 or excluded.
+        """
+        remaining = (Segment.Nucleus.proj(primary_seg_id='segment_id') - cls.SegmentExclude) - cls.CAVE2.proj()
+        return (Materialization & cls.CAVE2) - remaining
     
     class Info(djp.Part):
         definition = """
@@ -376,6 +557,62 @@ class Synapse(djp.Lookup):
         synapse_size                                  : int unsigned                 # (EM voxels) scaled by (4x4x40)
         """
     
+    class Edge(djp.Part):
+        definition = """
+        # Synapses from the table 'synapses_pni_2', stored once per synapse
+        -> Materialization
+        -> master
+        ---
+        pre_seg_id                                    : bigint unsigned              # id of the presynaptic segment
+        post_seg_id                                   : bigint unsigned              # id of the postsynaptic segment
+        synapse_x                                     : int unsigned                 # x coordinate of synapse centroid in EM voxels (x: 4nm, y: 4nm, z: 40nm). From Allen 'ctr_pt_position'.
+        synapse_y                                     : int unsigned                 # y coordinate of centroid in EM voxels (x: 4nm, y: 4nm, z: 40nm). From Allen 'ctr_pt_position'.
+        synapse_z                                     : int unsigned                 # z coordinate of centroid in EM voxels (x: 4nm, y: 4nm, z: 40nm). From Allen 'ctr_pt_position'.
+        synapse_size                                  : int unsigned                 # (EM voxels) scaled by (4x4x40)
+        index (ver, pre_seg_id)
+        index (ver, post_seg_id)
+        """
+
+        @classmethod
+        def fetch_as_info2(cls, ver, primary_seg_ids=None, chunk_size=10_000):
+            """
+            Fetches synapses in the layout of Synapse.Info2, with one row per synapse and primary segment.
+
+            :param ver: materialization version
+            :param primary_seg_ids: (array-like) primary segments to fetch synapses of
+                If None, all primary segments converted for ver.
+            :param chunk_size: (int) number of primary segments per query when primary_seg_ids is provided,
+                which bounds the size of the SQL statement
+
+            :returns: pandas.DataFrame with the columns of Synapse.Info2
+            """
+            primaries = (dj.U('primary_seg_id') & (cls.master.EdgeMaker & {'ver': ver})).fetch('primary_seg_id')
+            if primary_seg_ids is not None:
+                primaries = np.intersect1d(primaries, np.asarray(primary_seg_ids, dtype=primaries.dtype))
+            if len(primaries) == 0:
+                return to_primary_secondary(pd.DataFrame(columns=cls.heading.names), primaries)
+            edges = cls & {'ver': ver}
+            if primary_seg_ids is None:
+                # every edge of ver was converted from a primary segment, so no restriction is needed
+                df = edges.fetch(format='frame').reset_index()
+            else:
+                dfs = []
+                for start in range(0, len(primaries), chunk_size):
+                    ids = ','.join(str(int(i)) for i in primaries[start:start + chunk_size])
+                    dfs.append((edges & f'pre_seg_id in ({ids}) or post_seg_id in ({ids})').fetch(format='frame').reset_index())
+                # a synapse between two chunks is fetched by both
+                df = pd.concat(dfs, ignore_index=True).drop_duplicates(['ver', 'synapse_id'])
+            return to_primary_secondary(df, primaries)
+
+    class EdgeMaker(djp.Part, dj.Computed):
+        definition = """
+        -> Materialization
+        -> Segment.proj(primary_seg_id='segment_id')
+        ---
+        n_synapses : int unsigned # number of synapses of the primary segment stored in Edge
+        ts_inserted=CURRENT_TIMESTAMP : timestamp # timestamp inserted
+        """
+
     class MatV1(djp.Part):
         definition = """
         -> master.Info
@@ -417,7 +654,8 @@ class Mesh(djp.Lookup):
     mesh_id : varchar(12) # unique identifier of a mesh
     """
     
-    class Object(djp.Part):
+    class Object(BulkFetchMixin, djp.Part):
+        bulk_fetch_attrs = ('mesh',)
         definition = """
         -> master
         ---
@@ -427,6 +665,62 @@ class Mesh(djp.Lookup):
         ts_inserted=CURRENT_TIMESTAMP : timestamp
         """
     
+    class Stats(djp.Part):
+        definition = """
+        # geometry statistics of each mesh in Mesh.Object
+        -> master.Object
+        ---
+        area                          : double               # surface area (nm^2)
+        volume                        : double               # enclosed volume (nm^3), only meaningful for watertight meshes
+        bbox_min_x                    : float                # lower corner of the bounding box of the vertices (nm)
+        bbox_min_y                    : float                # lower corner of the bounding box of the vertices (nm)
+        bbox_min_z                    : float                # lower corner of the bounding box of the vertices (nm)
+        bbox_max_x                    : float                # upper corner of the bounding box of the vertices (nm)
+        bbox_max_y                    : float                # upper corner of the bounding box of the vertices (nm)
+        bbox_max_z                    : float                # upper corner of the bounding box of the vertices (nm)
+        centroid_x                    : float                # area-weighted centroid of the faces (nm)
+        centroid_y                    : float                # area-weighted centroid of the faces (nm)
+        centroid_z                    : float                # area-weighted centroid of the faces (nm)
+        ts_inserted=CURRENT_TIMESTAMP : timestamp
+        """
+
+    class LOD(djp.Part):
+        definition = """
+        # decimated levels of detail of each mesh in Mesh.Object
+        -> master.Object
+        -> MakeMethod
+        ---
+        n_levels                      : tinyint unsigned     # number of levels
+        lod_obj                       : <minnie65_mesh_lods> # path to the hdf5 file with all levels
+        ts_inserted=CURRENT_TIMESTAMP : timestamp
+        """
+
+        @classmethod
+        def load(cls, key, face_budget=None):
+            """
+            Reads one level of detail of a mesh, without reading the other levels or the full resolution mesh.
+
+            :param key: restriction that selects one row of Mesh.LOD (e.g. {'mesh_id': ...} if there is one make method)
+            :param face_budget: (int) number of faces needed. The coarsest level with at least face_budget faces is read,
+                or the finest level if none has enough. If None, the finest level.
+
+            :returns: trimesh.Trimesh
+            """
+            df = fetch_filepaths(cls & key, 'lod_obj')
+            assert len(df) == 1, f'key must select one row, but selects {len(df)}.'
+            return MeshLOD.load(cached_filepath(df['lod_obj'][0])).trimesh(face_budget)
+
+    class LODLevel(djp.Part):
+        definition = """
+        # size of each level of detail in Mesh.LOD
+        -> master.LOD
+        level                         : tinyint unsigned     # level index, 0 is the finest
+        ---
+        fraction                      : float                # target fraction of the faces of the full resolution mesh
+        n_vertices                    : int unsigned         # number of vertices
+        n_faces                       : int unsigned         # number of faces
+        """
+
     class MeshParty(djp.Part, dj.Computed):
         enable_hashing = True
         hash_name = 'mesh_id'
@@ -450,13 +744,40 @@ class Meshwork(djp.Lookup):
     """
     contents = [[0]] # default id for rows lacking object
 
-    class PCGMeshwork(djp.Part):
+    class PCGMeshwork(BulkFetchMixin, djp.Part):
+        bulk_fetch_attrs = ('meshwork_obj',)
         definition = """
         -> master
         ---
         meshwork_obj : <minnie65_meshwork> # in-place path to the hdf5 file
         """
 
+        @classmethod
+        def load(cls, key, part='meshwork', **kwargs):
+            """
+            Loads a meshwork, or only part of it, without the checksum DataJoint runs on filepath fetches.
+
+            :param key: restriction that selects one row
+            :param part: (str) one of:
+                "meshwork": the full meshparty Meshwork (as fetched through MeshworkAdapter)
+                "skeleton": only the skeleton (meshparty Skeleton)
+                "annotations": only annotation tables, dict of pandas.DataFrame. kwargs: table_names
+                "mesh_indices": only the mesh indices of annotation rows (e.g. synapses), dict of arrays. kwargs: table_names
+                "datasets": only specific HDF5 datasets, dict of arrays. kwargs: names
+            """
+            from meshparty import meshwork
+            loaders = {
+                'meshwork': meshwork.load_meshwork,
+                'skeleton': load_meshwork_skeleton,
+                'annotations': load_meshwork_annotations,
+                'mesh_indices': load_meshwork_mesh_indices,
+                'datasets': read_h5_datasets,
+            }
+            assert part in loaders, f'part must be one of {list(loaders)}'
+            df = fetch_filepaths(cls & key, 'meshwork_obj')
+            assert len(df) == 1, f'key must select one row, but selects {len(df)}.'
+            return loaders[part](cached_filepath(df['meshwork_obj'][0]), **kwargs)
+
     class PCGMeshworkExclude(djp.Part):
         definition = """
         -> Segment
@@ -489,13 +810,38 @@ class Skeleton(djp.Lookup):
     """
     contents = [[0]] # default id for rows lacking object
 
-    class PCGSkeleton(djp.Part):
+    class PCGSkeleton(BulkFetchMixin, djp.Part):
+        bulk_fetch_attrs = ('skeleton_obj',)
         definition = """
         -> master
         ---
         skeleton_obj : <minnie65_pcg_skeletons>   # in-place path to the hdf5 file
         """
 
+        @classmethod
+        def load(cls, key, include_mesh_to_skel_map=False, datasets=None, use_pack=True):
+            """
+            Loads a skeleton without its mesh_to_skel_map, or only specific HDF5 datasets, without the checksum
+                DataJoint runs on filepath fetches.
+
+            :param key: restriction that selects one row
+            :param include_mesh_to_skel_map: (bool) also read mesh_to_skel_map, as PCGSkelAdapter does
+            :param datasets: (list) if provided, returns only these datasets (e.g. ["vertices", "edges"]) as a dict of arrays
+            :param use_pack: (bool) read the skeleton from a SkeletonPack if it is packed. Packs do not store the
+                mesh_to_skel_map, so the skeleton file is read if include_mesh_to_skel_map or datasets is provided.
+
+            :returns: meshparty Skeleton, or dict of arrays if datasets is provided
+            """
+            if use_pack and not include_mesh_to_skel_map and datasets is None:
+                packed = SkeletonPack.locate(cls & key, 'skeleton_obj')
+                if len(packed) == 1:
+                    return open_skeleton_pack(str(cached_filepath(packed['pack_obj'][0]))).skeleton('skeleton_obj', packed['idx'][0])
+            df = fetch_filepaths(cls & key, 'skeleton_obj')
+            assert len(df) == 1, f'key must select one row, but selects {len(df)}.'
+            if datasets is not None:
+                return read_h5_datasets(cached_filepath(df['skeleton_obj'][0]), datasets)
+            return load_pcg_skeleton(cached_filepath(df['skeleton_obj'][0]), include_mesh_to_skel_map=include_mesh_to_skel_map)
+
     class PCGSkeletonMaker(djp.Part, dj.Computed):
         enable_hashing = True
         hash_name = 'skeleton_id'
@@ -509,6 +855,22 @@ class Skeleton(djp.Lookup):
         ts_inserted=CURRENT_TIMESTAMP : timestamp
         """
 
+    class PCGSkeletonMetrics(djp.Part):
+        definition = """
+        # morphology metrics of each skeleton in Skeleton.PCGSkeleton
+        -> master.PCGSkeleton
+        ---
+        n_vertices                    : int unsigned         # number of skeleton vertices
+        n_edges                       : int unsigned         # number of skeleton edges
+        cable_length                  : float                # summed length of all edges (nm)
+        n_branch_points               : int unsigned         # number of vertices with more than two edges
+        n_end_points                  : int unsigned         # number of vertices with one edge
+        max_path_length               : float                # max path length from the root to a vertex along the skeleton (nm)
+        mean_path_length              : float                # mean path length from the root to a vertex along the skeleton (nm)
+        radial_extent                 : float                # max euclidean distance of a vertex from the root (nm)
+        ts_inserted=CURRENT_TIMESTAMP : timestamp
+        """
+
     class MeshworkAxonDendriteSkeletonError(djp.Part):
         error_code = '000001'
         hash_name = 'skeleton_id'
@@ -521,7 +883,8 @@ class Skeleton(djp.Lookup):
         ts_inserted=CURRENT_TIMESTAMP : timestamp
         """
 
-    class MeshworkAxonDendriteSkeleton(djp.Part):
+    class MeshworkAxonDendriteSkeleton(BulkFetchMixin, djp.Part):
+        bulk_fetch_attrs = ('axon_skeleton', 'dendrite_skeleton')
         hash_name = 'skeleton_id'
         definition = """
         -> master
@@ -531,6 +894,17 @@ class Skeleton(djp.Lookup):
         split_score : float # score from pcg_skel.meshwork.algorithms.split_axon_by_synapses
         """
 
+        @classmethod
+        def load(cls, key, use_pack=True):
+            """
+            Loads the axon and dendrite skeletons of a row, from a SkeletonPack if they are packed.
+
+            :param key: restriction that selects one row
+
+            :returns: dict with axon_skeleton and dendrite_skeleton, each a dict with vertices and edges arrays
+            """
+            return {attr_name: next(SkeletonPack.fetch_arrays(cls & key, attr_name, use_pack=use_pack))[1] for attr_name in ('axon_skeleton', 'dendrite_skeleton')}
+
     class MeshworkAxonDendriteSkeletonMaker(djp.Part, dj.Computed):
         enable_hashing = True
         hash_name = 'skeleton_make_id'
@@ -543,6 +917,169 @@ class Skeleton(djp.Lookup):
         ts_inserted=CURRENT_TIMESTAMP : timestamp
         """
 
+@schema
+class SkeletonPack(djp.Lookup):
+    hash_name = 'pack_id'
+    definition = """
+    pack_id : varchar(12) # unique identifier of a skeleton pack
+    """
+
+    class Object(djp.Part):
+        definition = """
+        -> master
+        ---
+        n_skeletons : int unsigned # number of packed skeletons
+        pack_obj : <minnie65_skeleton_packs> # path to the hdf5 file with the concatenated vertices and edges of all members
+        """
+
+    class Member(djp.Part):
+        definition = """
+        # skeletons stored in a pack
+        -> master.Object
+        -> Skeleton
+        attr_name : varchar(32) # packed attribute, e.g. "skeleton_obj" of Skeleton.PCGSkeleton or "axon_skeleton" of Skeleton.MeshworkAxonDendriteSkeleton
+        ---
+        idx : int unsigned # index of the skeleton in the pack group attr_name
+        """
+
+    class SkeletonMaker(djp.Part, dj.Computed):
+        enable_hashing = True
+        hash_name = 'pack_id'
+        hashed_attrs = Materialization.primary_key + MakeMethod.primary_key
+        definition = """
+        -> master.Object
+        -> Materialization
+        -> MakeMethod
+        ---
+        ts_inserted=CURRENT_TIMESTAMP : timestamp
+        """
+
+    @classmethod
+    def locate(cls, restriction={}, attr_name='skeleton_obj'):
+        """
+        Finds the packs of skeletons, without opening any files.
+
+        :param restriction: restriction on skeleton_id, e.g. a query of Skeleton.PCGSkeleton
+        :param attr_name: (str) packed attribute
+
+        :returns: pandas.DataFrame with skeleton_id, pack_obj (path to the pack) and idx. If a skeleton is in several packs, one is chosen.
+        """
+        rel = cls.Object * (cls.Member & {'attr_name': attr_name} & restriction)
+        return fetch_filepaths(rel, 'pack_obj').drop_duplicates('skeleton_id').reset_index(drop=True)
+
+    @classmethod
+    def fetch_arrays(cls, rel, attr_name='skeleton_obj', use_pack=True, n_workers=16):
+        """
+        Reads the vertices and edges of skeletons from their packs, or from their own files if they are not packed.
+
+        :param rel: Skeleton.PCGSkeleton or Skeleton.MeshworkAxonDendriteSkeleton, or a restriction of them
+        :param attr_name: (str) "skeleton_obj", "axon_skeleton" or "dendrite_skeleton"
+        :param use_pack: (bool) if False, always reads the skeleton files
+        :param n_workers: (int) number of threads reading skeleton files
+
+        :yields: skeleton_id and dict with vertices, edges and root (-1 if none), in order of skeleton_id
+        """
+        df = fetch_filepaths(rel, attr_name, order_by='skeleton_id')
+        packed = cls.locate(rel, attr_name).set_index('skeleton_id') if use_pack else pd.DataFrame(columns=['pack_obj', 'idx'])
+
+        def load(skeleton_id):
+            if skeleton_id in packed.index:
+                return open_skeleton_pack(str(cached_filepath(packed.at[skeleton_id, 'pack_obj']))).get(attr_name, packed.at[skeleton_id, 'idx'])
+            return read_skeleton_file(cached_filepath(filepaths[skeleton_id]))
+
+        filepaths = dict(zip(df['skeleton_id'], df[attr_name]))
+        skeleton_ids = df['skeleton_id'].tolist()
+        arrays = bulk_load(skeleton_ids, load, n_workers=n_workers, nbytes=lambda skeleton_id: 0, report_every=None)
+        return zip(skeleton_ids, arrays)
+
+
+@schema
+class SpatialIndex(djp.Lookup):
+    hash_name = 'spatial_index_id'
+    definition = """
+    spatial_index_id : varchar(12) # unique identifier of a spatial index
+    """
+
+    class Object(djp.Part):
+        definition = """
+        -> master
+        ---
+        n_points : int unsigned # number of indexed points
+        cell_size : float # size of a grid cell in nm
+        spatial_index_obj : <minnie65_spatial_indexes> # path to the .npz file of the grid index (coordinates in nm)
+        """
+
+    class SynapseMaker(djp.Part, dj.Computed):
+        enable_hashing = True
+        hash_name = 'spatial_index_id'
+        hashed_attrs = Materialization.primary_key + MakeMethod.primary_key
+        definition = """
+        -> master.Object
+        -> Materialization
+        -> MakeMethod
+        ---
+        ts_inserted=CURRENT_TIMESTAMP : timestamp
+        """
+
+    @classmethod
+    def load_synapses(cls, ver):
+        """
+        Memory maps the synapse centroid index of a materialization version.
+
+        Query coordinates are in nm; use utils.spatial_utils.voxels_to_nm to convert synapse_x/y/z. Queries return synapse_id.
+
+        :param ver: materialization version
+
+        :returns: utils.spatial_utils.GridIndex
+        """
+        filepath = fetch_filepaths(cls.Object & (cls.SynapseMaker & {'ver': ver}), 'spatial_index_obj')['spatial_index_obj'].item()
+        return GridIndex.load(cached_filepath(filepath))
+
+
+@schema
+class Connectome(djp.Lookup):
+    hash_name = 'connectome_id'
+    definition = """
+    connectome_id : varchar(12) # unique identifier of a connectome
+    """
+
+    class Object(djp.Part):
+        definition = """
+        -> master
+        ---
+        n_segments : int unsigned # number of segments (rows and columns of the matrices)
+        n_edges : int unsigned # number of connected (pre, post) segment pairs
+        n_synapses : int unsigned # number of synapses after removing the copies stored under both primary segments
+        connectome_obj : <minnie65_connectomes> # path to the .npz file of CSR/CSC synapse count and synapse size arrays
+        """
+
+    class SynapseMaker(djp.Part, dj.Computed):
+        enable_hashing = True
+        hash_name = 'connectome_id'
+        hashed_attrs = Materialization.primary_key + MakeMethod.primary_key
+        definition = """
+        -> master.Object
+        -> Materialization
+        -> MakeMethod
+        ---
+        ts_inserted=CURRENT_TIMESTAMP : timestamp
+        """
+
+    @classmethod
+    def load(cls, ver):
+        """
+        Memory maps the synapse connectome of a materialization version.
+
+        The file is opened directly instead of through the adapter, which would first checksum the whole file.
+
+        :param ver: materialization version
+
+        :returns: utils.connectivity_utils.Connectome
+        """
+        filepath = fetch_filepaths(cls.Object & (cls.SynapseMaker & {'ver': ver}), 'connectome_obj')['connectome_obj'].item()
+        return SparseConnectome.load(cached_filepath(filepath))
+
+
 @schema
 class Queue(djp.Lookup):
     hash_name = 'queue_id'
@@ -584,5 +1121,190 @@ class Queue(djp.Lookup):
         def add_rows(cls, rows):
             cls.insert(rows, insert_to_master=True, ignore_extra_fields=True)
 
-schema.spawn_missing_classes()
+
+@schema
+class Metrics(djp.Lookup):
+    definition = """
+    # aggregation windows of utils.metrics_utils.collector
+    pod : varchar(128) # name of the pod (HOSTNAME) that recorded the stages
+    window_start : datetime(6) # start of the aggregation window
+    ---
+    window_s : float # length of the aggregation window in seconds
+    ts_inserted=CURRENT_TIMESTAMP : timestamp
+    """
+
+    class Stage(djp.Part):
+        definition = """
+        # wall time, bytes and rows of a stage of a maker, summed over an aggregation window
+        -> master
+        table_name : varchar(128) # class name of the maker, e.g. "Mesh.MeshParty"
+        method : varchar(32) # import_method or make_method of the keys, "" if none
+        stage : varchar(32) # stage name. "make" is the whole make() call.
+        ---
+        n_calls : int unsigned # number of times the stage ran
+        n_errors : int unsigned # number of times the stage raised
+        seconds : double # summed wall time in seconds
+        n_bytes : bigint unsigned # summed bytes read or written
+        n_rows : bigint unsigned # summed rows fetched or inserted
+        """
+
+    _connection = None
+    stage_attrs = ['table_name', 'method', 'stage', 'n_calls', 'n_errors', 'seconds', 'n_bytes', 'n_rows']
+
+    @classmethod
+    def insert_window(cls, pod, window_start, window_s, rows):
+        """
+        Inserts a window of utils.metrics_utils.collector. Rows are inserted with a connection of their own,
+            so they are kept if the transaction of the make being recorded is rolled back.
+        """
+        if cls._connection is None:
+            cls._connection = dj.Connection(dj.config['database.host'], dj.config['database.user'], dj.config['database.password'])
+        conn = cls._connection
+        values = ', '.join(['(' + ', '.join(['%s'] * (len(cls.stage_attrs) + 2)) + ')'] * len(rows))
+        with conn.transaction:
+            conn.query(f'INSERT INTO {cls.full_table_name} (pod, window_start, window_s) VALUES (%s, %s, %s)', args=(pod, window_start, window_s))
+            conn.query(
+                f'INSERT INTO {cls.Stage.full_table_name} (pod, window_start, {", ".join(cls.stage_attrs)}) VALUES {values}',
+                args=[v for row in rows for v in [pod, window_start] + [row[attr] for attr in cls.stage_attrs]]
+            )
+
+    @classmethod
+    def summary(cls, restriction={}, by=('table_name', 'method', 'stage')):
+        """
+        Sums the stages of all windows matching a restriction (e.g. {'pod': ...} or 'window_start > "2024-01-01"').
+
+        :returns: pandas.DataFrame indexed by the attributes in by, with the summed n_calls, n_errors, seconds, n_bytes
+            and n_rows and the derived seconds_per_call, bytes_per_s and rows_per_s
+        """
+        df = (cls.Stage & restriction).fetch(format='frame').reset_index()
+        df = df.groupby(list(by))[['n_calls', 'n_errors', 'seconds', 'n_bytes', 'n_rows']].sum()
+        df['seconds_per_call'] = df['seconds'] / df['n_calls']
+        df['bytes_per_s'] = df['n_bytes'] / df['seconds']
+        df['rows_per_s'] = df['n_rows'] / df['seconds']
+        return df
+
+
+metrics_collector.sinks.append(Metrics.insert_window)
+
+
+def __getattr__(name):
+    """
+    Creates module attributes on first access, so importing this module does not query the legacy schema or list all tables:
+        mat_v1: virtual module of the legacy schema microns_minnie65_materialization
+        other names: classes of tables in the schema that are not defined in this module (schema.spawn_missing_classes)
+    """
+    global _spawned_missing_classes
+    if name == 'mat_v1':
+        globals()[name] = dj.create_virtual_module('mat_v1', 'microns_minnie65_materialization')
+        return globals()[name]
+    if not name.startswith('__') and not _spawned_missing_classes:
+        _spawned_missing_classes = True
+        schema.spawn_missing_classes(context=globals())
+        if name in globals():
+            return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+_spawned_missing_classes = False
+
+
+spatial_index_cache_dir = Path(os.getenv('MICRONS_SPATIAL_INDEX_CACHE_DIR', Path.home() / '.cache' / 'microns-materialization' / 'spatial_indexes'))
+
+query_cache = QueryCache(
+    cache_dir=os.getenv('MICRONS_QUERY_CACHE_DIR', Path.home() / '.cache' / 'microns-materialization' / 'queries'),
+    max_bytes=float(os.getenv('MICRONS_QUERY_CACHE_MAX_BYTES', 10 * 1024**3))
+)
+
+
+def prefetch_files(rel, *attrs, n_workers=16):
+    """
+    Copies the files of filepath attributes of rel into the local file cache, e.g.
+        prefetch_files(Mesh.Object & segments, 'mesh')
+
+    :param rel: DataJoint table or query expression
+    :param attrs: (str) names of the filepath attributes
+    :param n_workers: (int) number of threads copying files
+
+    :returns: dict of cache stats (hits, misses, bytes_copied, n_evicted)
+    """
+    assert local_file_cache is not None, 'Set MICRONS_LOCAL_CACHE_DIR to enable the local file cache.'
+    df = fetch_filepaths(rel, *attrs)
+    return local_file_cache.prefetch([filepath for attr in attrs for filepath in df[attr]], n_workers=n_workers)
+
+
+# per maker table (by full table name): the server's last update time of the table and the number of rows
+#   of each version the maker has completed, reused until the table is updated
+_complete_vers = {}
+
+
+def _table_update_time(table):
+    """
+    :returns: (datetime) last insert, update or delete in table as tracked by the server, or None if unknown (e.g. after a restart)
+    """
+    return dj.conn().query(
+        'SELECT update_time FROM information_schema.tables WHERE table_schema=%s AND table_name=%s', 
+        args=(table.database, table.table_name)
+    ).fetchone()[0]
+
+
+def materialization_stamp(maker, ver=None):
+    """
+    Counts the make keys that a maker table inserted for ver, e.g. Nucleus.CAVE for Nucleus.Info.
+
+    Nucleus.CAVE, Nucleus.LineageMaker and Segment.Nucleus fill a version in one make call, so a version is complete once
+        they have it. Synapse.CAVE2 inserts one key per (ver, primary_seg_id), so its versions are complete once in Synapse.complete,
+        and its keys are only counted for the other versions. Complete versions are stamped with their number of maker rows,
+        which is counted once and remembered for the process until the server reports an update of the maker table,
+        so a complete version that gains or loses rows (e.g. from a re-run import) gets a new stamp.
+
+    :param maker: maker table of the queried table
+    :param ver: materialization version(s) to count. If None, all versions are counted.
+
+    :returns: dict of the complete versions with their number of rows and the number of make keys of the other versions,
+        which changes whenever the maker inserts or deletes rows for ver
+    """
+    update_time = _table_update_time(maker)
+    memo = _complete_vers.get(maker.full_table_name)
+    if memo is None or update_time is None or memo['update_time'] != update_time:
+        memo = _complete_vers[maker.full_table_name] = {'update_time': update_time, 'n_rows': {}}
+    complete = memo['n_rows']
+    per_segment = maker.full_table_name == Synapse.CAVE2.full_table_name
+    vers = None if ver is None else {float(v) for v in wrap(ver)}
+    if vers is None or not vers <= complete.keys():
+        restr = {} if vers is None else [{'ver': v} for v in vers - complete.keys()]
+        done = Synapse.complete if per_segment else dj.U('ver') & maker
+        new = [{'ver': v} for v in (done & restr).fetch('ver')]
+        if new:
+            counts = dj.U('ver').aggr(maker & new, n='count(*)').fetch(as_dict=True)
+            complete.update({float(row['ver']): int(row['n']) for row in counts})
+    if vers is None:
+        vers_complete = sorted(complete)
+        pending = maker - [{'ver': v} for v in complete]
+    else:
+        vers_complete = sorted(vers & complete.keys())
+        pending = maker & [{'ver': v} for v in vers - complete.keys()] if vers - complete.keys() else None
+    n_keys = len(dj.U('ver', 'primary_seg_id') & pending) if per_segment and pending is not None else 0
+    return {'complete': [[v, complete[v]] for v in vers_complete], 'n_keys': n_keys}
+
+
+def fetch_cached(rel, maker, ver=None, format='frame', **fetch_kwargs):
+    """
+    Fetches a query on Nucleus.Info, Nucleus.Lineage, Segment or Synapse.Info2 through the local query cache, e.g.
+        fetch_cached(Synapse.Info2 & {'ver': 343}, Synapse.CAVE2)
+
+    Materialized versions do not change once imported, so results are reused until the maker of 
+        the queried table inserts more rows for the queried versions (see materialization_stamp). 
+        The cache directory and size are set by MICRONS_QUERY_CACHE_DIR and MICRONS_QUERY_CACHE_MAX_BYTES.
+
+    :param rel: DataJoint table or query expression
+    :param maker: maker table of the queried table: Nucleus.CAVE, Nucleus.LineageMaker, Segment.Nucleus or Synapse.CAVE2
+    :param ver: materialization version(s) rel depends on
+        If None, taken from rel if it has a ver attribute, otherwise all versions.
+    :param format: (str) "frame" or "array"
+    :param fetch_kwargs: passed to fetch (e.g. order_by, limit)
+    """
+    if ver is None and 'ver' in rel.heading.names:
+        ver = sorted(str(v) for v in (dj.U('ver') & rel).fetch('ver'))
+    stamp = {'ver': ver, 'maker': maker.full_table_name, **materialization_stamp(maker, ver)}
+    return query_cache.fetch(rel, stamp=stamp, format=format, **fetch_kwargs)
 
@@ -0,0 +1,178 @@
+"""
+Utils for auditing the files of DataJoint filepath stores against the rows that reference them.
+"""
+import logging
+import os
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from .filepath_utils import pool_map
+
+logger = logging.getLogger(__name__)
+
+audit_statuses = ['ok', 'missing', 'orphaned', 'corrupt']
+
+
+def _scan_dir(directory):
+    """
+    :returns: list of (path, size, mtime) of the files under directory, skipping hidden files and directories
+    """
+    files, stack = [], [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    stat = entry.stat(follow_symlinks=False)
+                    files.append((entry.path, stat.st_size, stat.st_mtime))
+    return files
+
+
+def list_store_files(root, n_workers=32):
+    """
+    Lists all files of a store, scanning each top level directory (e.g. each shard) in a thread pool.
+
+    Hidden files and directories (temporary files of writes in progress, quarantine, cache locks) are skipped.
+
+    :param root: (str or pathlib.Path) root directory of the store
+    :param n_workers: (int) number of threads
+
+    :returns: pandas.DataFrame with columns filepath (relative to root), size and mtime
+    """
+    root = Path(root)
+    files, directories = [], []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            else:
+                stat = entry.stat(follow_symlinks=False)
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for result in executor.map(_scan_dir, directories):
+            files.extend(result)
+    df = pd.DataFrame(files, columns=['filepath', 'size', 'mtime'])
+    df['filepath'] = [os.path.relpath(filepath, root) for filepath in df['filepath']]
+    return df
+
+
+def check_file_header(filepath):
+    """
+    Opens a file far enough to detect truncated or corrupt files without reading its data:
+        HDF5 files are opened and their root group listed, .npz files are opened and their member list read.
+
+    :returns: (str) error message, or None if the file could be opened
+    """
+    try:
+        if Path(filepath).suffix == '.npz':
+            with zipfile.ZipFile(filepath) as f:
+                f.namelist()
+        else:
+            with h5py.File(filepath, 'r') as f:
+                list(f.keys())
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+    return None
+
+
+def check_file_headers(filepaths, n_workers=None, chunksize=64):
+    """
+    Runs check_file_header on many files in a process pool.
+
+    :returns: list of error messages (None for readable files) in the order of filepaths
+    """
+    return pool_map(check_file_header, filepaths, n_workers=n_workers, chunksize=chunksize)
+
+
+def audit_store(external, n_workers=32, check_headers=True, min_age=24 * 3600):
+    """
+    Reports missing, orphaned and corrupt files of a filepath store.
+
+    The store directory and the external table of the store are listed concurrently and joined in memory:
+        missing: paths of external rows used by a table that are not on disk
+        orphaned: files on disk that no used external row points to (including files of unused external rows)
+        corrupt: files of used external rows whose headers cannot be read (see check_file_header)
+
+    :param external: DataJoint external table of the store, e.g. schema.external["minnie65_meshes"]
+    :param n_workers: (int) number of threads listing the store and of processes checking headers
+    :param check_headers: (bool) check the headers of referenced files. Reads a few KB per file.
+    :param min_age: (float) files modified less than min_age seconds ago are never reported as orphaned,
+        because makers write files before inserting their rows
+
+    :returns: pandas.DataFrame with columns filepath (relative to the store), status (one of audit_statuses), size and error
+    """
+    stage = Path(external.spec['stage']).absolute()
+    start = time.perf_counter()
+    # the database connection is not thread-safe, so both queries run in the current thread while the store is listed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        files_future = executor.submit(list_store_files, stage, n_workers)
+        rows = external.fetch('hash', 'filepath', format='frame').reset_index()
+        used = external.used().fetch('hash')
+        files = files_future.result()
+    logger.info(f'Listed {len(files)} files and {len(rows)} external rows of store {external.store} in {time.perf_counter() - start:.1f} s.')
+
+    referenced = set(rows['filepath'][rows['hash'].isin(set(used))])
+    on_disk = files.set_index('filepath')
+
+    missing = sorted(referenced - set(on_disk.index))
+    orphaned = on_disk[~on_disk.index.isin(referenced) & (on_disk['mtime'] < time.time() - min_age)]
+    present = sorted(referenced & set(on_disk.index))
+
+    errors = [None] * len(present)
+    if check_headers:
+        start = time.perf_counter()
+        errors = check_file_headers([str(stage / filepath) for filepath in present], n_workers=n_workers)
+        logger.info(f'Checked {len(present)} file headers of store {external.store} in {time.perf_counter() - start:.1f} s.')
+
+    report = pd.concat([
+        pd.DataFrame({'filepath': present, 'status': ['ok' if e is None else 'corrupt' for e in errors], 'size': on_disk['size'].reindex(present).values, 'error': errors}),
+        pd.DataFrame({'filepath': missing, 'status': 'missing', 'size': np.nan, 'error': None}),
+        pd.DataFrame({'filepath': orphaned.index, 'status': 'orphaned', 'size': orphaned['size'].values, 'error': None}),
+    ], ignore_index=True)
+    counts = report['status'].value_counts().reindex(audit_statuses, fill_value=0).to_dict()
+    logger.info(f'Audit of store {external.store}: {counts}, {report.loc[report.status == "orphaned", "size"].sum() / 1024**3:.1f} GiB orphaned.')
+    return report
+
+
+def _move(args):
+    src, dst = args
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.rename(src, dst)
+        return True
+    except FileNotFoundError:
+        logger.warning(f'File {src} not found, skipping.')
+        return False
+
+
+def quarantine_files(root, filepaths, quarantine_dir=None, n_workers=32):
+    """
+    Moves files out of a store into a quarantine directory with a thread pool, keeping their relative paths,
+        so they can be restored or deleted later.
+
+    :param root: (str or pathlib.Path) root directory of the store
+    :param filepaths: (list) paths relative to root
+    :param quarantine_dir: (str or pathlib.Path) defaults to <root>/.quarantine/<date>, which is on the same filesystem
+        (so moving is a rename) and skipped when listing the store
+    :param n_workers: (int) number of threads
+
+    :returns: pathlib.Path of the quarantine directory
+    """
+    root = Path(root)
+    quarantine_dir = root / '.quarantine' / datetime.now().strftime('%Y-%m-%d_%H:%M:%S') if quarantine_dir is None else Path(quarantine_dir)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        n_moved = sum(executor.map(_move, [(root / filepath, quarantine_dir / filepath) for filepath in filepaths]))
+    logger.info(f'Moved {n_moved} files to {quarantine_dir}.')
+    return quarantine_dir
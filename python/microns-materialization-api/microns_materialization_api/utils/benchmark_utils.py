@@ -0,0 +1,450 @@
+"""
+Benchmarks of storage and loading of materialization objects, run on local sample files or on synthetic files.
+
+Examples:
+    python -m microns_materialization_api.utils.benchmark_utils mesh_storage /path/to/sample/meshes/*.h5
+    python -m microns_materialization_api.utils.benchmark_utils import_time microns_materialization_api.schemas.minnie65_materialization --budget 1
+    python -m microns_materialization_api.utils.benchmark_utils adapter_io --n-files 50 --threads 1 16 --data-dir /mnt/scratch --output adapter_io.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from .cache_utils import cached_filepath
+from .mesh_utils import load_trimesh, mesh_cache, read_h5_array, write_mesh_h5
+from .synthetic_utils import (sample_sizes, synthetic_meshwork,
+                              synthetic_skeleton, write_synthetic_mesh)
+
+logger = logging.getLogger(__name__)
+
+# HDF5 storage modes compared by benchmark_mesh_storage, as kwargs of write_mesh_h5
+mesh_storage_modes = {
+    'hdf5': {},
+    'hdf5_gzip': {'compression': 'gzip', 'compression_opts': 4},
+    'hdf5_lzf': {'compression': 'lzf'},
+    'hdf5_quantized_gzip': {'vertex_decimals': 0, 'compression': 'gzip', 'compression_opts': 4},
+}
+
+
+def _timeit(func, n_repeats):
+    """
+    :returns: result of the last call and the min wall time in seconds over n_repeats calls
+    """
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def _write_draco(filepath, vertices, faces, quantization_bits=16, compression_level=7):
+    import DracoPy
+    with open(filepath, 'wb') as f:
+        f.write(DracoPy.encode(vertices, faces.reshape(-1, 3), quantization_bits=quantization_bits, compression_level=compression_level))
+
+
+def _load_draco(filepath):
+    import DracoPy
+    import trimesh
+    with open(filepath, 'rb') as f:
+        mesh = DracoPy.decode(f.read())
+    return trimesh.Trimesh(vertices=mesh.points, faces=mesh.faces, process=False)
+
+
+def benchmark_mesh_storage(filepaths, modes=None, include_draco=True, n_repeats=3, tmp_dir=None):
+    """
+    Compares storage modes of meshes by bytes on disk, write time and load time.
+
+    HDF5 modes are loaded into a trimesh.Trimesh as by TrimeshAdapter, with the mesh cache disabled.
+        Draco is included if DracoPy is installed and loaded with DracoPy and trimesh.
+
+    :param filepaths: (list) paths to sample mesh .h5 files (as downloaded by meshparty)
+    :param modes: (dict) storage modes as kwargs of write_mesh_h5. Defaults to mesh_storage_modes.
+    :param include_draco: (bool) also benchmark Draco files
+    :param n_repeats: (int) number of repeats of each write and load. The min time is reported.
+    :param tmp_dir: (str) directory for the written files. Defaults to a temporary directory.
+
+    :returns: pandas.DataFrame with one row per mesh and mode, with columns:
+        mesh, mode, n_vertices, n_faces, bytes, compression_ratio, write_s, load_s, max_vertex_error
+    """
+    modes = mesh_storage_modes if modes is None else modes
+    writers = {name: (lambda fp, v, f, kw=kw: write_mesh_h5(fp, v, f, **kw), lambda fp: load_trimesh(fp, cache=None), '.h5') for name, kw in modes.items()}
+    if include_draco:
+        try:
+            import DracoPy
+            writers['draco'] = (_write_draco, _load_draco, '.drc')
+        except ImportError:
+            logger.warning('DracoPy is not installed, skipping draco.')
+
+    rows = []
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as d:
+        for filepath in filepaths:
+            with h5py.File(filepath, 'r') as f:
+                vertices, faces = f['vertices'][()], f['faces'][()].ravel()
+            original_bytes = os.path.getsize(filepath)
+            for name, (write, load, suffix) in writers.items():
+                out = Path(d) / f'{Path(filepath).stem}_{name}{suffix}'
+                _, write_s = _timeit(lambda: write(out, vertices, faces), n_repeats)
+                _, load_s = _timeit(lambda: load(out), n_repeats)
+                rows.append({
+                    'mesh': Path(filepath).name,
+                    'mode': name,
+                    'n_vertices': len(vertices),
+                    'n_faces': len(faces) // 3,
+                    'bytes': os.path.getsize(out),
+                    'compression_ratio': original_bytes / os.path.getsize(out),
+                    'write_s': write_s,
+                    'load_s': load_s,
+                    # draco reorders vertices, so the error is only computed for the hdf5 modes
+                    'max_vertex_error': float(np.abs(read_h5_array(out, 'vertices') - vertices).max()) if suffix == '.h5' else np.nan,
+                })
+                out.unlink()
+    return pd.DataFrame(rows)
+
+
+def summarize(df, by='mode'):
+    """
+    :returns: pandas.DataFrame with the total bytes and times and the median compression ratio of each group
+    """
+    return df.groupby(by).agg(
+        bytes=('bytes', 'sum'),
+        compression_ratio=('compression_ratio', 'median'),
+        write_s=('write_s', 'sum'),
+        load_s=('load_s', 'sum'),
+    )
+
+
+def _parse_importtime(stderr):
+    """
+    :returns: pandas.DataFrame of the lines of python -X importtime, with columns module, depth, self_s and cumulative_s
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append({
+            'module': name.strip(),
+            'depth': (len(name) - len(name.lstrip()) - 1) // 2,
+            'self_s': int(self_us) / 1e6,
+            'cumulative_s': int(cumulative_us) / 1e6,
+        })
+    return pd.DataFrame(rows, columns=['module', 'depth', 'self_s', 'cumulative_s'])
+
+
+def benchmark_import_time(module, n_repeats=3, python=sys.executable, env=None):
+    """
+    Measures the import time of a module, each time in a fresh interpreter with python -X importtime.
+
+    Modules imported by the interpreter at startup (site, encodings, ...) are not counted.
+
+    :param module: (str) name of the module, e.g. "microns_materialization_api.schemas.minnie65_materialization"
+    :param n_repeats: (int) number of interpreters started. The fastest run is reported.
+    :param python: (str) path to the python executable
+    :param env: (dict) environment of the interpreters. Defaults to the current environment.
+
+    :returns: wall time of the import in seconds and pandas.DataFrame of the modules imported by the fastest run,
+        sorted by self_s (see _parse_importtime)
+    """
+    code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+    best = None
+    for _ in range(n_repeats):
+        result = subprocess.run([python, '-X', 'importtime', '-c', code], capture_output=True, text=True, env=env)
+        if result.returncode != 0:
+            raise RuntimeError(f'Importing {module} failed:\n{result.stderr[-2000:]}')
+        import_s = float(result.stdout.strip().splitlines()[-1])
+        if best is None or import_s < best[0]:
+            best = import_s, result.stderr
+    import_s, stderr = best
+    df = _parse_importtime(stderr)
+    # the interpreter's own startup imports come first, before any module imported by the -c code
+    first = df.index[df['module'].eq(module.split('.')[0])]
+    df = df.loc[first[0]:] if len(first) else df
+    return import_s, df.sort_values('self_s', ascending=False).reset_index(drop=True)
+
+
+def rss_bytes():
+    """
+    :returns: (int) resident memory of the process in bytes. Where /proc is not available, the peak of the process.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # ru_maxrss is in KB on linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class PeakRSS(threading.Thread):
+    """
+    Samples the resident memory of the process every interval seconds within a with block, and keeps the peak.
+    """
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.start_bytes = self.peak_bytes = rss_bytes()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_bytes = max(self.peak_bytes, rss_bytes())
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop_event.set()
+        self.join()
+        self.peak_bytes = max(self.peak_bytes, rss_bytes())
+
+
+def _write_mesh(filepath, rng, scale, compression=None):
+    write_synthetic_mesh(filepath, sample_sizes('mesh_vertices', 1, scale=scale, rng=rng)[0], rng=rng, compression=compression)
+
+
+def _write_meshwork(filepath, rng, scale, compression=None):
+    n_vertices = sample_sizes('skeleton_vertices', 1, scale=scale, rng=rng)[0]
+    pre_syn, post_syn = [
+        pd.DataFrame({'id': np.arange(n), 'size': rng.integers(100, 50_000, n), 'ctr_pt_position': [np.zeros(3)] * n})
+        for n in (sample_sizes(name, 1, scale=scale, rng=rng)[0] for name in ('presyn', 'postsyn'))
+    ]
+    synthetic_meshwork(0, n_vertices, pre_syn=pre_syn, post_syn=post_syn, rng=rng).save_meshwork(filepath, overwrite=True)
+
+
+def _write_pcg_skeleton(filepath, rng, scale, compression=None):
+    n_vertices, n_mesh_vertices = [sample_sizes(name, 1, scale=scale, rng=rng)[0] for name in ('skeleton_vertices', 'level2_vertices')]
+    synthetic_skeleton(n_vertices, n_mesh_vertices=n_mesh_vertices, rng=rng)[0].write_to_h5(filepath)
+
+
+def _write_axon_dendrite_skeleton(filepath, rng, scale, compression=None):
+    # the axon or the dendrite of a skeleton, as written by MakeMethod.MeshworkAxonDendriteSkeleton
+    skeleton, _ = synthetic_skeleton(sample_sizes('skeleton_vertices', 1, scale=scale / 2, rng=rng)[0], rng=rng)
+    np.savez(filepath, vertices=skeleton.vertices, edges=skeleton.edges)
+
+
+def _touch_npz(npz):
+    # np.load returns a lazy NpzFile for .npz files
+    return {name: npz[name] for name in npz.files} if hasattr(npz, 'files') else npz
+
+
+# adapters of the minnie65 stores benchmarked by benchmark_adapter_io, as (writer of a synthetic file, file suffix,
+#   function reading all data of the object returned by the adapter, or None if the adapter reads the whole file)
+adapter_io_stores = {
+    'minnie65_meshes': (_write_mesh, '.h5', None),
+    'minnie65_meshwork': (_write_meshwork, '.h5', None),
+    'minnie65_pcg_skeletons': (_write_pcg_skeleton, '.h5', None),
+    'minnie65_meshwork_axon_dendrite_skeletons': (_write_axon_dendrite_skeleton, '.npz', _touch_npz),
+}
+
+
+def write_synthetic_files(store, n_files, data_dir, scale=1., seed=0, compression=None):
+    """
+    Writes synthetic files of a store of adapter_io_stores, with sizes drawn from utils.synthetic_utils.size_distributions.
+
+    :param store: (str) key of adapter_io_stores
+    :param n_files: (int) number of files
+    :param data_dir: (str or pathlib.Path) directory of the files, created if needed
+    :param scale: (float) multiplies the median sizes
+    :param seed: (int) seed of the sizes and contents
+    :param compression: (str) HDF5 compression of mesh files (e.g. "gzip"), to compare storage choices. Ignored by other stores.
+
+    :returns: list of pathlib.Path of the files
+    """
+    write, suffix, _ = adapter_io_stores[store]
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    filepaths = []
+    for i in range(n_files):
+        filepath = data_dir / f'{store}_{i}{suffix}'
+        write(filepath, rng, scale, compression=compression)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def evict_from_page_cache(filepaths):
+    """
+    Asks the kernel to drop the cached pages of files, so the next read goes to the disk or the network filesystem.
+        Dirty pages are flushed first, since only clean pages can be dropped.
+
+    :returns: (bool) True if the files were evicted, False if posix_fadvise is not available (e.g. on macOS)
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return False
+    for filepath in filepaths:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    return True
+
+
+def _timed_get(adapter, touch, filepath):
+    start = time.perf_counter()
+    obj = adapter.get(cached_filepath(filepath))
+    if touch is not None:
+        touch(obj)
+    return time.perf_counter() - start
+
+
+def _read_files(adapter, touch, filepaths, n_threads):
+    """
+    :returns: per file latencies in seconds, in the order of filepaths, and the wall time of all reads
+    """
+    start = time.perf_counter()
+    if n_threads == 1:
+        latencies = [_timed_get(adapter, touch, filepath) for filepath in filepaths]
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            latencies = list(executor.map(lambda filepath: _timed_get(adapter, touch, filepath), filepaths))
+    return np.array(latencies), time.perf_counter() - start
+
+
+def benchmark_adapter_io(stores=None, n_files=20, scale=1., n_threads=(1, 8), data_dir=None, seed=0, mesh_compression=None):
+    """
+    Measures the read latency, throughput and peak RSS of the adapters of the minnie65 stores on synthetic files.
+
+    For each store, n_files synthetic files are written, then read through the adapter of the store
+        (config.adapters.minnie65_materialization) once per thread count, twice:
+        cold: after evicting the files from the page cache (see evict_from_page_cache) and clearing the mesh cache
+        warm: right after the cold read, so the page cache and the mesh cache hold the files
+    Objects are read completely, including the arrays that NpzFile would read lazily.
+        Files are read through the local file cache if MICRONS_LOCAL_CACHE_DIR is set, as by utils.filepath_utils.bulk_fetch.
+
+    :param stores: (list) keys of adapter_io_stores. Defaults to all.
+    :param n_files: (int) number of files per store
+    :param scale, seed: see write_synthetic_files
+    :param n_threads: (list) numbers of threads reading files concurrently. 1 reads serially.
+    :param data_dir: (str or pathlib.Path) directory of the files, e.g. on the filesystem of the stores.
+        Defaults to a temporary directory, removed afterwards.
+    :param mesh_compression: (str) HDF5 compression of the mesh files, see write_synthetic_files
+
+    :returns: pandas.DataFrame with one row per store, thread count and cache state, with columns:
+        store, adapter, cache ("cold" or "warm"), evicted, n_threads, n_files, bytes, seconds, files_per_s, bytes_per_s,
+        latency_mean_s, latency_p50_s, latency_p90_s, latency_p99_s, latency_max_s, peak_rss_bytes, rss_increase_bytes
+    """
+    from ..config import adapters
+    stores = list(adapter_io_stores) if stores is None else stores
+    rows = []
+    with tempfile.TemporaryDirectory() as d:
+        data_dir = Path(d if data_dir is None else data_dir)
+        for store in stores:
+            adapter = adapters.minnie65_materialization[store]
+            _, _, touch = adapter_io_stores[store]
+            start = time.perf_counter()
+            filepaths = write_synthetic_files(store, n_files, data_dir / store, scale=scale, seed=seed, compression=mesh_compression)
+            n_bytes = sum(os.path.getsize(filepath) for filepath in filepaths)
+            logger.info(f'Wrote {n_files} {store} files ({n_bytes / 1024**2:.1f} MiB) in {time.perf_counter() - start:.1f} s.')
+            for threads in n_threads:
+                for cache in ('cold', 'warm'):
+                    evicted = False
+                    if cache == 'cold':
+                        evicted = evict_from_page_cache(filepaths)
+                        mesh_cache.clear()
+                    with PeakRSS() as rss:
+                        latencies, seconds = _read_files(adapter, touch, filepaths, threads)
+                    rows.append({
+                        'store': store,
+                        'adapter': type(adapter).__name__,
+                        'cache': cache,
+                        'evicted': evicted,
+                        'n_threads': threads,
+                        'n_files': n_files,
+                        'bytes': n_bytes,
+                        'seconds': seconds,
+                        'files_per_s': n_files / seconds,
+                        'bytes_per_s': n_bytes / seconds,
+                        'latency_mean_s': latencies.mean(),
+                        'latency_p50_s': np.percentile(latencies, 50),
+                        'latency_p90_s': np.percentile(latencies, 90),
+                        'latency_p99_s': np.percentile(latencies, 99),
+                        'latency_max_s': latencies.max(),
+                        'peak_rss_bytes': rss.peak_bytes,
+                        'rss_increase_bytes': rss.peak_bytes - rss.start_bytes,
+                    })
+                    logger.info(f'{store} {cache} with {threads} threads: {n_files / seconds:.1f} files/s, {n_bytes / seconds / 1024**2:.1f} MiB/s, p50 {rows[-1]["latency_p50_s"] * 1e3:.1f} ms.')
+    return pd.DataFrame(rows)
+
+
+def adapter_io_report(df, params=None):
+    """
+    :returns: dict for the JSON output of benchmark_adapter_io, with the host, python version, timestamp, params and results
+    """
+    return {
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'params': params or {},
+        'results': json.loads(df.to_json(orient='records')),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    mesh_storage = subparsers.add_parser('mesh_storage', help='compare mesh storage modes')
+    mesh_storage.add_argument('filepaths', nargs='+', help='sample mesh .h5 files')
+    mesh_storage.add_argument('--n-repeats', type=int, default=3)
+    mesh_storage.add_argument('--no-draco', action='store_true')
+    mesh_storage.add_argument('--output', help='path of a .csv file for the per mesh results')
+
+    import_time = subparsers.add_parser('import_time', help='measure the import time of modules in fresh interpreters')
+    import_time.add_argument('modules', nargs='+', help='module names')
+    import_time.add_argument('--n-repeats', type=int, default=3)
+    import_time.add_argument('--top', type=int, default=15, help='number of slowest modules printed')
+    import_time.add_argument('--budget', type=float, help='exit with status 1 if any import takes longer, in seconds')
+
+    adapter_io = subparsers.add_parser('adapter_io', help='measure read latency, throughput and peak RSS of the store adapters on synthetic files')
+    adapter_io.add_argument('--stores', nargs='+', choices=list(adapter_io_stores), help='stores to benchmark. Defaults to all.')
+    adapter_io.add_argument('--n-files', type=int, default=20, help='number of files per store')
+    adapter_io.add_argument('--scale', type=float, default=1., help='multiplies the median file sizes')
+    adapter_io.add_argument('--threads', type=int, nargs='+', default=[1, 8], help='numbers of reading threads')
+    adapter_io.add_argument('--data-dir', help='directory of the synthetic files. Defaults to a temporary directory.')
+    adapter_io.add_argument('--seed', type=int, default=0)
+    adapter_io.add_argument('--mesh-compression', choices=['gzip', 'lzf'])
+    adapter_io.add_argument('--output', help='path of a .json file for the results')
+
+    args = parser.parse_args()
+    if args.benchmark == 'mesh_storage':
+        df = benchmark_mesh_storage(args.filepaths, include_draco=not args.no_draco, n_repeats=args.n_repeats)
+        if args.output is not None:
+            df.to_csv(args.output, index=False)
+        print(summarize(df).to_string())
+    elif args.benchmark == 'import_time':
+        over_budget = []
+        for module in args.modules:
+            import_s, df = benchmark_import_time(module, n_repeats=args.n_repeats)
+            print(f'{module}: {import_s:.3f} s')
+            print(df.head(args.top).to_string(index=False))
+            if args.budget is not None and import_s > args.budget:
+                over_budget.append(module)
+        if over_budget:
+            print(f'Over the budget of {args.budget} s: {", ".join(over_budget)}')
+            sys.exit(1)
+    elif args.benchmark == 'adapter_io':
+        params = {'stores': args.stores, 'n_files': args.n_files, 'scale': args.scale, 'n_threads': args.threads, 'data_dir': args.data_dir, 'seed': args.seed, 'mesh_compression': args.mesh_compression}
+        df = benchmark_adapter_io(stores=args.stores, n_files=args.n_files, scale=args.scale, n_threads=args.threads, data_dir=args.data_dir, seed=args.seed, mesh_compression=args.mesh_compression)
+        if args.output is not None:
+            Path(args.output).write_text(json.dumps(adapter_io_report(df, params), indent=2))
+        print(df[['store', 'cache', 'n_threads', 'files_per_s', 'bytes_per_s', 'latency_p50_s', 'latency_p99_s', 'peak_rss_bytes']].to_string(index=False))
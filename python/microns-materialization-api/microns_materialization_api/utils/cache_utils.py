@@ -0,0 +1,375 @@
+"""
+Utils for caching query results and files on local disk and objects in memory.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from .filepath_utils import bulk_load
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCache:
+    """
+    Read-through, size-bounded LRU cache of DataJoint query results on local disk.
+
+    Entries are keyed by a hash of the query SQL, the fetch arguments and a caller-provided stamp.
+        Frames are stored as Parquet and arrays as NumPy .npy files. When the stamp changes
+        (e.g. because the source tables gained rows) the old entries are no longer hit and are
+        evicted once the cache exceeds max_bytes.
+    """
+    suffixes = {'frame': '.parquet', 'array': '.npy'}
+
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3):
+        """
+        :param cache_dir: (str or pathlib.Path) directory of the cache
+        :param max_bytes: (int) max total size of the cache before least recently used entries are evicted
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, rel, stamp=None, **fetch_kwargs):
+        """
+        :returns: (str) hash identifying the result of fetching rel with fetch_kwargs under stamp
+        """
+        key = json.dumps({'sql': rel.make_sql(), 'stamp': stamp, 'fetch_kwargs': fetch_kwargs}, sort_keys=True, default=str)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def fetch(self, rel, stamp=None, format='frame', **fetch_kwargs):
+        """
+        Fetches rel from the cache, or from the database on a miss and stores the result.
+
+        :param rel: DataJoint table or query expression
+        :param stamp: JSON serializable value that changes whenever the result of rel could change
+        :param format: (str) "frame" for a pandas.DataFrame or "array" for a numpy record array
+        :param fetch_kwargs: passed to fetch (e.g. order_by, limit)
+        """
+        assert format in self.suffixes, f'format must be one of {list(self.suffixes)}'
+        filepath = self.cache_dir / f'{self.make_key(rel, stamp=stamp, format=format, **fetch_kwargs)}{self.suffixes[format]}'
+
+        try:
+            result = self._read(filepath, format)
+            os.utime(filepath)
+            self.hits += 1
+            return result
+        except FileNotFoundError:
+            self.misses += 1
+
+        result = rel.fetch(format=format, **fetch_kwargs)
+        self._write(filepath, result, format)
+        self.evict()
+        return result
+
+    @staticmethod
+    def _read(filepath, format):
+        if format == 'frame':
+            import pyarrow.parquet as pq
+            table = pq.read_table(filepath)
+            index_names = json.loads(table.schema.metadata[b'index_names'])
+            df = table.to_pandas()
+            return df.set_index(index_names) if index_names else df
+        return np.load(filepath, allow_pickle=True)
+
+    def _write(self, filepath, result, format):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # write under a unique temporary name so concurrent writers and readers never see partial files
+        tmp_filepath = filepath.with_name(f'.{uuid.uuid4().hex}.tmp')
+        try:
+            if format == 'frame':
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                # DataJoint frames are indexed by primary key and may have no other columns, so the index is stored as columns
+                index_names = [name for name in result.index.names if name is not None]
+                table = pa.Table.from_pandas(result.reset_index() if index_names else result, preserve_index=False)
+                table = table.replace_schema_metadata({**table.schema.metadata, b'index_names': json.dumps(index_names).encode()})
+                pq.write_table(table, tmp_filepath)
+            else:
+                with open(tmp_filepath, 'wb') as f:
+                    np.save(f, result, allow_pickle=True)
+            os.replace(tmp_filepath, filepath)
+        except Exception as e:
+            tmp_filepath.unlink(missing_ok=True)
+            logger.warning(f'Could not cache query result: {e}')
+
+    def entries(self):
+        """
+        :returns: list of (filepath, size, last access time) of the cache entries, least recently used first
+        """
+        entries = []
+        for suffix in self.suffixes.values():
+            for filepath in self.cache_dir.glob(f'*{suffix}'):
+                try:
+                    stat = filepath.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((filepath, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None):
+        """
+        Removes least recently used entries until the cache fits in max_bytes.
+
+        :param max_bytes: (int) defaults to self.max_bytes
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for filepath, size, _ in entries:
+            if total <= max_bytes:
+                break
+            filepath.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        self.evict(max_bytes=0)
+
+
+class LRUCache:
+    """
+    Thread-safe, in-memory LRU cache bounded by the total bytes of its values.
+    """
+    def __init__(self, max_bytes=2 * 1024**3):
+        """
+        :param max_bytes: (int) max total bytes of the values before least recently used values are evicted
+        """
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes):
+        """
+        Adds a value. Values larger than max_bytes are not cached.
+
+        :param nbytes: (int) size of the value in bytes
+        """
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self._size += nbytes
+            while self._size > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self._size -= evicted_nbytes
+
+    def get_or_load(self, key, loader, nbytes=None):
+        """
+        Gets a value, or loads and adds it on a miss.
+
+        :param loader: callable that returns the value
+        :param nbytes: callable that returns the size of the value in bytes. Defaults to value.nbytes.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = loader()
+            self.put(key, value, nbytes(value) if nbytes is not None else value.nbytes)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class FileCache:
+    """
+    Read-through, size-bounded LRU cache of files from network storage on a local disk.
+
+    A cached copy is named by a hash of the source path and the size and mtime of the source, so a changed source
+        is copied again. The source is checked with one stat per access. Copies are written under a temporary name
+        and renamed into place, and each shard directory has a lock file, so processes on one node can share the cache
+        without copying a file twice or reading partial copies. Entries are evicted by last access (mtime).
+        Files accessed within the last min_age seconds are not evicted, so a path returned by get stays valid
+        while the caller opens it, even if another process evicts at the same time.
+    """
+    def __init__(self, cache_dir, max_bytes=100 * 1024**3, min_age=600):
+        """
+        :param cache_dir: (str or pathlib.Path) directory of the cache, on a local disk
+        :param max_bytes: (int) max total size of the cache before least recently used files are evicted
+        :param min_age: (float) seconds after its last access before a file can be evicted.
+            The cache can exceed max_bytes by the files accessed within min_age.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = int(max_bytes)
+        self.min_age = min_age
+        self.hits = 0
+        self.misses = 0
+        self.bytes_copied = 0
+        self.n_evicted = 0
+        self._size = None
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({str(self.cache_dir)!r}, max_bytes={self.max_bytes})'
+
+    def cached_filepath(self, filepath, stat=None):
+        """
+        :returns: pathlib.Path of the cached copy of the current version of filepath, which may not exist
+        """
+        filepath = Path(filepath)
+        stat = filepath.stat() if stat is None else stat
+        key = hashlib.sha256(str(filepath.absolute()).encode()).hexdigest()[:32]
+        return self.cache_dir / key[:2] / f'{key}_{stat.st_size}_{stat.st_mtime_ns}{filepath.suffix}'
+
+    def get(self, filepath):
+        """
+        Returns the path of the cached copy of a file, copying the file into the cache on a miss.
+
+        :param filepath: (str or pathlib.Path) path to the source file
+
+        :returns: pathlib.Path of the cached copy
+        """
+        stat = os.stat(filepath)
+        cached = self.cached_filepath(filepath, stat)
+        try:
+            os.utime(cached)
+            with self._lock:
+                self.hits += 1
+            return cached
+        except FileNotFoundError:
+            pass
+
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        with open(cached.parent / '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another process may have copied the file while this one waited for the lock
+            if not cached.exists():
+                tmp_filepath = cached.with_name(f'.{uuid.uuid4().hex}.tmp')
+                try:
+                    shutil.copyfile(filepath, tmp_filepath)
+                    os.replace(tmp_filepath, cached)
+                finally:
+                    tmp_filepath.unlink(missing_ok=True)
+                with self._lock:
+                    self.misses += 1
+                    self.bytes_copied += stat.st_size
+                    self._added += stat.st_size
+            else:
+                with self._lock:
+                    self.hits += 1
+        # other processes add files too, so the size is rescanned after this process added 5% of max_bytes
+        if self._size is None or self._size + self._added > self.max_bytes or self._added > self.max_bytes / 20:
+            self.evict()
+        return cached
+
+    def entries(self):
+        """
+        :returns: list of (filepath, size, last access time) of the cached files, least recently used first
+        """
+        entries = []
+        for filepath in self.cache_dir.glob('*/*_*'):
+            try:
+                stat = filepath.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((filepath, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, max_bytes=None, min_age=None):
+        """
+        Removes least recently used files until the cache fits in max_bytes. Skipped if another process is evicting.
+            Files accessed within min_age seconds are kept. Processes that have a removed file open keep reading it.
+
+        :param max_bytes: (int) defaults to self.max_bytes
+        :param min_age: (float) defaults to self.min_age
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        min_age = self.min_age if min_age is None else min_age
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_dir / '.evict.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            cutoff = time.time() - min_age
+            for filepath, size, last_access in entries:
+                if total <= max_bytes or last_access > cutoff:
+                    break
+                filepath.unlink(missing_ok=True)
+                total -= size
+                with self._lock:
+                    self.n_evicted += 1
+            with self._lock:
+                self._size = total
+                self._added = 0
+
+    def clear(self):
+        self.evict(max_bytes=0, min_age=0)
+
+    def stats(self):
+        """
+        :returns: dict with the hits, misses, bytes copied and files evicted by this process
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes_copied': self.bytes_copied, 'n_evicted': self.n_evicted}
+
+    def prefetch(self, filepaths, n_workers=16):
+        """
+        Copies files into the cache with a thread pool.
+
+        :param filepaths: (list) paths to the source files
+        :param n_workers: (int) number of threads
+
+        :returns: dict of stats, as stats
+        """
+        for _ in bulk_load(filepaths, self.get, n_workers=n_workers, raise_errors=False):
+            pass
+        return self.stats()
+
+
+local_file_cache = FileCache(os.environ['MICRONS_LOCAL_CACHE_DIR'], max_bytes=float(os.getenv('MICRONS_LOCAL_CACHE_MAX_BYTES', 100 * 1024**3)), min_age=float(os.getenv('MICRONS_LOCAL_CACHE_MIN_AGE', 600))) if os.getenv('MICRONS_LOCAL_CACHE_DIR') else None
+
+
+def cached_filepath(filepath):
+    """
+    :returns: the path of the local copy of filepath if MICRONS_LOCAL_CACHE_DIR is set, else filepath
+    """
+    return filepath if local_file_cache is None else local_file_cache.get(filepath)
@@ -0,0 +1,145 @@
+"""
+Utils for building and loading sparse connectivity matrices.
+"""
+import struct
+import zipfile
+
+import numpy as np
+
+
+def build_connectome(pre_seg_ids, post_seg_ids, counts, sizes):
+    """
+    Builds sparse connectivity matrices between segments from edge lists.
+
+    Duplicate (pre, post) pairs are summed, so one edge per synapse or partial aggregates of several chunks can be passed.
+
+    :param pre_seg_ids: (array-like) presynaptic segment id of each edge
+    :param post_seg_ids: (array-like) postsynaptic segment id of each edge
+    :param counts: (array-like) number of synapses of each edge
+    :param sizes: (array-like) summed synapse_size of each edge
+
+    :returns: dict of arrays with keys:
+        segment_ids: sorted segment ids. The index of a segment id is the row and column of the segment in the matrices.
+        indptr, indices, counts, sizes: CSR matrices of synapse counts and summed synapse sizes (rows: pre, columns: post)
+        csc_indptr, csc_indices, csc_counts, csc_sizes: the same matrices in CSC format
+    """
+    pre_seg_ids = np.asarray(pre_seg_ids, dtype=np.uint64)
+    post_seg_ids = np.asarray(post_seg_ids, dtype=np.uint64)
+    segment_ids = np.unique(np.concatenate([pre_seg_ids, post_seg_ids]))
+    n = len(segment_ids)
+
+    # sum duplicate edges, keyed by flat matrix index so the result is sorted by row, then column
+    flat_index, inverse = np.unique(np.searchsorted(segment_ids, pre_seg_ids) * n + np.searchsorted(segment_ids, post_seg_ids), return_inverse=True)
+    counts = np.bincount(inverse, weights=counts, minlength=len(flat_index)).astype(np.uint32)
+    sizes = np.bincount(inverse, weights=sizes, minlength=len(flat_index)).astype(np.uint64)
+    rows, cols = flat_index // n, flat_index % n
+
+    # CSC order: sorted by column, then row
+    order = np.lexsort((rows, cols))
+
+    return {
+        'segment_ids': segment_ids,
+        'indptr': np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n))]).astype(np.int64),
+        'indices': cols.astype(np.int64),
+        'counts': counts,
+        'sizes': sizes,
+        'csc_indptr': np.concatenate([[0], np.cumsum(np.bincount(cols, minlength=n))]).astype(np.int64),
+        'csc_indices': rows[order].astype(np.int64),
+        'csc_counts': counts[order],
+        'csc_sizes': sizes[order],
+    }
+
+
+def load_npz_mmap(filepath):
+    """
+    Memory maps the arrays of an uncompressed .npz file (as written by numpy.savez) without reading them.
+
+    :param filepath: (str or pathlib.Path) path to the .npz file
+
+    :returns: dict of read-only numpy.memmap arrays keyed by array name
+    """
+    arrays = {}
+    with zipfile.ZipFile(filepath) as zf, open(filepath, 'rb') as f:
+        for info in zf.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED, f'{info.filename} is compressed and cannot be memory mapped.'
+            # the data of a member starts after its local file header (30 bytes + file name + extra field)
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(filepath, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C', offset=f.tell())
+    return arrays
+
+
+class Connectome:
+    """
+    Sparse synapse count and synapse size matrices between segments, backed by memory-mapped arrays.
+
+    Rows are presynaptic and columns postsynaptic segments, in the order of segment_ids.
+    """
+    def __init__(self, arrays):
+        """
+        :param arrays: (dict) arrays as returned by build_connectome or load_npz_mmap
+        """
+        self.arrays = arrays
+        self.segment_ids = arrays['segment_ids']
+        self.shape = (len(self.segment_ids), len(self.segment_ids))
+
+    @classmethod
+    def load(cls, filepath):
+        return cls(load_npz_mmap(filepath))
+
+    @staticmethod
+    def save(filepath, arrays):
+        np.savez(filepath, **arrays)
+
+    def _csr(self, name):
+        from scipy import sparse
+        return sparse.csr_matrix((self.arrays[name], self.arrays['indices'], self.arrays['indptr']), shape=self.shape, copy=False)
+
+    def _csc(self, name):
+        from scipy import sparse
+        return sparse.csc_matrix((self.arrays[f'csc_{name}'], self.arrays['csc_indices'], self.arrays['csc_indptr']), shape=self.shape, copy=False)
+
+    @property
+    def counts(self):
+        """
+        :returns: scipy.sparse.csr_matrix of synapse counts
+        """
+        return self._csr('counts')
+
+    @property
+    def sizes(self):
+        """
+        :returns: scipy.sparse.csr_matrix of summed synapse sizes
+        """
+        return self._csr('sizes')
+
+    @property
+    def counts_csc(self):
+        return self._csc('counts')
+
+    @property
+    def sizes_csc(self):
+        return self._csc('sizes')
+
+    def index(self, segment_ids):
+        """
+        Maps segment ids to matrix indices.
+
+        :param segment_ids: (array-like) segment ids
+
+        :returns: numpy array of indices, -1 where the segment id has no synapses in the connectome
+        """
+        segment_ids = np.asarray(segment_ids, dtype=np.uint64)
+        idx = np.searchsorted(self.segment_ids, segment_ids)
+        idx[idx == len(self.segment_ids)] = 0
+        return np.where(self.segment_ids[idx] == segment_ids, idx, -1) if len(self.segment_ids) else np.full(len(segment_ids), -1)
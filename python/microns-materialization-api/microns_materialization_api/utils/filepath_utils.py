@@ -0,0 +1,301 @@
+"""
+Utils for working with filepath attributes of DataJoint tables.
+"""
+import hashlib
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# sharded layout of external stores: <store>/<2 hex chars>/<2 hex chars>/<filename>, 65,536 directories
+shard_depth = 2
+shard_width = 2
+
+
+def fetch_filepaths(rel, *attrs, **fetch_kwargs):
+    """
+    Fetches rows of a table with the stored paths of its filepath attributes, without opening any files.
+
+    DataJoint resolves filepath attributes one row at a time and checksums each file before passing it
+        to the adapter. Here each attribute is instead joined to the external table of its store, so all
+        paths come back from a single query.
+
+    :param rel: DataJoint table or query expression
+    :param attrs: (str) names of the filepath attributes to resolve
+    :param fetch_kwargs: passed to fetch (e.g. order_by, limit)
+
+    :returns: pandas.DataFrame with the primary key and secondary attributes of rel,
+        where each column in attrs contains the absolute filepath as a str.
+        Other external attributes of rel are dropped.
+    """
+    stages = {}
+    for attr in attrs:
+        attribute = rel.heading.attributes[attr]
+        assert attribute.is_filepath, f'{attr} is not a filepath attribute.'
+        external = rel.connection.schemas[attribute.database].external[attribute.store]
+        stages[attr] = Path(external.spec['stage']).absolute()
+        alias = f'{attr}_hash'
+        rel = rel.proj(..., **{alias: attr}) * external.proj(**{alias: 'hash', attr: 'filepath'})
+
+    names = [name for name in rel.heading.secondary_attributes if not rel.heading.attributes[name].is_external]
+    df = rel.proj(*names).fetch(format='frame', **fetch_kwargs).reset_index()
+    for attr, stage in stages.items():
+        df[attr] = [str(stage / filepath) for filepath in df[attr]]
+    return df
+
+
+class Throughput:
+    """
+    Counts files and bytes loaded and reports the rate.
+    """
+    def __init__(self):
+        self.n_files = 0
+        self.n_bytes = 0
+        self.n_errors = 0
+        self.start = time.perf_counter()
+
+    def update(self, n_bytes):
+        self.n_files += 1
+        self.n_bytes += n_bytes
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    @property
+    def files_per_s(self):
+        return self.n_files / self.elapsed
+
+    @property
+    def bytes_per_s(self):
+        return self.n_bytes / self.elapsed
+
+    def __str__(self):
+        return f'{self.n_files} files ({self.n_errors} errors), {self.n_bytes / 1024**2:.1f} MiB in {self.elapsed:.1f} s: {self.files_per_s:.1f} files/s, {self.bytes_per_s / 1024**2:.1f} MiB/s'
+
+
+def bulk_load(items, loader, n_workers=16, max_in_flight=None, raise_errors=True, throughput=None, report_every=1000, nbytes=os.path.getsize):
+    """
+    Loads many files with a thread pool and yields the results in the order of items.
+
+    At most max_in_flight files are loaded ahead of the consumer, so memory stays bounded for large queries.
+
+    :param items: (iterable) paths to the files, or any items accepted by loader and nbytes
+    :param loader: callable that loads one item, e.g. the get method of an adapter
+    :param n_workers: (int) number of threads. Opening files on a network filesystem is latency bound,
+        so more threads than CPUs usually help.
+    :param max_in_flight: (int) max number of items loaded ahead of the consumer. Defaults to 4 * n_workers.
+    :param raise_errors: (bool) if False, logs errors and yields None for items that could not be loaded
+    :param throughput: (Throughput) updated with each loaded item, to read the rate during or after the load
+    :param report_every: (int) logs the throughput every report_every items. If None, only at the end.
+    :param nbytes: callable that returns the bytes read for an item, for the throughput
+
+    :yields: the result of loader for each item
+    """
+    max_in_flight = 4 * n_workers if max_in_flight is None else max_in_flight
+    throughput = Throughput() if throughput is None else throughput
+
+    def load(item):
+        return loader(item), nbytes(item)
+
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=n_workers)
+    futures = deque()
+    try:
+        futures.extend((item, executor.submit(load, item)) for item in islice(items, max_in_flight))
+        while futures:
+            item, future = futures.popleft()
+            futures.extend((next_item, executor.submit(load, next_item)) for next_item in islice(items, 1))
+            try:
+                result, n_bytes = future.result()
+                throughput.update(n_bytes)
+            except Exception as e:
+                if raise_errors:
+                    raise
+                throughput.n_errors += 1
+                logger.error(f'Could not load {item}: {e}')
+                result = None
+            if report_every is not None and throughput.n_files % report_every == 0 and throughput.n_files:
+                logger.info(str(throughput))
+            yield result
+    finally:
+        for _, future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+    logger.info(str(throughput))
+
+
+def bulk_fetch(rel, *attrs, n_workers=16, max_in_flight=None, raise_errors=True, throughput=None, report_every=1000, **fetch_kwargs):
+    """
+    Fetches adapter-backed filepath attributes (e.g. Mesh.Object.mesh, Skeleton.PCGSkeleton.skeleton_obj) of many rows,
+        opening the files with a thread pool.
+
+    Paths are resolved with fetch_filepaths in one query and each file is loaded with the adapter of its attribute,
+        so the objects are the same as from fetch. Files are read through the local file cache if MICRONS_LOCAL_CACHE_DIR is set
+        (see utils.cache_utils.cached_filepath); unlike fetch, the network file is not read to verify its checksum.
+
+    Example:
+        for row in bulk_fetch(Skeleton.PCGSkeleton & segments, 'skeleton_obj', n_workers=32):
+            row['skeleton_obj']
+
+    :param rel: DataJoint table or query expression
+    :param attrs: (str) names of the filepath attributes to load
+    :param n_workers, max_in_flight, raise_errors, throughput, report_every: see bulk_load
+    :param fetch_kwargs: passed to fetch (e.g. order_by, limit)
+
+    :yields: dict per row (as fetch(as_dict=True)) with the primary key and secondary attributes of rel,
+        where each attribute in attrs holds the loaded object (None if it could not be loaded and raise_errors is False).
+        Other external attributes are dropped.
+    """
+    from .cache_utils import cached_filepath  # cache_utils imports this module
+
+    adapters = {attr: rel.heading.attributes[attr].adapter for attr in attrs}
+    rows = fetch_filepaths(rel, *attrs, **fetch_kwargs).to_dict('records')
+
+    def load(row):
+        return {attr: row[attr] if adapter is None else adapter.get(cached_filepath(row[attr])) for attr, adapter in adapters.items()}
+
+    def nbytes(row):
+        return sum(os.path.getsize(row[attr]) for attr in attrs)
+
+    objects = bulk_load(rows, load, n_workers=n_workers, max_in_flight=max_in_flight, raise_errors=raise_errors, throughput=throughput, report_every=report_every, nbytes=nbytes)
+    for row, obj in zip(rows, objects):
+        yield {**row, **(dict.fromkeys(attrs) if obj is None else obj)}
+
+
+class BulkFetchMixin:
+    """
+    Adds a bulk_fetch classmethod to a table with adapter-backed filepath attributes, e.g.
+        class Object(BulkFetchMixin, djp.Part):
+            bulk_fetch_attrs = ('mesh',)
+    """
+    bulk_fetch_attrs = ()
+
+    @classmethod
+    def bulk_fetch(cls, restriction={}, n_workers=16, **kwargs):
+        """
+        Loads the attributes in bulk_fetch_attrs of many rows with a thread pool, in order, as a generator of row dicts.
+            See utils.filepath_utils.bulk_fetch for kwargs.
+        """
+        return bulk_fetch(cls & restriction, *cls.bulk_fetch_attrs, n_workers=n_workers, **kwargs)
+
+
+def pool_map(func, items, n_workers=None, chunksize=1, threads=False):
+    """
+    Applies func to many items in a process pool, or in the current process if n_workers is 1 or there is at most one item.
+
+    :param func: function of one item. Must be defined at module level unless threads is True.
+    :param items: (list) items
+    :param n_workers: (int) number of workers. Defaults to the number of CPUs.
+    :param chunksize: (int) number of items sent to a worker process at a time
+    :param threads: (bool) use a thread pool instead of a process pool
+
+    :returns: list of results in the order of items
+    """
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    if n_workers == 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    if threads:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            return list(executor.map(func, items))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(func, items, chunksize=chunksize))
+
+
+def shard_key(filename):
+    """
+    :returns: (str) the part of the file stem that determines the shard, i.e. without the "__<timestamp>"
+        appended by append_timestamp_to_filepath, so a file keeps its shard when it is timestamped
+    """
+    return Path(filename).stem.split('__')[0]
+
+
+def shard_dir(root, filename, depth=shard_depth, width=shard_width, mkdir=True):
+    """
+    Returns the directory of a file in the hashed-prefix sharded layout of a store, e.g.
+        shard_dir("/mnt/store", "864691135.h5") -> /mnt/store/3f/a9
+
+    Flat directories with millions of files make every create, lookup and listing slow on network filesystems.
+        Shards are chosen by a hash of shard_key(filename), so files spread evenly over depth levels of 16**width directories.
+
+    :param root: (str or pathlib.Path) root directory of the store
+    :param filename: (str) name of the file
+    :param mkdir: (bool) create the directory if it does not exist
+
+    :returns: pathlib.Path
+    """
+    digest = hashlib.md5(shard_key(filename).encode()).hexdigest()
+    directory = Path(root).joinpath(*(digest[i * width:(i + 1) * width] for i in range(depth)))
+    if mkdir:
+        directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+def _move_to_shard(args):
+    """
+    :returns: "moved", "already_moved" or "missing"
+    """
+    src, dst = args
+    if src.exists():
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(src, dst)
+        return 'moved'
+    return 'already_moved' if dst.exists() else 'missing'
+
+
+def migrate_to_sharded_layout(external, batch_size=10_000, n_workers=32, dry_run=False, limit=None):
+    """
+    Moves the files of a filepath store from the flat layout into the sharded layout (see shard_dir)
+        and rewrites their paths in the external table of the store, in batches.
+
+    Files are moved with a thread pool, then the paths of the moved batch are rewritten in one transaction.
+        Only rows whose path has no directory are migrated, so the migration can be stopped and rerun.
+        A file that was moved by an interrupted run, but whose path was not rewritten, is found at its new path and rewritten.
+
+    The hash of an external row stays that of the old relative path, which is how existing rows of the referencing tables
+        keep pointing to it. Readers that fetched an old path before its batch was rewritten will not find the file.
+
+    :param external: DataJoint external table of the store, e.g. schema.external["minnie65_meshes"]
+    :param batch_size: (int) number of files moved and rewritten per batch
+    :param n_workers: (int) number of threads moving files
+    :param dry_run: (bool) only log the number of files that would be moved
+    :param limit: (int) max number of files to migrate
+
+    :returns: dict with the number of moved, already moved and missing files
+    """
+    stage = Path(external.spec['stage']).absolute()
+    rel = external & 'filepath NOT LIKE "%%/%%"'
+    hashes, filepaths = rel.fetch('hash', 'filepath', limit=limit)
+    logger.info(f'{len(filepaths)} files of store {external.store} to migrate.')
+    counts = dict.fromkeys(('moved', 'already_moved', 'missing'), 0)
+    if dry_run:
+        return counts
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for start in range(0, len(filepaths), batch_size):
+            batch = list(zip(hashes[start:start + batch_size], filepaths[start:start + batch_size]))
+            new_filepaths = [str(shard_dir(Path(), filepath, mkdir=False) / filepath) for _, filepath in batch]
+            results = list(executor.map(_move_to_shard, [(stage / old, stage / new) for (_, old), new in zip(batch, new_filepaths)]))
+            updates = []
+            for (hash, old), new, result in zip(batch, new_filepaths, results):
+                counts[result] += 1
+                if result == 'missing':
+                    logger.warning(f'File {stage / old} not found, its path is not rewritten.')
+                else:
+                    updates.append((hash, new))
+            if updates:
+                with external.connection.transaction:
+                    external.connection.query(
+                        f'UPDATE {external.full_table_name} SET filepath = CASE hash {" ".join(["WHEN %s THEN %s"] * len(updates))} END '
+                        f'WHERE hash IN ({",".join(["%s"] * len(updates))})',
+                        args=[v for hash, new in updates for v in (hash.bytes, new)] + [hash.bytes for hash, _ in updates]
+                    )
+            logger.info(f'{min(start + batch_size, len(filepaths))}/{len(filepaths)} files of store {external.store} migrated ({sum(counts.values()) / (time.perf_counter() - start_time):.0f} files/s).')
+    logger.info(f'Migration of store {external.store} done: {counts}.')
+    return counts
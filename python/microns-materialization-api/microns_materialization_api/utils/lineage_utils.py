@@ -0,0 +1,99 @@
+"""
+Utils for looking up nucleus and segment ids across materialization versions.
+"""
+import numpy as np
+
+from .spatial_utils import _concatenate_ranges
+
+
+class NucleusLineage:
+    """
+    In-memory lookup of the segment of each nucleus in each materialization version, and the reverse.
+
+    Segment ids are held in a dense (nucleus, version) matrix, so lookups of many ids are a single
+        vectorized binary search.
+    """
+    flags = 'segment_changed', 'split', 'merge'
+
+    def __init__(self, df):
+        """
+        :param df: (pandas.DataFrame) rows of Nucleus.Lineage with at least ver, nucleus_id, segment_id and the flag columns
+        """
+        self.vers = np.array(sorted(df['ver'].unique()))
+        self.nucleus_ids = np.unique(df['nucleus_id'].values.astype(np.uint64))
+        rows = np.searchsorted(self.nucleus_ids, df['nucleus_id'].values.astype(np.uint64))
+        cols = np.searchsorted(self.vers, df['ver'].values)
+        segment_ids = df['segment_id'].values.astype(np.uint64)
+
+        self.segment_matrix = np.zeros((len(self.nucleus_ids), len(self.vers)), dtype=np.uint64)
+        self.segment_matrix[rows, cols] = segment_ids
+        self.flag_matrices = {}
+        for flag in self.flags:
+            matrix = np.zeros((len(self.nucleus_ids), len(self.vers)), dtype=bool)
+            matrix[rows, cols] = df[flag].values.astype(bool)
+            self.flag_matrices[flag] = matrix
+
+        # reverse lookup: rows sorted by version, then segment id
+        order = np.lexsort((segment_ids, cols))
+        self._rev_cols = cols[order]
+        self._rev_segment_ids = segment_ids[order]
+        self._rev_nucleus_ids = self.nucleus_ids[rows[order]]
+        self._rev_col_offsets = np.searchsorted(self._rev_cols, np.arange(len(self.vers) + 1))
+
+    def _rows(self, nucleus_ids):
+        nucleus_ids = np.asarray(nucleus_ids, dtype=np.uint64)
+        rows = np.searchsorted(self.nucleus_ids, nucleus_ids)
+        rows[rows == len(self.nucleus_ids)] = 0
+        found = self.nucleus_ids[rows] == nucleus_ids if len(self.nucleus_ids) else np.zeros(len(nucleus_ids), dtype=bool)
+        return rows, found
+
+    def _cols(self, vers):
+        if vers is None:
+            return np.arange(len(self.vers))
+        cols = np.searchsorted(self.vers, np.atleast_1d(vers))
+        assert np.all(cols < len(self.vers)) and np.all(self.vers[cols] == np.atleast_1d(vers)), 'Unknown materialization version.'
+        return cols
+
+    def segments(self, nucleus_ids, vers=None):
+        """
+        Looks up the segment of each nucleus in each version.
+
+        :param nucleus_ids: (array-like) nucleus ids
+        :param vers: (array-like) materialization versions. If None, all versions in self.vers.
+
+        :returns: numpy array (len(nucleus_ids), len(vers)) of segment ids, 0 where the nucleus is not in the version
+        """
+        rows, found = self._rows(nucleus_ids)
+        result = self.segment_matrix[np.ix_(rows, self._cols(vers))]
+        result[~found] = 0
+        return result
+
+    def flag(self, name, nucleus_ids, vers=None):
+        """
+        Looks up a flag (segment_changed, split or merge) of each nucleus in each version.
+
+        :returns: boolean numpy array (len(nucleus_ids), len(vers)), False where the nucleus is not in the version
+        """
+        rows, found = self._rows(nucleus_ids)
+        result = self.flag_matrices[name][np.ix_(rows, self._cols(vers))]
+        result[~found] = False
+        return result
+
+    def nuclei(self, segment_ids, ver):
+        """
+        Looks up the nuclei of each segment in a version.
+
+        :param segment_ids: (array-like) segment ids
+        :param ver: materialization version
+
+        :returns: two numpy arrays with one entry per match: segment ids and nucleus ids.
+            Segments with several nuclei (merges) have several matches; segments without nuclei have none.
+        """
+        col = self._cols(ver)[0]
+        start, end = self._rev_col_offsets[col], self._rev_col_offsets[col + 1]
+        ver_segment_ids = self._rev_segment_ids[start:end]
+        segment_ids = np.asarray(segment_ids, dtype=np.uint64)
+        left = np.searchsorted(ver_segment_ids, segment_ids, side='left')
+        right = np.searchsorted(ver_segment_ids, segment_ids, side='right')
+        idx = _concatenate_ranges(left, right)
+        return ver_segment_ids[idx], self._rev_nucleus_ids[start:end][idx]
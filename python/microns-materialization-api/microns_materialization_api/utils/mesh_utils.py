@@ -0,0 +1,421 @@
+"""
+Utils for storing meshes and computing their geometry statistics and levels of detail.
+"""
+import json
+import logging
+import os
+
+import h5py
+import numpy as np
+
+from .cache_utils import LRUCache
+from .filepath_utils import pool_map
+
+logger = logging.getLogger(__name__)
+
+# process-level cache of the processed vertices and faces of the meshes loaded by load_trimesh
+mesh_cache = LRUCache(max_bytes=int(os.getenv('MICRONS_MESH_CACHE_MAX_BYTES', 2 * 1024**3)))
+
+mesh_stat_names = [
+    'n_vertices',
+    'n_faces',
+    'area',
+    'volume',
+    'bbox_min_x', 'bbox_min_y', 'bbox_min_z',
+    'bbox_max_x', 'bbox_max_y', 'bbox_max_z',
+    'centroid_x', 'centroid_y', 'centroid_z',
+]
+
+
+def read_h5_array(filepath, name):
+    """
+    Reads a dataset of an .h5 file, memory mapping it when possible.
+
+    Contiguous, unfiltered datasets (as written by meshparty) are memory mapped, so no data is read or copied
+        until it is used. Chunked or compressed datasets are read into memory.
+
+    :param filepath: (str or pathlib.Path) path to the .h5 file
+    :param name: (str) name of the dataset
+
+    :returns: numpy array (read-only numpy.memmap if memory mapped)
+    """
+    with h5py.File(filepath, 'r') as f:
+        dataset = f[name]
+        offset = dataset.id.get_offset()
+        if dataset.chunks is not None or offset is None or dataset.dtype.hasobject:
+            return dataset[()]
+        shape, dtype = dataset.shape, dataset.dtype
+    return np.memmap(filepath, dtype=dtype, mode='r', shape=shape, offset=offset)
+
+
+def _cache_key(filepath):
+    stat = os.stat(filepath)
+    return str(filepath), stat.st_size, stat.st_mtime_ns
+
+
+def load_mesh_arrays(filepath):
+    """
+    Reads the vertices and faces of a mesh .h5 file as stored, memory mapped where possible (see read_h5_array).
+
+    The arrays are not processed by trimesh, so duplicate vertices are kept.
+
+    :returns: (n, 3) vertex array and (m, 3) face array
+    """
+    return read_h5_array(filepath, 'vertices'), read_h5_array(filepath, 'faces').reshape(-1, 3)
+
+
+def load_trimesh(filepath, cache=mesh_cache):
+    """
+    Loads a mesh .h5 file into a trimesh.Trimesh, as TrimeshAdapter returns it (float64 vertices, uint32 faces, default processing).
+
+    The file is read when called; it is not opened lazily. The processed vertices and faces are kept read-only in a
+        process-level LRU cache (mesh_cache) keyed by path, size and modification time of the file, so fetching the same
+        mesh again skips the read and the processing. Each call returns a Trimesh over copies of the cached arrays,
+        so callers may edit it in place without affecting the cache.
+
+    :param filepath: (str or pathlib.Path) path to the mesh .h5 file
+    :param cache: (LRUCache) cache of processed meshes, or None to disable caching
+
+    :returns: trimesh.Trimesh
+    """
+    import trimesh
+
+    def load():
+        vertices, faces = load_mesh_arrays(filepath)
+        return trimesh.Trimesh(vertices=np.asarray(vertices, dtype=np.float64), faces=np.asarray(faces, dtype=np.uint32))
+
+    def load_arrays():
+        mesh = load()
+        vertices, faces = np.array(mesh.vertices), np.array(mesh.faces)
+        vertices.flags.writeable = False
+        faces.flags.writeable = False
+        return vertices, faces
+
+    if cache is None:
+        return load()
+    vertices, faces = cache.get_or_load(_cache_key(filepath), load_arrays, nbytes=lambda arrays: sum(array.nbytes for array in arrays))
+    return trimesh.Trimesh(vertices=vertices.copy(), faces=faces.copy(), process=False)
+
+
+def write_mesh_h5(filepath, vertices, faces, vertex_decimals=None, compression=None, compression_opts=None, chunk_rows=2**16):
+    """
+    Writes vertices and faces to a mesh .h5 file in the layout of meshparty (vertices (n, 3), faces flattened to (3 * m,)),
+        so it can be read by adapt_mesh_hdf5 and TrimeshAdapter.
+
+    HDF5 filters are decoded transparently on read, so compressed files need no changes to readers.
+
+    :param filepath: (str or pathlib.Path) path of the .h5 file to write
+    :param vertices: (array-like) (n, 3) vertex coordinates in nm
+    :param faces: (array-like) (m, 3) or (3 * m,) vertex indices of each face
+    :param vertex_decimals: (int) if not None, vertices are quantized to this many decimal places with the
+        HDF5 scale-offset filter (e.g. 0 keeps 1 nm precision). Lossy.
+    :param compression: (str) HDF5 compression filter (e.g. "gzip", "lzf"), or None for no compression
+    :param compression_opts: compression level of gzip (0-9)
+    :param chunk_rows: (int) number of vertices or face indices per HDF5 chunk. Only used with filters.
+    """
+    vertices = np.asarray(vertices)
+    faces = np.asarray(faces).ravel()
+    filtered = vertex_decimals is not None or compression is not None
+    with h5py.File(filepath, 'w') as f:
+        f.create_dataset(
+            'vertices',
+            data=vertices,
+            chunks=(min(chunk_rows, max(len(vertices), 1)), 3) if filtered else None,
+            scaleoffset=vertex_decimals,
+            compression=compression,
+            compression_opts=compression_opts,
+        )
+        f.create_dataset(
+            'faces',
+            data=faces,
+            chunks=(min(3 * chunk_rows, max(len(faces), 1)),) if filtered else None,
+            shuffle=compression is not None,
+            compression=compression,
+            compression_opts=compression_opts,
+        )
+
+
+def compress_mesh_file(src, dst, vertex_decimals=0, compression='gzip', compression_opts=4):
+    """
+    Rewrites a mesh .h5 file with compressed (and optionally quantized) vertices and faces.
+        Other datasets and attributes are copied with the same compression.
+
+    :param src: (str or pathlib.Path) path to the mesh .h5 file to read
+    :param dst: (str or pathlib.Path) path of the .h5 file to write. May be equal to src.
+    :param vertex_decimals, compression, compression_opts: see write_mesh_h5
+    """
+    with h5py.File(src, 'r') as f:
+        vertices, faces = f['vertices'][()], f['faces'][()]
+        others = {name: f[name][()] for name in f if name not in ('vertices', 'faces') and isinstance(f[name], h5py.Dataset)}
+        attrs = dict(f.attrs)
+    tmp = f'{dst}.{os.getpid()}.tmp'
+    try:
+        write_mesh_h5(tmp, vertices, faces, vertex_decimals=vertex_decimals, compression=compression, compression_opts=compression_opts)
+        with h5py.File(tmp, 'a') as f:
+            for name, data in others.items():
+                kwargs = {'compression': compression, 'compression_opts': compression_opts} if compression is not None and np.ndim(data) > 0 else {}
+                f.create_dataset(name, data=data, **kwargs)
+            f.attrs.update(attrs)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _read_vertices(vertices, idx, max_span):
+    """
+    Reads the vertices at sorted unique indices idx from an h5py dataset.
+
+    Faces usually reference a narrow range of vertices, so the range is read in contiguous slices of at most max_span rows
+        and the indexed rows are selected in numpy. h5py point selection would read the rows one at a time.
+
+    :returns: (len(idx), 3) float64 vertices in the order of idx
+    """
+    out = np.empty((len(idx),) + vertices.shape[1:], dtype=np.float64)
+    i = 0
+    while i < len(idx):
+        start = idx[i]
+        j = np.searchsorted(idx, start + max_span)
+        out[i:j] = vertices[start:idx[j - 1] + 1][idx[i:j] - start]
+        i = j
+    return out
+
+
+def mesh_stats(filepath, chunk_size=1_000_000):
+    """
+    Computes geometry statistics of a mesh .h5 file (as written by meshparty), streaming over its arrays.
+
+    At most chunk_size faces and the vertices they reference are held in memory at a time, so memory is bounded
+        independently of the size of the mesh.
+
+    :param filepath: (str or pathlib.Path) path to the .h5 file with datasets vertices (n, 3) in nm and faces (3 * m,)
+    :param chunk_size: (int) number of faces (and vertices) read at a time
+
+    :returns: dict with keys in mesh_stat_names:
+        n_vertices, n_faces: size of the mesh
+        area: surface area in nm^2
+        volume: enclosed volume in nm^3 (only meaningful for watertight meshes)
+        bbox_min_*, bbox_max_*: corners of the axis-aligned bounding box of the vertices in nm
+        centroid_*: area-weighted centroid of the faces in nm (as trimesh.Trimesh.centroid)
+    """
+    with h5py.File(filepath, 'r') as f:
+        vertices, faces = f['vertices'], f['faces']
+        n_vertices, n_faces = vertices.shape[0], faces.shape[0] // 3
+        stats = dict.fromkeys(mesh_stat_names, 0.)
+        stats.update({'n_vertices': n_vertices, 'n_faces': n_faces})
+        if n_vertices == 0:
+            return stats
+
+        bbox_min, bbox_max = np.full(3, np.inf), np.full(3, -np.inf)
+        for start in range(0, n_vertices, chunk_size):
+            chunk = vertices[start:start + chunk_size]
+            bbox_min = np.minimum(bbox_min, chunk.min(axis=0))
+            bbox_max = np.maximum(bbox_max, chunk.max(axis=0))
+
+        # coordinates relative to the first vertex keep the volume sum from cancelling large terms
+        origin = vertices[0].astype(np.float64)
+        area, volume, weighted_centroid = 0., 0., np.zeros(3)
+        for start in range(0, n_faces, chunk_size):
+            chunk = faces[3 * start:3 * (start + chunk_size)].reshape(-1, 3).astype(np.int64)
+            idx, inverse = np.unique(chunk, return_inverse=True)
+            tri = _read_vertices(vertices, idx, max_span=4 * chunk_size)[inverse.reshape(-1, 3)] - origin
+            cross = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+            face_areas = np.linalg.norm(cross, axis=1) / 2
+            area += face_areas.sum()
+            volume += np.einsum('ij,ij->', tri[:, 0], np.cross(tri[:, 1], tri[:, 2])) / 6
+            weighted_centroid += face_areas @ tri.mean(axis=1)
+
+    centroid = weighted_centroid / area + origin if area > 0 else origin
+    stats.update({
+        'area': float(area),
+        'volume': float(abs(volume)),
+        **{f'bbox_min_{a}': float(x) for a, x in zip('xyz', bbox_min)},
+        **{f'bbox_max_{a}': float(x) for a, x in zip('xyz', bbox_max)},
+        **{f'centroid_{a}': float(x) for a, x in zip('xyz', centroid)},
+    })
+    return stats
+
+
+def _mesh_stats_or_none(filepath, chunk_size):
+    try:
+        return mesh_stats(filepath, chunk_size=chunk_size)
+    except Exception as e:
+        logger.error(f'Could not compute mesh stats of {filepath}: {e}')
+        return None
+
+
+def compute_mesh_stats(filepaths, n_workers=None, chunk_size=1_000_000):
+    """
+    Computes mesh_stats for many mesh .h5 files in a thread pool.
+
+    Memory is bounded by n_workers meshes of at most chunk_size faces each.
+
+    :param filepaths: (list) paths to the .h5 files
+    :param n_workers: (int) number of threads. Defaults to the number of CPUs.
+    :param chunk_size: (int) number of faces read at a time per mesh
+
+    :returns: list of stat dicts in the order of filepaths, None for files that could not be read
+    """
+    return pool_map(lambda filepath: _mesh_stats_or_none(filepath, chunk_size), filepaths, n_workers=n_workers, threads=True)
+
+
+def cluster_vertices(vertices, faces, cell_size):
+    """
+    Decimates a mesh by vertex clustering: vertices in the same grid cell are merged into their mean,
+        and faces that collapse or become duplicates are dropped.
+
+    :param vertices: (array-like) (n, 3) vertex coordinates
+    :param faces: (array-like) (m, 3) vertex indices of each face
+    :param cell_size: (float) size of a grid cell, in units of vertices
+
+    :returns: vertices (k, 3) and faces (l, 3) of the decimated mesh
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell_size).astype(np.int64)
+    _, labels = np.unique(np.ravel_multi_index(cells.T, cells.max(axis=0) + 1), return_inverse=True)
+    labels = labels.ravel()
+    counts = np.bincount(labels)
+    new_vertices = np.stack([np.bincount(labels, weights=vertices[:, i]) for i in range(3)], axis=1) / counts[:, None]
+
+    new_faces = labels[faces]
+    keep = (new_faces[:, 0] != new_faces[:, 1]) & (new_faces[:, 1] != new_faces[:, 2]) & (new_faces[:, 0] != new_faces[:, 2])
+    new_faces = new_faces[keep]
+    # faces with the same vertices in any order are duplicates; the first one keeps its orientation
+    _, first = np.unique(np.sort(new_faces, axis=1), axis=0, return_index=True)
+    new_faces = new_faces[np.sort(first)]
+
+    # drop vertices that are no longer referenced by a face
+    used, new_faces = np.unique(new_faces, return_inverse=True)
+    return new_vertices[used], new_faces.reshape(-1, 3)
+
+
+def decimate(vertices, faces, n_faces, n_iter=16):
+    """
+    Decimates a mesh by vertex clustering to at most n_faces faces.
+
+    The cell size is found by bisection (in log space) as the smallest tried size that gives at most n_faces faces.
+
+    :param vertices: (array-like) (n, 3) vertex coordinates
+    :param faces: (array-like) (m, 3) vertex indices of each face
+    :param n_faces: (int) target number of faces
+    :param n_iter: (int) number of bisection steps
+
+    :returns: vertices and faces of the decimated mesh
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+    if len(faces) <= n_faces or len(vertices) == 0:
+        return vertices, faces
+    extent = np.ptp(vertices, axis=0).max()
+    # all vertices coincide, so there is no cell size to search
+    if not extent > 0:
+        return vertices, faces
+    lo, hi = np.log(extent * 1e-6), np.log(extent)
+    best = cluster_vertices(vertices, faces, np.exp(hi))
+    for _ in range(n_iter):
+        mid = (lo + hi) / 2
+        result = cluster_vertices(vertices, faces, np.exp(mid))
+        if len(result[1]) <= n_faces:
+            best, hi = result, mid
+        else:
+            lo = mid
+    return best
+
+
+def build_mesh_lod(mesh_filepath, lod_filepath, fractions):
+    """
+    Writes decimated levels of detail of a mesh .h5 file to one .h5 file.
+
+    Each level is decimated from the previous (finer) one, so coarse levels are cheap.
+
+    :param mesh_filepath: (str or pathlib.Path) path to the full resolution mesh .h5 file
+    :param lod_filepath: (str or pathlib.Path) path of the .h5 file to write
+    :param fractions: (list) target fraction of the full resolution faces of each level, e.g. [0.1, 0.01, 0.001]
+
+    :returns: list with a dict per level (finest first) with keys level, fraction, n_vertices, n_faces
+    """
+    with h5py.File(mesh_filepath, 'r') as f:
+        vertices = f['vertices'][()].astype(np.float64)
+        faces = f['faces'][()].reshape(-1, 3)
+    n_faces = len(faces)
+
+    levels = []
+    with h5py.File(lod_filepath, 'w') as f:
+        for level, fraction in enumerate(sorted(fractions, reverse=True)):
+            vertices, faces = decimate(vertices, faces, max(int(n_faces * fraction), 1))
+            group = f.create_group(f'levels/{level}')
+            group.create_dataset('vertices', data=vertices.astype(np.float32))
+            group.create_dataset('faces', data=faces.astype(np.uint32))
+            levels.append({'level': level, 'fraction': fraction, 'n_vertices': len(vertices), 'n_faces': len(faces)})
+        f.attrs['levels'] = json.dumps(levels)
+    return levels
+
+
+def _build_mesh_lod_or_none(args):
+    try:
+        return build_mesh_lod(*args)
+    except Exception as e:
+        logger.error(f'Could not build levels of detail of {args[0]}: {e}')
+        return None
+
+
+def build_mesh_lods(mesh_filepaths, lod_filepaths, fractions, n_workers=None):
+    """
+    Runs build_mesh_lod for many meshes in a process pool.
+
+    :param n_workers: (int) number of worker processes. Defaults to the number of CPUs.
+
+    :returns: list of results of build_mesh_lod in the order of mesh_filepaths, None for meshes that failed
+    """
+    args = [(m, l, fractions) for m, l in zip(mesh_filepaths, lod_filepaths)]
+    return pool_map(_build_mesh_lod_or_none, args, n_workers=n_workers)
+
+
+class MeshLOD:
+    """
+    Decimated levels of detail of a mesh, as written by build_mesh_lod.
+
+    Only the level metadata is read on load; the geometry of a level is read when requested.
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with h5py.File(filepath, 'r') as f:
+            self.levels = json.loads(f.attrs['levels'])
+
+    @classmethod
+    def load(cls, filepath):
+        return cls(filepath)
+
+    def select_level(self, face_budget=None):
+        """
+        :param face_budget: (int) number of faces needed. If None, the finest level.
+
+        :returns: (int) the coarsest level with at least face_budget faces, or the finest level if none has enough
+        """
+        if face_budget is not None:
+            for level in reversed(self.levels):
+                if level['n_faces'] >= face_budget:
+                    return level['level']
+        return self.levels[0]['level']
+
+    def get(self, face_budget=None, level=None):
+        """
+        Reads the geometry of one level.
+
+        :param face_budget: (int) see select_level. Ignored if level is provided.
+        :param level: (int) level to read
+
+        :returns: vertices (n, 3) in nm and faces (m, 3)
+        """
+        level = self.select_level(face_budget) if level is None else level
+        with h5py.File(self.filepath, 'r') as f:
+            return f[f'levels/{level}/vertices'][()].astype(np.float64), f[f'levels/{level}/faces'][()]
+
+    def trimesh(self, face_budget=None, level=None):
+        """
+        :returns: trimesh.Trimesh of one level (see get)
+        """
+        import trimesh
+        vertices, faces = self.get(face_budget=face_budget, level=level)
+        return trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
@@ -0,0 +1,102 @@
+"""
+Utils for reading parts of meshwork and skeleton .h5 files without loading the whole object.
+
+meshparty is imported inside the functions, so importing this module does not import meshparty and trimesh.
+"""
+import json
+
+import h5py
+import numpy as np
+
+
+def read_h5_datasets(filepath, names):
+    """
+    Reads only the named datasets of an .h5 file.
+
+    :param filepath: (str or pathlib.Path) path to the .h5 file
+    :param names: (list) dataset names, e.g. ["vertices", "edges"] or ["skeleton/vertices"]
+
+    :returns: dict of numpy arrays keyed by name
+    """
+    with h5py.File(filepath, 'r') as f:
+        return {name: f[name][()] for name in names}
+
+
+def load_pcg_skeleton(filepath, include_mesh_to_skel_map=False):
+    """
+    Loads a skeleton .h5 file (as written by pcg_skel) into a meshparty Skeleton, skipping the mesh_to_skel_map by default.
+
+    :param filepath: (str or pathlib.Path) path to the .h5 file
+    :param include_mesh_to_skel_map: (bool) also read mesh_to_skel_map, which is usually the largest dataset
+
+    :returns: meshparty.skeleton.Skeleton
+    """
+    from meshparty.skeleton import Skeleton
+    names = ['vertices', 'edges', 'root', 'meta'] + (['mesh_to_skel_map'] if include_mesh_to_skel_map else [])
+    data = read_h5_datasets(filepath, names)
+    return Skeleton(
+        vertices=data['vertices'],
+        edges=data['edges'],
+        mesh_to_skel_map=data.get('mesh_to_skel_map'),
+        root=data['root'],
+        meta=json.loads(data['meta']),
+    )
+
+
+def meshwork_version(filepath):
+    from meshparty.meshwork import meshwork_io
+    return meshwork_io.load_meshwork_metadata(filepath)['version']
+
+
+def load_meshwork_skeleton(filepath):
+    """
+    Loads only the skeleton of a meshwork .h5 file, without its mesh or annotations.
+
+    :returns: meshparty.skeleton.Skeleton, or None if the meshwork has no skeleton
+    """
+    from meshparty.meshwork import meshwork_io
+    return meshwork_io.load_meshwork_skeleton(filepath, version=meshwork_version(filepath))
+
+
+def load_meshwork_annotations(filepath, table_names=None):
+    """
+    Loads only annotation tables of a meshwork .h5 file, without its mesh or skeleton.
+
+    :param filepath: (str or pathlib.Path) path to the .h5 file
+    :param table_names: (list) names of the tables to load (e.g. ["pre_syn", "post_syn"]). If None, all tables.
+
+    :returns: dict of pandas.DataFrame keyed by table name, as stored (anno[table_name].data_original)
+    """
+    from meshparty.meshwork import meshwork_io
+    version = meshwork_version(filepath)
+    if table_names is None:
+        with h5py.File(filepath, 'r') as f:
+            table_names = list(f['annotations'].keys()) if 'annotations' in f else []
+    return {name: meshwork_io.anno_load_function[version](filepath, name) for name in table_names}
+
+
+def load_meshwork_mesh_indices(filepath, table_names=('pre_syn', 'post_syn')):
+    """
+    Loads the mesh vertex index of each row of annotation tables of a meshwork .h5 file, as anno[table_name].mesh_index
+        of the loaded meshwork, reading only the tables and the mesh masks.
+
+    Only tables stored with an index column (as pcg_skel stores synapses) of meshworks without a mask are supported.
+        Otherwise the mesh is needed to map the rows to vertices and the full meshwork must be loaded.
+
+    :param filepath: (str or pathlib.Path) path to the .h5 file
+    :param table_names: (list) names of the annotation tables
+
+    :returns: dict of numpy arrays of mesh indices keyed by table name
+    """
+    from meshparty.meshwork import meshwork_io
+    version = meshwork_version(filepath)
+    with h5py.File(filepath, 'r') as f:
+        if not (np.all(f['mesh/node_mask'][()]) and np.all(f['mesh/mesh_mask'][()])):
+            raise ValueError('The meshwork has a mask. Load the full meshwork instead.')
+        index_columns = {}
+        for name in table_names:
+            attrs = f[f'annotations/{name}'].attrs
+            if not bool(attrs.get('defined_index', False)):
+                raise ValueError(f'Annotation table {name} has no index column. Load the full meshwork instead.')
+            index_columns[name] = attrs['index_column']
+    return {name: meshwork_io.anno_load_function[version](filepath, name)[column].values.astype(np.int64) for name, column in index_columns.items()}
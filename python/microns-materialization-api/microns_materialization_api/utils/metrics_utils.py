@@ -0,0 +1,282 @@
+"""
+Utils for recording the wall time, bytes and rows of the stages of makers and import/make methods.
+
+A make() decorated with instrumented opens a record, and the code it calls marks its stages:
+
+    with stage('cave') as s:
+        df = client.materialize.query_table('nucleus_detection_v0')
+        s.add(n_rows=len(df))
+
+Stages may nest (e.g. "run" contains "cave" and "download"), and "make" is the whole make() call.
+    Outside of a record, stage does nothing.
+
+Records are aggregated in memory per (table, method, stage) by the process-wide collector and flushed every
+    flush_interval seconds to its sinks (e.g. the Metrics table) and, if MICRONS_METRICS_TEXTFILE is set,
+    to a Prometheus text file for the node_exporter textfile collector.
+"""
+import atexit
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+from .profile_utils import current_profiler
+
+logger = logging.getLogger(__name__)
+
+# attributes of a key holding the hash of the method that makes it, in order of precedence
+method_attrs = ('import_method', 'make_method')
+
+# counters of the Prometheus text file, as (name, index in the aggregated values, help)
+prometheus_counters = [
+    ('microns_stage_calls_total', 0, 'Number of times the stage ran.'),
+    ('microns_stage_errors_total', 1, 'Number of times the stage raised.'),
+    ('microns_stage_seconds_total', 2, 'Summed wall time of the stage in seconds.'),
+    ('microns_stage_bytes_total', 3, 'Summed bytes read or written by the stage.'),
+    ('microns_stage_rows_total', 4, 'Summed rows fetched or inserted by the stage.'),
+]
+
+_current_record = contextvars.ContextVar('microns_metrics_record', default=None)
+
+
+class Stage:
+    """
+    A timed stage of a record. Bytes and rows can be added while the stage runs, once they are known.
+    """
+    def __init__(self, name, n_bytes=0, n_rows=0):
+        self.name = name
+        self.n_bytes = n_bytes
+        self.n_rows = n_rows
+        self.seconds = 0.
+        self.error = False
+
+    def add(self, n_bytes=0, n_rows=0):
+        self.n_bytes += int(n_bytes)
+        self.n_rows += int(n_rows)
+
+
+class _NullStage:
+    def add(self, n_bytes=0, n_rows=0):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+class Record:
+    """
+    Stages of one make() call.
+    """
+    def __init__(self, table, method=''):
+        self.table = table
+        self.method = method
+        self.stages = []
+
+
+@contextlib.contextmanager
+def stage(name, n_bytes=0, n_rows=0):
+    """
+    Times a stage of the current record.
+
+    :param name: (str) stage name, e.g. "cave", "download", "write", "rename", "insert"
+    :param n_bytes: (int) bytes read or written, if known before the stage runs
+    :param n_rows: (int) rows fetched or inserted, if known before the stage runs
+
+    :yields: Stage, whose add method counts bytes and rows found while the stage runs
+    """
+    record = _current_record.get()
+    if record is None:
+        yield _null_stage
+        return
+    s = Stage(name, n_bytes, n_rows)
+    start = time.perf_counter()
+    try:
+        yield s
+    except BaseException:
+        s.error = True
+        raise
+    finally:
+        s.seconds = time.perf_counter() - start
+        record.stages.append(s)
+
+
+def file_size(filepath):
+    """
+    :returns: (int) size of a file in bytes, 0 if it does not exist
+    """
+    try:
+        return os.path.getsize(filepath)
+    except OSError:
+        return 0
+
+
+def method_hash(key):
+    """
+    :returns: (str) the import or make method hash of a key, "" if it has none
+    """
+    for attr in method_attrs:
+        if attr in key:
+            return str(key[attr])
+    return ''
+
+
+class MetricsCollector:
+    """
+    Aggregates records per (table, method, stage) in memory and flushes them to sinks and a Prometheus text file.
+
+    Each sink is called with pod, window_start (datetime), window_s and a list of row dicts with keys table_name, method,
+        stage, n_calls, n_errors, seconds, n_bytes and n_rows, aggregated since the last flush.
+        Errors of sinks are logged and never raised, so metrics never fail a make.
+    """
+    def __init__(self, pod=None, flush_interval=60., textfile=None):
+        """
+        :param pod: (str) name of the pod or host. Defaults to HOSTNAME, which is the pod name on kubernetes.
+        :param flush_interval: (float) seconds between flushes
+        :param textfile: (str or pathlib.Path) path of the Prometheus text file, written on each flush. None to disable.
+        """
+        self.pod = pod if pod is not None else os.getenv('HOSTNAME', socket.gethostname())
+        self.flush_interval = flush_interval
+        self.textfile = Path(textfile) if textfile else None
+        self.sinks = []
+        self._lock = threading.Lock()
+        self._window = {}
+        self._totals = {}
+        self._window_start = datetime.now()
+        self._last_flush = time.monotonic()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(pod={self.pod!r}, flush_interval={self.flush_interval}, textfile={self.textfile})'
+
+    @staticmethod
+    def _add(values, group, n_calls, n_errors, seconds, n_bytes, n_rows):
+        v = values.setdefault(group, [0, 0, 0., 0, 0])
+        v[0] += n_calls
+        v[1] += n_errors
+        v[2] += seconds
+        v[3] += n_bytes
+        v[4] += n_rows
+
+    def add(self, record, seconds, error=False):
+        """
+        Adds the stages of a record and a "make" stage of the whole call.
+        """
+        stages = [('make', 1, int(error), seconds, sum(s.n_bytes for s in record.stages if s.name == 'write'), sum(s.n_rows for s in record.stages if s.name == 'insert'))]
+        stages += [(s.name, 1, int(s.error), s.seconds, s.n_bytes, s.n_rows) for s in record.stages]
+        with self._lock:
+            for name, *values in stages:
+                group = (record.table, record.method, name)
+                self._add(self._window, group, *values)
+                self._add(self._totals, group, *values)
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the Prometheus text file and passes the rows aggregated since the last flush to the sinks.
+        """
+        with self._lock:
+            window, self._window = self._window, {}
+            window_start, self._window_start = self._window_start, datetime.now()
+            window_s = time.monotonic() - self._last_flush
+            self._last_flush = time.monotonic()
+            totals = dict(self._totals)
+        if self.textfile is not None:
+            try:
+                self.write_textfile(totals)
+            except Exception as e:
+                logger.warning(f'Could not write metrics to {self.textfile}: {type(e).__name__}: {e}')
+        if not window:
+            return
+        rows = [
+            {'table_name': table, 'method': method, 'stage': name, 'n_calls': v[0], 'n_errors': v[1], 'seconds': v[2], 'n_bytes': v[3], 'n_rows': v[4]}
+            for (table, method, name), v in window.items()
+        ]
+        for sink in self.sinks:
+            try:
+                sink(self.pod, window_start, window_s, rows)
+            except Exception as e:
+                logger.warning(f'Could not flush metrics to {sink}: {type(e).__name__}: {e}')
+
+    def write_textfile(self, totals=None):
+        """
+        Writes the cumulative counters of this process in the Prometheus text format, replacing the file atomically.
+        """
+        totals = self._totals if totals is None else totals
+        lines = []
+        for name, index, help in prometheus_counters:
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} counter']
+            for (table, method, stage_name), v in sorted(totals.items()):
+                labels = f'pod="{self.pod}",table="{table}",method="{method}",stage="{stage_name}"'
+                lines.append(f'{name}{{{labels}}} {v[index]}')
+        self.textfile.parent.mkdir(parents=True, exist_ok=True)
+        tmp_filepath = self.textfile.with_name(f'.{self.textfile.name}.{uuid.uuid4().hex}.tmp')
+        tmp_filepath.write_text('\n'.join(lines) + '\n')
+        os.replace(tmp_filepath, self.textfile)
+
+    def summary(self):
+        """
+        :returns: list of row dicts (see class docstring) of the cumulative counters of this process
+        """
+        with self._lock:
+            return [
+                {'table_name': table, 'method': method, 'stage': name, 'n_calls': v[0], 'n_errors': v[1], 'seconds': v[2], 'n_bytes': v[3], 'n_rows': v[4]}
+                for (table, method, name), v in self._totals.items()
+            ]
+
+
+collector = MetricsCollector(
+    flush_interval=float(os.getenv('MICRONS_METRICS_FLUSH_INTERVAL', 60)),
+    textfile=os.getenv('MICRONS_METRICS_TEXTFILE'),
+)
+atexit.register(collector.flush)
+
+
+@contextlib.contextmanager
+def record(table, method=''):
+    """
+    Opens a record of the stages run in the block and adds it to the collector on exit.
+        If a record is already open (e.g. a make calling another instrumented make), the block is part of it.
+
+    :param table: (str) name of the maker or method, e.g. "Mesh.MeshParty"
+    :param method: (str) method hash
+    """
+    if _current_record.get() is not None:
+        yield _current_record.get()
+        return
+    r = Record(table, method)
+    token = _current_record.set(r)
+    start = time.perf_counter()
+    error = False
+    try:
+        yield r
+    except BaseException:
+        error = True
+        raise
+    finally:
+        _current_record.reset(token)
+        collector.add(r, time.perf_counter() - start, error=error)
+        collector.maybe_flush()
+
+
+def instrumented(make):
+    """
+    Decorates the make method of a DataJoint table to record its stages, keyed by the class name of the table
+        and the method hash of the key. If profiling is enabled (see utils.profile_utils), the call is also profiled.
+    """
+    @functools.wraps(make)
+    def wrapper(self, key, *args, **kwargs):
+        with record(self.class_name, method_hash(key)):
+            profiler = current_profiler()
+            if profiler is None:
+                return make(self, key, *args, **kwargs)
+            return profiler.run(self.class_name, key, make, self, key, *args, **kwargs)
+    return wrapper
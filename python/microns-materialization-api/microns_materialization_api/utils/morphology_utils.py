@@ -0,0 +1,103 @@
+"""
+Utils for computing morphology metrics of skeletons.
+"""
+import logging
+
+import h5py
+import numpy as np
+
+from .filepath_utils import pool_map
+
+logger = logging.getLogger(__name__)
+
+skeleton_metric_names = [
+    'n_vertices',
+    'n_edges',
+    'cable_length',
+    'n_branch_points',
+    'n_end_points',
+    'max_path_length',
+    'mean_path_length',
+    'radial_extent',
+]
+
+
+def read_skeleton_arrays(filepath):
+    """
+    Reads the vertices, edges and root of a skeleton .h5 file (as written by meshparty) without building a Skeleton.
+
+    :param filepath: (str or pathlib.Path) path to the .h5 file
+
+    :returns: vertices (n, 3), edges (m, 2) and root (int)
+    """
+    with h5py.File(filepath, 'r') as f:
+        vertices = f['vertices'][()]
+        edges = f['edges'][()]
+        root = int(f['root'][()]) if 'root' in f else 0
+    return vertices, edges, root
+
+
+def skeleton_metrics(vertices, edges, root=0):
+    """
+    Computes morphology metrics of a skeleton.
+
+    :param vertices: (array-like) (n, 3) vertex coordinates in nm
+    :param edges: (array-like) (m, 2) vertex indices of each edge
+    :param root: (int) index of the root vertex
+
+    :returns: dict with keys in skeleton_metric_names:
+        n_vertices, n_edges: size of the skeleton
+        cable_length: summed length of all edges in nm
+        n_branch_points: number of vertices with more than two edges
+        n_end_points: number of vertices with one edge
+        max_path_length, mean_path_length: path length from the root to each vertex along the skeleton in nm
+        radial_extent: max Euclidean distance of a vertex from the root in nm
+        Vertices not connected to the root are ignored in path lengths and radial extent.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    n = len(vertices)
+    metrics = dict.fromkeys(skeleton_metric_names, 0)
+    metrics.update({'n_vertices': n, 'n_edges': len(edges)})
+    if n == 0:
+        return metrics
+
+    from scipy import sparse
+    from scipy.sparse.csgraph import dijkstra
+
+    lengths = np.linalg.norm(vertices[edges[:, 0]] - vertices[edges[:, 1]], axis=1)
+    degree = np.bincount(edges.ravel(), minlength=n)
+    graph = sparse.csr_matrix((lengths, (edges[:, 0], edges[:, 1])), shape=(n, n))
+    path_lengths = dijkstra(graph, directed=False, indices=root)
+    connected = np.isfinite(path_lengths)
+
+    metrics.update({
+        'cable_length': float(lengths.sum()),
+        'n_branch_points': int((degree > 2).sum()),
+        'n_end_points': int((degree == 1).sum()),
+        'max_path_length': float(path_lengths[connected].max()),
+        'mean_path_length': float(path_lengths[connected].mean()),
+        'radial_extent': float(np.linalg.norm(vertices[connected] - vertices[root], axis=1).max()),
+    })
+    return metrics
+
+
+def _skeleton_metrics_from_file(filepath):
+    try:
+        return skeleton_metrics(*read_skeleton_arrays(filepath))
+    except Exception as e:
+        logger.error(f'Could not compute skeleton metrics of {filepath}: {e}')
+        return None
+
+
+def compute_skeleton_metrics(filepaths, n_workers=None, chunksize=16):
+    """
+    Computes skeleton_metrics for many skeleton .h5 files in a process pool.
+
+    :param filepaths: (list) paths to the .h5 files
+    :param n_workers: (int) number of worker processes. Defaults to the number of CPUs. If 1, runs in the current process.
+    :param chunksize: (int) number of files sent to a worker at a time
+
+    :returns: list of metric dicts in the order of filepaths, None for files that could not be read
+    """
+    return pool_map(_skeleton_metrics_from_file, filepaths, n_workers=n_workers, chunksize=chunksize)
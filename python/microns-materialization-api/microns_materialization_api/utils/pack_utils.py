@@ -0,0 +1,242 @@
+"""
+Utils for packing many small skeleton files into one HDF5 file and reading them back with memory mapping.
+
+A pack has one group per packed attribute (e.g. "skeleton_obj", "axon_skeleton"), each with:
+    ids: (n,) skeleton ids
+    vertices: (sum of n_vertices, 3) vertices of all skeletons, concatenated
+    edges: (sum of n_edges, 2) edges of all skeletons, concatenated, indexing the vertices of their own skeleton
+    vertex_offsets, edge_offsets: (n + 1,) the rows of skeleton i are [offsets[i], offsets[i + 1])
+    roots: (n,) root vertex of each skeleton, -1 if the source file has none
+    meta: (n,) JSON metadata of each skeleton, "" if the source file has none
+"""
+import functools
+import json
+import logging
+import os
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from .filepath_utils import Throughput, bulk_load
+from .mesh_utils import read_h5_array
+
+logger = logging.getLogger(__name__)
+
+
+def read_skeleton_file(filepath):
+    """
+    Reads the arrays of a skeleton file, either an .h5 file as written by pcg_skel/meshparty or an .npz file
+        with vertices and edges (as Skeleton.MeshworkAxonDendriteSkeleton).
+
+    :returns: dict with vertices, edges, root (-1 if none) and meta (JSON str, "" if none)
+    """
+    if Path(filepath).suffix == '.npz':
+        with np.load(filepath) as f:
+            return {'vertices': f['vertices'], 'edges': f['edges'], 'root': -1, 'meta': ''}
+    with h5py.File(filepath, 'r') as f:
+        meta = f['meta'][()] if 'meta' in f else ''
+        return {
+            'vertices': f['vertices'][()],
+            'edges': f['edges'][()],
+            'root': int(f['root'][()]) if 'root' in f else -1,
+            'meta': meta.decode() if isinstance(meta, bytes) else str(meta),
+        }
+
+
+class _GroupWriter:
+    """
+    Appends skeletons to the resizable datasets of a group. Vertices and edges keep the dtype of the source files.
+    """
+    def __init__(self, group, chunk_rows):
+        self.group = group
+        self.chunk_rows = chunk_rows
+        self.datasets = None
+        self.vertex_offsets = [0]
+        self.edge_offsets = [0]
+        self.buffer = []
+
+    def _create_datasets(self, columns):
+        self.datasets = {}
+        for name, values in columns.items():
+            values = np.asarray(values) if name in ('vertices', 'edges') else values
+            shape = (0,) + np.shape(values)[1:] if name in ('vertices', 'edges') else (0,)
+            dtype = values.dtype if name in ('vertices', 'edges') else np.int64 if name == 'roots' else h5py.string_dtype()
+            self.datasets[name] = self.group.create_dataset(name, shape, dtype=dtype, maxshape=(None,) + shape[1:], chunks=(self.chunk_rows,) + shape[1:])
+
+    def append(self, skeleton_id, arrays):
+        self.buffer.append((skeleton_id, arrays))
+        self.vertex_offsets.append(self.vertex_offsets[-1] + len(arrays['vertices']))
+        self.edge_offsets.append(self.edge_offsets[-1] + len(arrays['edges']))
+
+    def flush(self):
+        if not self.buffer:
+            return
+        columns = {
+            'ids': [skeleton_id for skeleton_id, _ in self.buffer],
+            'vertices': np.concatenate([np.asarray(a['vertices']).reshape(-1, 3) for _, a in self.buffer]),
+            'edges': np.concatenate([np.asarray(a['edges']).reshape(-1, 2) for _, a in self.buffer]),
+            'roots': [a['root'] for _, a in self.buffer],
+            'meta': [a['meta'] for _, a in self.buffer],
+        }
+        if self.datasets is None:
+            self._create_datasets(columns)
+        for name, values in columns.items():
+            dataset = self.datasets[name]
+            n = len(dataset)
+            dataset.resize(n + len(values), axis=0)
+            dataset[n:] = values
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        if self.datasets is None:
+            self._create_datasets({'vertices': np.empty((0, 3)), 'edges': np.empty((0, 2), dtype=np.int64), 'ids': [], 'roots': [], 'meta': []})
+        group = self.group
+        group.create_dataset('vertex_offsets', data=np.array(self.vertex_offsets, dtype=np.int64))
+        group.create_dataset('edge_offsets', data=np.array(self.edge_offsets, dtype=np.int64))
+
+
+def _copy_contiguous(src, dst, chunk_rows):
+    """
+    Copies all groups of src to dst, writing vertices and edges as contiguous datasets so they can be memory mapped.
+    """
+    for name, group in src.items():
+        out = dst.create_group(name)
+        out.attrs.update(group.attrs)
+        for key, dataset in group.items():
+            if key in ('vertices', 'edges'):
+                copy = out.create_dataset(key, dataset.shape, dtype=dataset.dtype)
+                for start in range(0, len(dataset), chunk_rows):
+                    copy[start:start + chunk_rows] = dataset[start:start + chunk_rows]
+            else:
+                group.copy(key, out)
+
+
+def write_skeleton_pack(filepath, filepaths, n_workers=16, chunk_rows=2**16, flush_every=1000):
+    """
+    Packs skeleton files into one HDF5 file. Source files are read with a thread pool.
+
+    The pack is first written to a chunked temporary file next to filepath, then copied into contiguous datasets
+        and moved into place, so an existing pack is never left half-written.
+
+    :param filepath: (str or pathlib.Path) path to the pack
+    :param filepaths: (dict) for each group name (e.g. "skeleton_obj"), a list of (skeleton_id, path to the source file)
+    :param n_workers: (int) number of threads reading source files
+    :param chunk_rows: (int) rows per chunk of the temporary file and per copy into the pack
+    :param flush_every: (int) number of skeletons buffered before they are written
+
+    :returns: dict with, for each group name, a list of (skeleton_id, index in the group) of the packed skeletons.
+        Source files that could not be read are logged and skipped.
+    """
+    filepath = Path(filepath)
+    tmp_filepath = filepath.with_name(f'.{filepath.name}.tmp')
+    chunked_filepath = filepath.with_name(f'.{filepath.name}.chunked')
+    members = {}
+    try:
+        with h5py.File(chunked_filepath, 'w') as f:
+            for name, items in filepaths.items():
+                logger.info(f'Packing {len(items)} files of {name}.')
+                writer = _GroupWriter(f.create_group(name), chunk_rows)
+                throughput = Throughput()
+                loaded = bulk_load([fp for _, fp in items], read_skeleton_file, n_workers=n_workers, raise_errors=False, throughput=throughput)
+                members[name] = []
+                for (skeleton_id, _), arrays in zip(items, loaded):
+                    if arrays is None:
+                        continue
+                    members[name].append((skeleton_id, len(members[name])))
+                    writer.append(skeleton_id, arrays)
+                    if len(writer.buffer) >= flush_every:
+                        writer.flush()
+                writer.close()
+        with h5py.File(chunked_filepath, 'r') as src, h5py.File(tmp_filepath, 'w') as dst:
+            _copy_contiguous(src, dst, chunk_rows)
+        os.replace(tmp_filepath, filepath)
+    finally:
+        for fp in (chunked_filepath, tmp_filepath):
+            if fp.exists():
+                fp.unlink()
+    return members
+
+
+class SkeletonPack:
+    """
+    Read access to a skeleton pack. Vertices and edges are memory mapped, so reading one skeleton only touches
+        its own rows of the file.
+    """
+    def __init__(self, filepath):
+        self.filepath = Path(filepath)
+        self._groups = {}
+        with h5py.File(self.filepath, 'r') as f:
+            self.names = list(f.keys())
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({str(self.filepath)!r})'
+
+    @classmethod
+    def load(cls, filepath):
+        return cls(filepath)
+
+    def _group(self, name):
+        if name not in self._groups:
+            with h5py.File(self.filepath, 'r') as f:
+                group = {key: f[name][key][()] for key in ('vertex_offsets', 'edge_offsets', 'roots')}
+            group['vertices'] = read_h5_array(self.filepath, f'{name}/vertices')
+            group['edges'] = read_h5_array(self.filepath, f'{name}/edges')
+            self._groups[name] = group
+        return self._groups[name]
+
+    def ids(self, name):
+        with h5py.File(self.filepath, 'r') as f:
+            return f[name]['ids'].asstr()[()]
+
+    def meta(self, name, idx):
+        with h5py.File(self.filepath, 'r') as f:
+            meta = f[name]['meta'].asstr()[idx]
+        return json.loads(meta) if meta else {}
+
+    def __len__(self):
+        return sum(len(self._group(name)['roots']) for name in self.names)
+
+    def get(self, name, idx):
+        """
+        :param name: (str) group name, e.g. "skeleton_obj"
+        :param idx: (int) index of the skeleton in the group
+
+        :returns: dict with vertices (n, 3), edges (m, 2) and root (-1 if none). Arrays are read-only views of the file.
+        """
+        group = self._group(name)
+        v0, v1 = group['vertex_offsets'][idx:idx + 2]
+        e0, e1 = group['edge_offsets'][idx:idx + 2]
+        return {
+            'vertices': group['vertices'][v0:v1],
+            'edges': group['edges'][e0:e1],
+            'root': int(group['roots'][idx]),
+        }
+
+    def skeleton(self, name, idx):
+        """
+        :returns: meshparty.skeleton.Skeleton of the skeleton at idx, as loaded from its source file without the mesh_to_skel_map
+        """
+        from meshparty.skeleton import Skeleton
+        arrays = self.get(name, idx)
+        return Skeleton(
+            vertices=np.array(arrays['vertices'], dtype=np.float64),
+            edges=np.array(arrays['edges'], dtype=np.int64),
+            root=arrays['root'] if arrays['root'] >= 0 else None,
+            meta=self.meta(name, idx),
+        )
+
+
+@functools.lru_cache(maxsize=64)
+def _open_skeleton_pack(filepath, size, mtime_ns):
+    return SkeletonPack(filepath)
+
+
+def open_skeleton_pack(filepath):
+    """
+    Opens a SkeletonPack once per process and version of the file, identified by its size and modification time,
+        so a pack rewritten at the same path (e.g. after SkeletonPack is repopulated) is opened again.
+    """
+    stat = os.stat(filepath)
+    return _open_skeleton_pack(str(filepath), stat.st_size, stat.st_mtime_ns)
@@ -0,0 +1,114 @@
+"""
+Utils for writing partitioned Parquet datasets in chunks.
+"""
+import json
+import os
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+class ParquetPartition:
+    """
+    One hive-style partition (e.g. <dataset_dir>/ver=343.00) of a Parquet dataset, written one part file per chunk.
+
+    A manifest in the partition directory records the chunk keys stored in each part file,
+        so an interrupted export can resume without rewriting the parts that are already on disk.
+    """
+    manifest_name = '_manifest.json'
+
+    def __init__(self, dataset_dir, partition, row_group_size=100_000, compression='zstd'):
+        """
+        :param dataset_dir: (str or pathlib.Path) root directory of the dataset
+        :param partition: (dict) partition columns and values, in directory order
+        :param row_group_size: (int) max number of rows per row group
+        :param compression: (str) Parquet compression codec
+        """
+        self.partition = partition
+        self.path = Path(dataset_dir).joinpath(*[f'{k}={v}' for k, v in partition.items()])
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        filepath = self.path / self.manifest_name
+        if filepath.exists():
+            with open(filepath, 'r') as f:
+                return json.load(f)
+        return {'parts': {}, 'complete': False}
+
+    def _write_manifest(self):
+        filepath = self.path / self.manifest_name
+        tmp_filepath = filepath.with_suffix('.tmp')
+        with open(tmp_filepath, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_filepath, filepath)
+
+    @property
+    def complete(self):
+        return self.manifest['complete']
+
+    @property
+    def exported_keys(self):
+        return {key for keys in self.manifest['parts'].values() for key in keys}
+
+    def clear(self):
+        """
+        Removes all part files and resets the manifest.
+        """
+        for name in self.manifest['parts']:
+            self.path.joinpath(name).unlink(missing_ok=True)
+        self.manifest = {'parts': {}, 'complete': False}
+        if self.path.exists():
+            self._write_manifest()
+
+    def write(self, df, chunk_keys):
+        """
+        Writes a chunk as a new part file and records it in the manifest.
+
+        The part is written under a temporary name and renamed once complete, so readers never see partial files.
+
+        :param df: (pandas.DataFrame) rows of the chunk. Partition columns are dropped if present.
+        :param chunk_keys: (list) keys that identify the chunk, stored in the manifest
+
+        :returns: pathlib.Path of the part file
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        df = df.drop(columns=[c for c in self.partition if c in df.columns])
+        name = f'part-{len(self.manifest["parts"]):05d}.parquet'
+        filepath = self.path / name
+        tmp_filepath = filepath.with_suffix('.tmp')
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, tmp_filepath, row_group_size=self.row_group_size, compression=self.compression, write_statistics=True)
+        os.replace(tmp_filepath, filepath)
+        self.manifest['parts'][name] = [int(key) for key in chunk_keys]
+        self._write_manifest()
+        return filepath
+
+    def mark_complete(self):
+        self.manifest['complete'] = True
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._write_manifest()
+
+
+def chunk_keys_by_size(keys, counts, chunk_size):
+    """
+    Groups sorted keys into consecutive chunks of about chunk_size rows.
+
+    :param keys: (array-like) keys in the order they should be chunked
+    :param counts: (array-like) number of rows for each key
+    :param chunk_size: (int) target number of rows per chunk. A key with more rows than chunk_size gets its own chunk.
+
+    :returns: list of lists of keys
+    """
+    chunks, chunk, n = [], [], 0
+    for key, count in zip(keys, counts):
+        if chunk and n + count > chunk_size:
+            chunks.append(chunk)
+            chunk, n = [], 0
+        chunk.append(key)
+        n += count
+    if chunk:
+        chunks.append(chunk)
+    return chunks
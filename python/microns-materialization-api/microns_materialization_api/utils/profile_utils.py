@@ -0,0 +1,313 @@
+"""
+Utils for profiling the CPU time and memory of make() calls.
+
+Profiling is opt-in: set MICRONS_PROFILE=true, or run populate inside the profiling context manager:
+
+    with profiling(min_seconds=30):
+        Meshwork.PCGMeshworkMaker.populate(restriction)
+
+Each make() decorated with utils.metrics_utils.instrumented then runs under cProfile, with tracemalloc tracing
+    allocations and a thread sampling the traced memory. Calls over a time or memory threshold (or that raise) are
+    written to the profile directory, keyed by table and key:
+
+    <profile_dir>/<table_name>/<key_hash>/<timestamp>.prof  cProfile stats, readable with pstats.Stats
+    <profile_dir>/<table_name>/<key_hash>/<timestamp>.json  key, wall and CPU time, peak memory, top functions and allocations
+
+Example (worst keys by time and by peak memory):
+    python -m microns_materialization_api.utils.profile_utils summary --profile-dir /path/to/profiles
+"""
+import argparse
+import contextlib
+import contextvars
+import cProfile
+import hashlib
+import io
+import json
+import logging
+import os
+import pstats
+import socket
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+default_profile_dir = Path(os.getenv('MICRONS_PROFILE_DIR', Path.home() / '.cache' / 'microns-materialization' / 'profiles'))
+
+_current_profiler = contextvars.ContextVar('microns_profiler', default=None)
+_env_profiler = None
+
+
+def key_hash(key):
+    """
+    :returns: (str) md5 of the JSON of a key, independent of the order of its attributes
+    """
+    return hashlib.md5(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class _MemorySampler(threading.Thread):
+    """
+    Samples the memory traced by tracemalloc and keeps a snapshot taken near the peak.
+        A new snapshot is taken when the traced memory grows by more than growth times the last snapshot.
+    """
+    def __init__(self, interval=0.5, growth=1.1):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.growth = growth
+        self.snapshot = None
+        self.snapshot_bytes = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            current, _ = tracemalloc.get_traced_memory()
+            if current > self.snapshot_bytes * self.growth:
+                self.snapshot = tracemalloc.take_snapshot()
+                self.snapshot_bytes = current
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class MakeProfiler:
+    """
+    Runs make() calls under cProfile and tracemalloc and writes the profiles of calls over a threshold.
+    """
+    def __init__(self, profile_dir=None, min_seconds=60., min_peak_bytes=2 * 1024**3, trace_memory=True,
+                 sample_interval=0.5, n_frames=1, top_n=25):
+        """
+        :param profile_dir: (str or pathlib.Path) directory of the profiles. Defaults to MICRONS_PROFILE_DIR
+            or ~/.cache/microns-materialization/profiles.
+        :param min_seconds: (float) calls taking at least this wall time are written
+        :param min_peak_bytes: (int) calls whose traced memory peaks at least this high are written
+        :param trace_memory: (bool) trace allocations with tracemalloc. Python allocations get slower and use more memory.
+        :param sample_interval: (float) seconds between samples of the traced memory
+        :param n_frames: (int) frames of traceback stored per allocation by tracemalloc
+        :param top_n: (int) number of functions and allocation sites written to the .json file
+        """
+        self.profile_dir = Path(profile_dir) if profile_dir is not None else default_profile_dir
+        self.min_seconds = min_seconds
+        self.min_peak_bytes = min_peak_bytes
+        self.trace_memory = trace_memory
+        self.sample_interval = sample_interval
+        self.n_frames = n_frames
+        self.top_n = top_n
+        self.pod = os.getenv('HOSTNAME', socket.gethostname())
+        self._active = False
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(profile_dir={str(self.profile_dir)!r}, min_seconds={self.min_seconds}, min_peak_bytes={self.min_peak_bytes})'
+
+    def run(self, table_name, key, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) under the profilers and writes the profile if it is over a threshold or raises.
+            Calls nested in a profiled call are run as is.
+        """
+        if self._active:
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # another profiler is active in this thread
+            logger.warning(f'Could not profile {table_name} {key}: {e}')
+            return func(*args, **kwargs)
+        self._active = True
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(self.n_frames)
+        sampler = None
+        if self.trace_memory:
+            if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+                tracemalloc.reset_peak()
+            base_bytes, _ = tracemalloc.get_traced_memory()
+            sampler = _MemorySampler(self.sample_interval)
+            sampler.start()
+        ts = datetime.now()
+        start, cpu_start = time.perf_counter(), time.process_time()
+        error = None
+        try:
+            return func(*args, **kwargs)
+        except BaseException as e:
+            error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            profile.disable()
+            seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - cpu_start
+            peak_bytes, snapshot = 0, None
+            if sampler is not None:
+                sampler.stop()
+                peak_bytes = max(tracemalloc.get_traced_memory()[1] - base_bytes, 0)
+                snapshot = sampler.snapshot
+            if started_tracing:
+                tracemalloc.stop()
+            self._active = False
+            if seconds >= self.min_seconds or peak_bytes >= self.min_peak_bytes or error is not None:
+                try:
+                    self.write(table_name, key, ts, profile, snapshot, seconds=seconds, cpu_seconds=cpu_seconds, peak_bytes=peak_bytes, error=error)
+                except Exception as e:
+                    logger.warning(f'Could not write the profile of {table_name} {key}: {type(e).__name__}: {e}')
+
+    def _top_functions(self, profile):
+        stats = pstats.Stats(profile, stream=io.StringIO())
+        rows = []
+        for (filename, lineno, function), (_, n_calls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({'function': f'{filename}:{lineno}({function})', 'n_calls': n_calls, 'tottime': tottime, 'cumtime': cumtime})
+        return sorted(rows, key=lambda r: r['cumtime'], reverse=True)[:self.top_n]
+
+    def _top_allocations(self, snapshot):
+        if snapshot is None:
+            return []
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+        return [
+            {'line': str(stat.traceback), 'bytes': stat.size, 'count': stat.count}
+            for stat in snapshot.statistics('lineno')[:self.top_n]
+        ]
+
+    def write(self, table_name, key, ts, profile, snapshot=None, **summary):
+        """
+        Writes the .prof and .json files of a call.
+
+        :returns: pathlib.Path of the .json file
+        """
+        directory = self.profile_dir / table_name / key_hash(key)
+        directory.mkdir(parents=True, exist_ok=True)
+        stem = ts.strftime('%Y-%m-%d_%H:%M:%S.%f')
+        profile.dump_stats(directory / f'{stem}.prof')
+        info = {
+            'table_name': table_name,
+            'key': key,
+            'key_hash': key_hash(key),
+            'pod': self.pod,
+            'ts_profiled': ts.isoformat(),
+            **summary,
+            'top_functions': self._top_functions(profile),
+            'top_allocations': self._top_allocations(snapshot),
+            'profile_obj': str(directory / f'{stem}.prof'),
+        }
+        filepath = directory / f'{stem}.json'
+        filepath.write_text(json.dumps(info, default=str, indent=1))
+        logger.info(f'Wrote profile of {table_name} {key} ({summary["seconds"]:.1f} s, {summary["peak_bytes"] / 1024**2:.0f} MiB peak) to {filepath}.')
+        return filepath
+
+
+@contextlib.contextmanager
+def profiling(enabled=True, **kwargs):
+    """
+    Profiles the instrumented make() calls run in the block.
+
+    :param enabled: (bool) if False, the block runs without profiling, unless MICRONS_PROFILE is set
+    :param kwargs: passed to MakeProfiler
+    """
+    if not enabled:
+        yield None
+        return
+    profiler = MakeProfiler(**kwargs)
+    token = _current_profiler.set(profiler)
+    try:
+        yield profiler
+    finally:
+        _current_profiler.reset(token)
+
+
+def current_profiler():
+    """
+    :returns: the MakeProfiler of the enclosing profiling block, a MakeProfiler with default settings
+        if MICRONS_PROFILE is "true", or None
+    """
+    global _env_profiler
+    profiler = _current_profiler.get()
+    if profiler is not None:
+        return profiler
+    if os.getenv('MICRONS_PROFILE', 'false').lower() == 'true':
+        if _env_profiler is None:
+            _env_profiler = MakeProfiler(
+                min_seconds=float(os.getenv('MICRONS_PROFILE_MIN_SECONDS', 60)),
+                min_peak_bytes=float(os.getenv('MICRONS_PROFILE_MIN_PEAK_BYTES', 2 * 1024**3)),
+            )
+        return _env_profiler
+    return None
+
+
+def load_profiles(profile_dir=None, table_name=None):
+    """
+    Reads the .json files of a profile directory.
+
+    :param profile_dir: (str or pathlib.Path) defaults to default_profile_dir
+    :param table_name: (str) only profiles of this table, e.g. "Meshwork.PCGMeshworkMaker"
+
+    :returns: pandas.DataFrame with one row per profile, with columns table_name, key, key_hash, pod, ts_profiled,
+        seconds, cpu_seconds, peak_bytes, error and profile_obj
+    """
+    profile_dir = Path(profile_dir) if profile_dir is not None else default_profile_dir
+    pattern = f'{table_name}/*/*.json' if table_name is not None else '*/*/*.json'
+    rows = []
+    for filepath in profile_dir.glob(pattern):
+        try:
+            info = json.loads(filepath.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not read {filepath}: {type(e).__name__}: {e}')
+            continue
+        rows.append({k: v for k, v in info.items() if k not in ('top_functions', 'top_allocations')})
+    columns = ['table_name', 'key', 'key_hash', 'pod', 'ts_profiled', 'seconds', 'cpu_seconds', 'peak_bytes', 'error', 'profile_obj']
+    return pd.DataFrame(rows, columns=columns)
+
+
+def worst_keys(profiles, by='seconds', top=20):
+    """
+    :param profiles: pandas.DataFrame from load_profiles
+    :param by: (str) "seconds", "cpu_seconds" or "peak_bytes"
+    :param top: (int) number of keys
+
+    :returns: pandas.DataFrame of the top keys of each table by the max of a column over their profiles,
+        with the number of profiles and errors of each key
+    """
+    if not len(profiles):
+        return profiles
+    grouped = profiles.assign(key=profiles['key'].map(lambda k: json.dumps(k, sort_keys=True, default=str))).groupby(['table_name', 'key_hash', 'key'])
+    df = grouped.agg(
+        n_profiles=('ts_profiled', 'count'),
+        n_errors=('error', 'count'),
+        seconds=('seconds', 'max'),
+        cpu_seconds=('cpu_seconds', 'max'),
+        peak_bytes=('peak_bytes', 'max'),
+    ).reset_index()
+    return df.sort_values(by, ascending=False).groupby('table_name').head(top).reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    summary = subparsers.add_parser('summary', help='list the worst keys by time and by peak memory')
+    summary.add_argument('--profile-dir', help='defaults to MICRONS_PROFILE_DIR')
+    summary.add_argument('--table', help='only profiles of this table, e.g. Meshwork.PCGMeshworkMaker')
+    summary.add_argument('--top', type=int, default=20, help='number of keys per table')
+
+    stats = subparsers.add_parser('stats', help='print the cProfile stats of a profile')
+    stats.add_argument('filepath', help='.prof or .json file of a profile')
+    stats.add_argument('--sort', default='cumulative', help='pstats sort key')
+    stats.add_argument('--top', type=int, default=40, help='number of functions')
+
+    args = parser.parse_args()
+    pd.set_option('display.width', 250)
+    pd.set_option('display.max_colwidth', 120)
+    if args.command == 'summary':
+        profiles = load_profiles(args.profile_dir, args.table)
+        print(f'{len(profiles)} profiles.')
+        if len(profiles):
+            columns = ['table_name', 'key', 'n_profiles', 'n_errors', 'seconds', 'cpu_seconds', 'peak_bytes']
+            for by in ('seconds', 'peak_bytes'):
+                print(f'\nWorst keys by {by}:')
+                print(worst_keys(profiles, by=by, top=args.top)[columns].to_string(index=False))
+    elif args.command == 'stats':
+        filepath = Path(args.filepath)
+        if filepath.suffix == '.json':
+            filepath = Path(json.loads(filepath.read_text())['profile_obj'])
+        pstats.Stats(str(filepath)).sort_stats(args.sort).print_stats(args.top)
@@ -0,0 +1,234 @@
+"""
+Utils for rewriting existing HDF5 files with a different chunking and compression filter.
+
+Files compressed with blosc need the hdf5plugin package (pip install hdf5plugin) in every process that reads them.
+"""
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pandas as pd
+from datajoint.hash import uuid_from_file
+
+from .filepath_utils import pool_map
+
+logger = logging.getLogger(__name__)
+
+
+def compression_kwargs(compression='gzip', compression_opts=None, shuffle=True):
+    """
+    :param compression: (str) "gzip", "lzf", "blosc" or None
+    :param compression_opts: (int) gzip or blosc level. Defaults to 4 for gzip and 5 for blosc.
+    :param shuffle: (bool) apply the byte shuffle filter before compressing
+
+    :returns: dict of kwargs of h5py.Group.create_dataset
+    """
+    if compression is None:
+        return {}
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4 if compression_opts is None else compression_opts, 'shuffle': shuffle}
+    if compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': shuffle}
+    if compression == 'blosc':
+        import hdf5plugin
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=5 if compression_opts is None else compression_opts, shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+    raise ValueError(f'compression must be one of gzip, lzf, blosc or None, not {compression}.')
+
+
+def _is_pandas_group(group):
+    # tables written by pandas.to_hdf (meshwork annotations of version 1) are read with PyTables, which cannot read every filter
+    return 'pandas_type' in group.attrs
+
+
+def copy_h5(src, dst, compression='gzip', compression_opts=None, shuffle=True, chunk_rows=2**16, min_size=1024):
+    """
+    Copies all groups, datasets and attributes of an open HDF5 file into another, rewriting datasets with a new filter.
+
+    Scalar, string and object datasets, datasets with fewer than min_size elements and tables written by pandas are copied as is.
+
+    :param src: (h5py.Group) source file or group
+    :param dst: (h5py.Group) destination file or group
+    :param chunk_rows: (int) rows per chunk along the first axis
+    :param min_size: (int) datasets with fewer elements are not compressed
+    """
+    kwargs = compression_kwargs(compression, compression_opts, shuffle)
+    dst.attrs.update(src.attrs)
+    for name, obj in src.items():
+        if isinstance(obj, h5py.Group):
+            if _is_pandas_group(obj):
+                src.copy(obj, dst, name=name)
+            else:
+                copy_h5(obj, dst.create_group(name), compression, compression_opts, shuffle, chunk_rows, min_size)
+        elif obj.shape == () or obj.dtype.kind in 'OSUV' or obj.size < min_size:
+            src.copy(obj, dst, name=name)
+        else:
+            chunks = (min(chunk_rows, obj.shape[0]),) + obj.shape[1:] if kwargs else None
+            dataset = dst.create_dataset(name, data=obj[()], chunks=chunks, **kwargs)
+            dataset.attrs.update(obj.attrs)
+
+
+def _array_equal(a, b):
+    # NaN equals NaN, so float data with missing values compares equal to its copy
+    a, b = np.asarray(a), np.asarray(b)
+    return np.array_equal(a, b, equal_nan=a.dtype.kind in 'fc' and b.dtype.kind in 'fc')
+
+
+def _attrs_equal(a, b):
+    return set(a.attrs.keys()) == set(b.attrs.keys()) and all(_array_equal(a.attrs[key], b.attrs[key]) for key in a.attrs)
+
+
+def h5_equal(a, b):
+    """
+    :returns: (bool) True if two open HDF5 files or groups have the same groups, attributes and dataset values
+    """
+    if set(a.keys()) != set(b.keys()) or not _attrs_equal(a, b):
+        return False
+    for name, obj in a.items():
+        other = b[name]
+        if isinstance(obj, h5py.Group):
+            if not isinstance(other, h5py.Group) or not h5_equal(obj, other):
+                return False
+        elif not isinstance(other, h5py.Dataset) or obj.dtype != other.dtype or obj.shape != other.shape or not _attrs_equal(obj, other) or not _array_equal(obj[()], other[()]):
+            return False
+    return True
+
+
+def _read_mesh(filepath):
+    from .mesh_utils import load_trimesh
+    return load_trimesh(filepath, cache=None)
+
+
+def _read_meshwork(filepath):
+    from meshparty import meshwork
+    return meshwork.load_meshwork(filepath)
+
+
+def _read_pcg_skeleton(filepath):
+    from .meshwork_utils import load_pcg_skeleton
+    return load_pcg_skeleton(filepath, include_mesh_to_skel_map=True)
+
+
+# functions reading a file as the adapter of each store does, to measure read latency
+read_functions = {
+    'mesh': _read_mesh,
+    'meshwork': _read_meshwork,
+    'pcg_skeleton': _read_pcg_skeleton,
+}
+
+
+def _time_read(read_function, filepath, n_repeats):
+    if read_function is None:
+        return np.nan
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        read_functions[read_function](filepath)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def recompress_file(filepath, compression='gzip', compression_opts=None, shuffle=True, chunk_rows=2**16, min_size=1024,
+                    read_function=None, n_repeats=1, keep_larger=False, dry_run=False):
+    """
+    Rewrites an HDF5 file with a new filter and replaces it atomically, if the rewrite reads back identically.
+
+    The rewrite is written to a temporary file next to filepath, compared dataset by dataset with the original,
+        and moved over the original with os.replace, so readers see either the old or the new file.
+
+    :param filepath: (str or pathlib.Path) path to the HDF5 file
+    :param compression, compression_opts, shuffle: see compression_kwargs
+    :param chunk_rows, min_size: see copy_h5
+    :param read_function: (str) key of read_functions, to measure the read time before and after
+    :param n_repeats: (int) number of reads timed. The min time is reported.
+    :param keep_larger: (bool) replace the file even if the rewrite is larger
+    :param dry_run: (bool) rewrite and verify, but keep the original
+
+    :returns: dict with filepath, status ("replaced", "larger", "dry_run", "mismatch" or "error"), bytes_before, bytes_after,
+        read_s_before, read_s_after, contents_hash (uuid of the new file, None if not replaced) and error
+    """
+    filepath = Path(filepath)
+    tmp_filepath = filepath.with_name(f'.{filepath.name}.{uuid.uuid4().hex}.tmp')
+    result = {'filepath': str(filepath), 'status': 'error', 'bytes_before': np.nan, 'bytes_after': np.nan,
+              'read_s_before': np.nan, 'read_s_after': np.nan, 'contents_hash': None, 'error': None}
+    try:
+        result['bytes_before'] = os.path.getsize(filepath)
+        with h5py.File(filepath, 'r') as src, h5py.File(tmp_filepath, 'w') as dst:
+            copy_h5(src, dst, compression, compression_opts, shuffle, chunk_rows, min_size)
+        with h5py.File(filepath, 'r') as a, h5py.File(tmp_filepath, 'r') as b:
+            if not h5_equal(a, b):
+                result['status'] = 'mismatch'
+                return result
+        result['bytes_after'] = os.path.getsize(tmp_filepath)
+        result['read_s_before'] = _time_read(read_function, filepath, n_repeats)
+        result['read_s_after'] = _time_read(read_function, tmp_filepath, n_repeats)
+        if dry_run:
+            result['status'] = 'dry_run'
+        elif result['bytes_after'] >= result['bytes_before'] and not keep_larger:
+            result['status'] = 'larger'
+        else:
+            os.chmod(tmp_filepath, os.stat(filepath).st_mode)
+            result['contents_hash'] = uuid_from_file(tmp_filepath)
+            os.replace(tmp_filepath, filepath)
+            result['status'] = 'replaced'
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        tmp_filepath.unlink(missing_ok=True)
+    return result
+
+
+def _recompress_file(args):
+    filepath, kwargs = args
+    return recompress_file(filepath, **kwargs)
+
+
+def recompress_files(filepaths, n_workers=None, **kwargs):
+    """
+    Runs recompress_file on many files in a process pool.
+
+    :param filepaths: (list) paths to the HDF5 files
+    :param n_workers: (int) number of worker processes. Defaults to the number of CPUs.
+    :param kwargs: passed to recompress_file
+
+    :returns: pandas.DataFrame with one row per file, in the order of filepaths
+    """
+    args = [(filepath, kwargs) for filepath in filepaths]
+    return pd.DataFrame(pool_map(_recompress_file, args, n_workers=n_workers))
+
+
+def update_external_contents(external, report):
+    """
+    Updates size and contents_hash of the external rows of replaced files, so DataJoint fetches pass their checksum.
+
+    :param external: DataJoint external table of the store
+    :param report: pandas.DataFrame from recompress_files with a hash column of the external rows
+    """
+    replaced = report[report['status'] == 'replaced']
+    if not len(replaced):
+        return
+    cases = ' '.join(['WHEN %s THEN %s'] * len(replaced))
+    with external.connection.transaction:
+        external.connection.query(
+            f'UPDATE {external.full_table_name} SET size = CASE hash {cases} END, contents_hash = CASE hash {cases} END '
+            f'WHERE hash IN ({",".join(["%s"] * len(replaced))})',
+            args=[v for h, size in zip(replaced['hash'], replaced['bytes_after']) for v in (h.bytes, int(size))]
+            + [v for h, contents_hash in zip(replaced['hash'], replaced['contents_hash']) for v in (h.bytes, contents_hash.bytes)]
+            + [h.bytes for h in replaced['hash']]
+        )
+
+
+def summarize(report):
+    """
+    :returns: pandas.DataFrame with the number of files, total bytes and total read time before and after, per status
+    """
+    return report.groupby('status').agg(
+        n_files=('filepath', 'count'),
+        bytes_before=('bytes_before', 'sum'),
+        bytes_after=('bytes_after', 'sum'),
+        read_s_before=('read_s_before', 'sum'),
+        read_s_after=('read_s_after', 'sum'),
+    )
@@ -0,0 +1,275 @@
+"""
+Utils for spatial indexing of 3D points.
+"""
+import os
+import tempfile
+from functools import cached_property
+
+import numpy as np
+
+from .connectivity_utils import load_npz_mmap
+
+# EM voxel resolution in nm (x: 4nm, y: 4nm, z: 40nm)
+VOXEL_RESOLUTION = np.array([4, 4, 40])
+
+
+def voxels_to_nm(xyz, resolution=VOXEL_RESOLUTION):
+    """
+    Converts EM voxel coordinates to nm, which makes distances isotropic.
+
+    :param xyz: (array-like) (n, 3) or (3,) coordinates in EM voxels
+    :param resolution: (array-like) voxel size in nm
+
+    :returns: numpy array of coordinates in nm
+    """
+    return np.asarray(xyz, dtype=np.float64) * np.asarray(resolution, dtype=np.float64)
+
+
+def _concatenate_ranges(starts, ends):
+    """
+    :returns: numpy array of all integers in the half-open ranges [starts[i], ends[i])
+    """
+    lengths = ends - starts
+    if lengths.sum() == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - offsets, lengths)
+
+
+class GridIndex:
+    """
+    Uniform grid index over 3D points in nm.
+
+    Points are sorted by grid cell (C-order, z fastest), so the points of a run of cells along z are one
+        contiguous slice of the arrays. This lets the index be memory mapped from disk and queried without
+        loading it.
+
+    Indexes with at most kdtree_max_points points (e.g. nuclei) are small enough to load, and radius and kNN
+        queries on them are answered for the whole batch at once by a KD-tree built on first use.
+    """
+    kdtree_max_points = 5_000_000
+    def __init__(self, arrays):
+        """
+        :param arrays: (dict) arrays as written by GridIndex.build:
+            ids: (n,) id of each point
+            points: (n, 3) float32 coordinates of each point in nm
+            offsets: (n_cells + 1,) start of each cell in ids and points
+            origin: (3,) lower corner of the grid in nm
+            cell_size: (3,) size of a cell in nm
+            shape: (3,) number of cells along each axis
+        """
+        self.arrays = arrays
+        self.ids = arrays['ids']
+        self.points = arrays['points']
+        self.offsets = arrays['offsets']
+        self.origin = np.asarray(arrays['origin'], dtype=np.float64)
+        self.cell_size = np.asarray(arrays['cell_size'], dtype=np.float64)
+        self.shape = np.asarray(arrays['shape'], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, filepath):
+        return cls(load_npz_mmap(filepath))
+
+    @classmethod
+    def build(cls, filepath, iter_chunks, bounds, cell_size=10_000, tmp_dir=None):
+        """
+        Builds a grid index in two passes over the points and writes it to an uncompressed .npz file.
+
+        Only one chunk of points is held in memory at a time; the sorted arrays are filled in
+            temporary memory-mapped files.
+
+        :param filepath: (str or pathlib.Path) path of the .npz file to write
+        :param iter_chunks: callable that returns an iterator of (ids, points) chunks, where points are (n, 3) in nm.
+            It is called twice and must yield the same points both times (in any order).
+        :param bounds: (array-like) (2, 3) lower and upper corner of all points in nm
+        :param cell_size: (float or array-like) size of a grid cell in nm
+        :param tmp_dir: (str or pathlib.Path) directory for the temporary files. Defaults to the directory of filepath.
+
+        :returns: GridIndex memory mapped from filepath
+        """
+        bounds = np.asarray(bounds, dtype=np.float64)
+        cell_size = np.broadcast_to(np.asarray(cell_size, dtype=np.float64), (3,))
+        origin = bounds[0]
+        shape = np.maximum(np.ceil((bounds[1] - origin) / cell_size).astype(np.int64), 1)
+        n_cells = int(np.prod(shape))
+
+        def cells(points):
+            xyz = np.clip(np.floor((points - origin) / cell_size).astype(np.int64), 0, shape - 1)
+            return np.ravel_multi_index(xyz.T, shape)
+
+        # pass 1: count points per cell
+        counts = np.zeros(n_cells, dtype=np.int64)
+        for _, points in iter_chunks():
+            counts += np.bincount(cells(np.asarray(points, dtype=np.float64)), minlength=n_cells)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        n = int(offsets[-1])
+
+        # pass 2: scatter each chunk into the sorted position of its cells
+        tmp_dir = os.path.dirname(os.path.abspath(filepath)) if tmp_dir is None else tmp_dir
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as d:
+            ids_out = np.lib.format.open_memmap(os.path.join(d, 'ids.npy'), mode='w+', dtype=np.uint64, shape=(n,))
+            points_out = np.lib.format.open_memmap(os.path.join(d, 'points.npy'), mode='w+', dtype=np.float32, shape=(n, 3))
+            filled = offsets[:-1].copy()
+            for ids, points in iter_chunks():
+                points = np.asarray(points, dtype=np.float64)
+                cell = cells(points)
+                order = np.argsort(cell, kind='stable')
+                cell = cell[order]
+                # position of each point within its cell for this chunk
+                first = np.searchsorted(cell, cell, side='left')
+                positions = filled[cell] + np.arange(len(cell)) - first
+                ids_out[positions] = np.asarray(ids, dtype=np.uint64)[order]
+                points_out[positions] = points[order]
+                filled += np.bincount(cell, minlength=n_cells)
+            ids_out.flush()
+            points_out.flush()
+            np.savez(
+                filepath,
+                ids=ids_out,
+                points=points_out,
+                offsets=offsets,
+                origin=origin,
+                cell_size=cell_size,
+                shape=shape
+            )
+            del ids_out, points_out
+        return cls.load(filepath)
+
+    @cached_property
+    def kdtree(self):
+        from scipy.spatial import cKDTree
+        return cKDTree(np.asarray(self.points))
+
+    @property
+    def use_kdtree(self):
+        return len(self) <= self.kdtree_max_points
+
+    def _box_indices(self, lo, hi):
+        """
+        :returns: indices of the points in the cells that overlap the box [lo, hi]
+        """
+        if np.any(hi < self.origin) or np.any(lo > self.origin + self.shape * self.cell_size):
+            return np.zeros(0, dtype=np.int64)
+        # clip before casting so unbounded boxes (e.g. a column with y from -inf to inf) are allowed
+        c0 = np.clip(np.floor((lo - self.origin) / self.cell_size), 0, self.shape - 1).astype(np.int64)
+        c1 = np.clip(np.floor((hi - self.origin) / self.cell_size), 0, self.shape - 1).astype(np.int64)
+        if np.any(c1 < c0):
+            return np.zeros(0, dtype=np.int64)
+        ix, iy = np.meshgrid(np.arange(c0[0], c1[0] + 1), np.arange(c0[1], c1[1] + 1), indexing='ij')
+        column = (ix.ravel() * self.shape[1] + iy.ravel()) * self.shape[2]
+        return _concatenate_ranges(np.asarray(self.offsets[column + c0[2]]), np.asarray(self.offsets[column + c1[2] + 1]))
+
+    def _covers_grid(self, lo, hi):
+        return np.all(lo <= self.origin) and np.all(hi >= self.origin + self.shape * self.cell_size)
+
+    def query_box(self, lo, hi):
+        """
+        Finds the points inside axis-aligned boxes.
+
+        :param lo: (array-like) (m, 3) or (3,) lower corners of the boxes in nm
+        :param hi: (array-like) (m, 3) or (3,) upper corners of the boxes in nm
+
+        :returns: list of m arrays of ids
+        """
+        lo, hi = np.atleast_2d(lo).astype(np.float64), np.atleast_2d(hi).astype(np.float64)
+        results = []
+        for l, h in zip(lo, hi):
+            idx = self._box_indices(l, h)
+            points = self.points[idx]
+            inside = np.all((points >= l) & (points <= h), axis=1)
+            results.append(np.asarray(self.ids[idx[inside]]))
+        return results
+
+    def query_radius(self, centers, radius, return_distances=False):
+        """
+        Finds the points within a radius of each center.
+
+        :param centers: (array-like) (m, 3) or (3,) centers in nm
+        :param radius: (float or array-like) radius in nm, per center or for all centers
+        :param return_distances: (bool) also return the distance of each point, sorted by distance
+
+        :returns: list of m arrays of ids (and list of m arrays of distances in nm)
+        """
+        centers = np.atleast_2d(centers).astype(np.float64)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(centers),))
+        if self.use_kdtree:
+            neighbors = self.kdtree.query_ball_point(centers, radius)
+        results, distances = [], []
+        for i, (c, r) in enumerate(zip(centers, radius)):
+            idx = np.asarray(neighbors[i], dtype=np.int64) if self.use_kdtree else self._box_indices(c - r, c + r)
+            d = np.linalg.norm(self.points[idx] - c, axis=1)
+            inside = d <= r
+            idx, d = idx[inside], d[inside]
+            if return_distances:
+                order = np.argsort(d)
+                idx, d = idx[order], d[order]
+                distances.append(d)
+            results.append(np.asarray(self.ids[idx]))
+        return (results, distances) if return_distances else results
+
+    def query_knn(self, centers, k=1):
+        """
+        Finds the k nearest points of each center.
+
+        The search box around each center starts at one cell and doubles until it holds k points that are
+            closer than its half-width, which guarantees they are the k nearest.
+
+        :param centers: (array-like) (m, 3) or (3,) centers in nm
+        :param k: (int) number of neighbors
+
+        :returns: ids (m, k) and distances in nm (m, k), sorted by distance.
+            If the index has fewer than k points, missing neighbors have id 0 and distance inf.
+        """
+        centers = np.atleast_2d(centers).astype(np.float64)
+        if self.use_kdtree:
+            distances, idx = self.kdtree.query(centers, k=k)
+            distances, idx = distances.reshape(len(centers), k), idx.reshape(len(centers), k)
+            found = idx < len(self)
+            ids = np.zeros((len(centers), k), dtype=np.uint64)
+            ids[found] = self.ids[idx[found]]
+            return ids, distances
+
+        ids = np.zeros((len(centers), k), dtype=np.uint64)
+        distances = np.full((len(centers), k), np.inf)
+        for i, c in enumerate(centers):
+            r = self.cell_size.max()
+            while True:
+                idx = self._box_indices(c - r, c + r)
+                d = np.linalg.norm(self.points[idx] - c, axis=1)
+                if (len(d) >= k and np.partition(d, k - 1)[k - 1] <= r) or self._covers_grid(c - r, c + r):
+                    break
+                r *= 2
+            order = np.argsort(d)[:k]
+            ids[i, :len(order)] = self.ids[idx[order]]
+            distances[i, :len(order)] = d[order]
+        return ids, distances
+
+    def count_radius(self, centers, radius):
+        """
+        Counts the points within a radius of each center.
+
+        :param centers: (array-like) (m, 3) or (3,) centers in nm
+        :param radius: (float or array-like) radius in nm, per center or for all centers
+
+        :returns: numpy array of m counts
+        """
+        if self.use_kdtree:
+            centers = np.atleast_2d(centers).astype(np.float64)
+            radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(centers),))
+            return np.asarray(self.kdtree.query_ball_point(centers, radius, return_length=True))
+        return np.array([len(ids) for ids in self.query_radius(centers, radius)])
+
+    def density(self, centers, radius):
+        """
+        Density of points in a sphere around each center.
+
+        :param centers: (array-like) (m, 3) or (3,) centers in nm
+        :param radius: (float or array-like) radius of the sphere in nm
+
+        :returns: numpy array of m densities in points per mm^3
+        """
+        volume_mm3 = 4 / 3 * np.pi * (np.asarray(radius, dtype=np.float64) * 1e-6) ** 3
+        return self.count_radius(centers, radius) / volume_mm3
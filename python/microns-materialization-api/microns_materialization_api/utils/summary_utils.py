@@ -0,0 +1,33 @@
+"""
+Utils for topping up tables of per-segment summary statistics.
+"""
+import numpy as np
+
+
+def rows_to_write(df, existing, nullable_attrs, presence_attrs, key='segment_id', refresh_incomplete=True):
+    """
+    Selects the rows of freshly computed summaries that are new or replace an incomplete existing row.
+
+    An existing row is incomplete if one of nullable_attrs is NULL or one of presence_attrs is 0. It is replaced
+        only if the fresh row differs from it in one of these attributes, so rows whose sources are still
+        missing are not rewritten on every run.
+
+    :param df: (pandas.DataFrame) freshly computed summaries with key, nullable_attrs and presence_attrs columns
+    :param existing: (pandas.DataFrame) rows already in the table, with the same columns
+    :param nullable_attrs: (list) attributes that are NULL while their source is missing
+    :param presence_attrs: (list) 0/1 attributes that are 0 while their source is missing
+    :param key: (str) attribute identifying a row
+    :param refresh_incomplete: (bool) if False, only new rows are selected
+
+    :returns: two boolean numpy arrays aligned with df: is_new and is_updated
+    """
+    attrs = list(nullable_attrs) + list(presence_attrs)
+    existing = existing.set_index(key)[attrs]
+    is_new = ~df[key].isin(existing.index).values
+    is_updated = np.zeros(len(df), dtype=bool)
+    if refresh_incomplete:
+        incomplete = existing[existing[list(nullable_attrs)].isna().any(axis=1) | (existing[list(presence_attrs)] == 0).any(axis=1)]
+        candidates = df[df[key].isin(incomplete.index)].set_index(key)[attrs]
+        same = candidates.fillna(-1).astype(float).values == incomplete.loc[candidates.index].fillna(-1).astype(float).values
+        is_updated = df[key].isin(candidates.index[~same.all(axis=1)]).values
+    return is_new, is_updated
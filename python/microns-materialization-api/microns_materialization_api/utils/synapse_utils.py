@@ -0,0 +1,51 @@
+"""
+Utils for working with synapse tables.
+"""
+import numpy as np
+import pandas as pd
+
+
+def to_pre_post(df, primary_seg_ids):
+    """
+    Converts rows of Synapse.Info2 to one row per synapse with presynaptic and postsynaptic segment ids.
+
+    Synapse.Info2 stores each synapse once per primary segment, so a synapse between two primary segments
+        appears twice: as "presyn" under its presynaptic segment and as "postsyn" under its postsynaptic segment.
+        The "postsyn" copy is dropped when the presynaptic segment is itself a primary segment, which keeps
+        exactly one row per synapse without needing the other copy to be in the same chunk.
+
+    :param df: (pandas.DataFrame) rows of Synapse.Info2 with at least primary_seg_id, secondary_seg_id and prepost
+    :param primary_seg_ids: (array-like) all primary_seg_id values imported for the version
+
+    :returns: pandas.DataFrame with pre_seg_id and post_seg_id in place of primary_seg_id, secondary_seg_id and prepost
+    """
+    is_pre = (df['prepost'] == 'presyn').values
+    primary = df['primary_seg_id'].values
+    secondary = df['secondary_seg_id'].values
+    df = df.assign(
+        pre_seg_id=np.where(is_pre, primary, secondary),
+        post_seg_id=np.where(is_pre, secondary, primary)
+    )
+    keep = is_pre | ~np.isin(df['pre_seg_id'].values, np.asarray(primary_seg_ids, dtype=df['pre_seg_id'].dtype))
+    return df[keep].drop(columns=['primary_seg_id', 'secondary_seg_id', 'prepost'])
+
+
+def to_primary_secondary(df, primary_seg_ids):
+    """
+    Converts rows with one row per synapse to the layout of Synapse.Info2, with one row per synapse and primary segment.
+
+    The inverse of to_pre_post: a synapse is listed as "presyn" under its presynaptic segment and as "postsyn" under 
+        its postsynaptic segment, for each of them that is a primary segment.
+
+    :param df: (pandas.DataFrame) rows with at least pre_seg_id and post_seg_id
+    :param primary_seg_ids: (array-like) primary segment ids to list synapses under
+
+    :returns: pandas.DataFrame with primary_seg_id, secondary_seg_id and prepost in place of pre_seg_id and post_seg_id
+    """
+    dtype = df['pre_seg_id'].dtype
+    primary_seg_ids = np.asarray(primary_seg_ids, dtype=dtype)
+    df_pre = df[np.isin(df['pre_seg_id'].values, primary_seg_ids)].rename(columns={'pre_seg_id': 'primary_seg_id', 'post_seg_id': 'secondary_seg_id'})
+    df_pre['prepost'] = 'presyn'
+    df_post = df[np.isin(df['post_seg_id'].values, primary_seg_ids)].rename(columns={'post_seg_id': 'primary_seg_id', 'pre_seg_id': 'secondary_seg_id'})
+    df_post['prepost'] = 'postsyn'
+    return pd.concat([df_pre, df_post], axis=0, ignore_index=True)
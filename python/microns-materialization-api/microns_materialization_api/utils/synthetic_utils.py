@@ -0,0 +1,248 @@
+"""
+Utils for generating synthetic CAVE tables, meshes, skeletons and meshwork objects, for benchmarks that run without CAVE or cloud-volume.
+
+Sizes are drawn from log-normal distributions with medians of the order of minnie65 neurons (see size_distributions),
+    so files have realistic sizes and compressibility: vertices follow random walks along a branching tree, as neurites do,
+    and faces connect nearby vertices.
+
+meshparty is imported inside the functions that build its objects.
+"""
+import numpy as np
+import pandas as pd
+
+from .mesh_utils import write_mesh_h5
+
+# voxel resolution in nm of the positions in CAVE tables
+voxel_resolution = np.array([4, 4, 40])
+
+# size distributions as (median, sigma of the log, min, max)
+size_distributions = {
+    'mesh_vertices': (1_000_000, 0.8, 10_000, 10_000_000), # full resolution meshes downloaded by meshparty
+    'skeleton_vertices': (15_000, 0.7, 500, 200_000), # pcg_skel skeletons
+    'level2_vertices': (40_000, 0.7, 1_000, 500_000), # level 2 graphs, the meshes of pcg_skel meshwork objects
+    'presyn': (300, 1.0, 1, 20_000), # output synapses of a neuron
+    'postsyn': (2_000, 0.6, 1, 30_000), # input synapses of a neuron
+}
+
+
+def lognormal_sizes(n, median, sigma, min_size=1, max_size=None, rng=None):
+    """
+    :param n: (int) number of sizes
+    :param median: (float) median size
+    :param sigma: (float) standard deviation of the log of the sizes
+    :param min_size, max_size: (int) sizes are clipped to this range
+
+    :returns: (n,) int64 array
+    """
+    rng = np.random.default_rng(rng)
+    sizes = np.round(rng.lognormal(np.log(median), sigma, n))
+    return np.clip(sizes, min_size, max_size).astype(np.int64)
+
+
+def sample_sizes(name, n, scale=1., rng=None):
+    """
+    Draws n sizes of a distribution of size_distributions, with the median and bounds multiplied by scale.
+
+    :returns: (n,) int64 array
+    """
+    median, sigma, min_size, max_size = size_distributions[name]
+    return lognormal_sizes(n, median * scale, sigma, max(1, int(min_size * scale)), max(1, int(max_size * scale)), rng=rng)
+
+
+def random_tree(n_vertices, branch_probability=0.01, step=500., origin=None, rng=None):
+    """
+    Grows a tree by random walks: each vertex continues from the previous one, or with branch_probability starts
+        a new branch from a random earlier vertex. Vertex 0 is the root.
+
+    :param n_vertices: (int) number of vertices
+    :param branch_probability: (float) probability of a new branch per vertex
+    :param step: (float) length of each step in nm
+    :param origin: (array-like) position of the root in nm. Defaults to the origin.
+
+    :returns: vertices (n, 3) float64 in nm, edges (n - 1, 2) int64 as (child, parent) and parents (n,) int64 (-1 for the root)
+    """
+    rng = np.random.default_rng(rng)
+    n_vertices = max(int(n_vertices), 1)
+    parents = np.arange(-1, n_vertices - 1)
+    branches = np.flatnonzero(rng.random(n_vertices) < branch_probability)
+    branches = branches[branches > 1]
+    parents[branches] = (rng.random(len(branches)) * branches).astype(np.int64)
+
+    # directions change slowly along a branch, so neurites are smooth
+    directions = rng.normal(size=(n_vertices, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    vertices = np.zeros((n_vertices, 3))
+    heading = np.zeros((n_vertices, 3))
+    for i in range(1, n_vertices):
+        h = heading[parents[i]] * 0.9 + directions[i] * 0.3
+        heading[i] = h / np.linalg.norm(h)
+        vertices[i] = vertices[parents[i]] + heading[i] * step
+    if origin is not None:
+        vertices += np.asarray(origin, dtype=float)
+    edges = np.stack([np.arange(1, n_vertices), parents[1:]], axis=1)
+    return vertices, edges, parents
+
+
+def subtree_mask(parents, vertex):
+    """
+    :returns: (n,) bool array, True on vertex and its descendants. Parents must precede their children.
+    """
+    mask = np.zeros(len(parents), dtype=bool)
+    mask[vertex] = True
+    for i in range(vertex + 1, len(parents)):
+        mask[i] = mask[parents[i]]
+    return mask
+
+
+def axon_vertex(parents, fraction=0.3):
+    """
+    :returns: (int) the non-root vertex whose subtree size is closest to fraction of the tree, used as the base of the axon
+    """
+    sizes = np.ones(len(parents), dtype=np.int64)
+    for i in range(len(parents) - 1, 0, -1):
+        sizes[parents[i]] += sizes[i]
+    if len(parents) < 2:
+        return 0
+    return int(np.argmin(np.abs(sizes[1:] - fraction * len(parents)))) + 1
+
+
+def synthetic_mesh(n_vertices, origin=None, radius=300., rng=None):
+    """
+    Generates a tube-like mesh around a random tree.
+
+    :param n_vertices: (int) number of vertices
+    :param origin: (array-like) position in nm of the root of the tree
+    :param radius: (float) radius in nm of the tube
+
+    :returns: vertices (n, 3) float64 in nm and faces (about 2n, 3) int64
+    """
+    rng = np.random.default_rng(rng)
+    n_vertices = max(int(n_vertices), 3)
+    ring = 8
+    centers, _, _ = random_tree(max(n_vertices // ring, 1), step=radius, origin=origin, rng=rng)
+    offsets = rng.normal(scale=radius, size=(len(centers) * ring, 3))
+    vertices = (np.repeat(centers, ring, axis=0) + offsets)[:n_vertices]
+    # faces connect vertices of the same and of the next ring, so they are local like those of real meshes
+    first = np.arange(n_vertices - 2)
+    faces = np.concatenate([
+        np.stack([first, first + 1, first + 2], axis=1),
+        np.stack([first, np.minimum(first + ring, n_vertices - 1), first + 1], axis=1),
+    ])
+    return vertices, faces
+
+
+def write_synthetic_mesh(filepath, n_vertices, origin=None, rng=None, **kwargs):
+    """
+    Writes a synthetic mesh to a mesh .h5 file in the layout of meshparty (see mesh_utils.write_mesh_h5).
+
+    :param kwargs: passed to write_mesh_h5, e.g. compression
+    """
+    vertices, faces = synthetic_mesh(n_vertices, origin=origin, rng=rng)
+    write_mesh_h5(filepath, vertices, faces, **kwargs)
+
+
+def synthetic_skeleton(n_vertices, n_mesh_vertices=None, origin=None, rng=None):
+    """
+    Generates a skeleton as returned by pcg_skel.pcg_skeleton.
+
+    :param n_vertices: (int) number of skeleton vertices
+    :param n_mesh_vertices: (int) length of mesh_to_skel_map. Defaults to 3 * n_vertices.
+    :param origin: (array-like) position in nm of the root
+
+    :returns: meshparty.skeleton.Skeleton and the parents of its vertices (see random_tree)
+    """
+    from meshparty.skeleton import Skeleton
+    rng = np.random.default_rng(rng)
+    vertices, edges, parents = random_tree(n_vertices, origin=origin, rng=rng)
+    n_mesh_vertices = 3 * len(vertices) if n_mesh_vertices is None else n_mesh_vertices
+    mesh_to_skel_map = np.sort(rng.integers(0, len(vertices), n_mesh_vertices))
+    skeleton = Skeleton(vertices, edges, root=0, mesh_to_skel_map=mesh_to_skel_map, radius=rng.uniform(100, 1000, len(vertices)))
+    return skeleton, parents
+
+
+def synthetic_meshwork(segment_id, n_vertices, pre_syn=None, post_syn=None, origin=None, rng=None):
+    """
+    Generates a meshwork object as returned by pcg_skel.pcg_meshwork, with a skeleton and pre_syn and post_syn annotations.
+
+    Synapses are moved onto the skeleton: presynaptic ones onto the axon (a subtree of about 30% of the vertices) and
+        postsynaptic ones onto the rest, so split_axon_by_synapses finds a clean split.
+
+    :param segment_id: (int) segment id
+    :param n_vertices: (int) number of skeleton vertices, which are also the mesh vertices
+    :param pre_syn, post_syn: (pandas.DataFrame) synapses of the segment with a ctr_pt_position column in voxels
+    :param origin: (array-like) position in nm of the root
+
+    :returns: meshparty.meshwork.Meshwork
+    """
+    from meshparty.meshwork import Meshwork
+    rng = np.random.default_rng(rng)
+    skeleton, parents = synthetic_skeleton(n_vertices, n_mesh_vertices=n_vertices, origin=origin, rng=rng)
+    is_axon = subtree_mask(parents, axon_vertex(parents))
+    nrn = Meshwork(skeleton=skeleton, seg_id=segment_id, voxel_resolution=voxel_resolution)
+    for name, df, on_axon in (('pre_syn', pre_syn, True), ('post_syn', post_syn, False)):
+        df = pd.DataFrame({'ctr_pt_position': []}) if df is None else df.copy()
+        candidates = np.flatnonzero(is_axon == on_axon)
+        if not len(candidates):
+            candidates = np.arange(len(is_axon))
+        positions = skeleton.vertices[rng.choice(candidates, len(df))] / voxel_resolution
+        df['ctr_pt_position'] = list(positions)
+        nrn.add_annotations(name, df, point_column='ctr_pt_position', anchored=True)
+    return nrn
+
+
+def nucleus_table(n_nuclei, unassigned_fraction=0.05, first_segment_id=864691135000000000, rng=None):
+    """
+    Generates a table like the CAVE table nucleus_detection_v0.
+
+    :param n_nuclei: (int) number of nuclei
+    :param unassigned_fraction: (float) fraction of nuclei with pt_root_id 0, as nuclei outside of any segment
+    :param first_segment_id: (int) segment ids are drawn above this value
+
+    :returns: pandas.DataFrame with columns id, valid, pt_root_id, pt_supervoxel_id, pt_position (arrays in voxels) and volume
+    """
+    rng = np.random.default_rng(rng)
+    segment_ids = first_segment_id + rng.choice(10 * n_nuclei + 1, n_nuclei, replace=False).astype(np.int64) * 1000
+    segment_ids[rng.random(n_nuclei) < unassigned_fraction] = 0
+    positions = rng.uniform([60_000, 40_000, 15_000], [400_000, 240_000, 27_000], size=(n_nuclei, 3)).astype(np.int64)
+    return pd.DataFrame({
+        'id': np.arange(1, n_nuclei + 1, dtype=np.int64) * 7,
+        'valid': True,
+        'pt_root_id': segment_ids,
+        'pt_supervoxel_id': 88000000000000000 + rng.integers(0, 10**15, n_nuclei),
+        'pt_position': list(positions),
+        'volume': rng.lognormal(np.log(250), 0.3, n_nuclei),
+    })
+
+
+def synapse_table(segment_ids, scale=1., partner_fraction=0.1, rng=None):
+    """
+    Generates a table like the CAVE table synapses_pni_2 for the given segments.
+
+    Each segment gets presynaptic and postsynaptic synapses with sizes from size_distributions. Partners are other segments
+        of segment_ids with probability partner_fraction, and otherwise segments without a nucleus.
+
+    :param segment_ids: (array-like) segment ids, e.g. the pt_root_id of a nucleus table
+    :param scale: (float) multiplies the median numbers of synapses
+
+    :returns: pandas.DataFrame with columns id, valid, pre_pt_root_id, post_pt_root_id, ctr_pt_position (arrays in voxels) and size
+    """
+    rng = np.random.default_rng(rng)
+    segment_ids = np.unique(np.asarray(segment_ids, dtype=np.int64))
+    segment_ids = segment_ids[segment_ids != 0]
+    n_pre = sample_sizes('presyn', len(segment_ids), scale=scale, rng=rng)
+    n_post = sample_sizes('postsyn', len(segment_ids), scale=scale, rng=rng)
+    primary = np.concatenate([np.repeat(segment_ids, n_pre), np.repeat(segment_ids, n_post)])
+    is_pre = np.concatenate([np.ones(n_pre.sum(), dtype=bool), np.zeros(n_post.sum(), dtype=bool)])
+    partners = 864691136000000000 + rng.integers(0, 10**9, len(primary)) * 1000
+    in_segments = rng.random(len(primary)) < partner_fraction
+    if len(segment_ids):
+        partners[in_segments] = rng.choice(segment_ids, in_segments.sum())
+    positions = rng.uniform([60_000, 40_000, 15_000], [400_000, 240_000, 27_000], size=(len(primary), 3)).astype(np.int64)
+    return pd.DataFrame({
+        'id': rng.permutation(len(primary)).astype(np.int64) + 1,
+        'valid': True,
+        'pre_pt_root_id': np.where(is_pre, primary, partners),
+        'post_pt_root_id': np.where(is_pre, partners, primary),
+        'ctr_pt_position': list(positions),
+        'size': rng.lognormal(np.log(5_000), 1., len(primary)).astype(np.int64),
+    })
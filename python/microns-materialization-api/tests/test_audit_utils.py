@@ -0,0 +1,88 @@
+"""
+Tests of utils.audit_utils on a small store in a temporary directory.
+"""
+import os
+import time
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+pd = pytest.importorskip('pandas')
+audit_utils = pytest.importorskip('microns_materialization_api.utils.audit_utils')
+
+
+class FakeExternal:
+    """
+    Stands in for a DataJoint external table: rows of (hash, filepath), of which the hashes in used are referenced.
+    """
+    store = 'test'
+
+    def __init__(self, stage, rows, used):
+        self.spec = {'stage': str(stage)}
+        self.rows = pd.DataFrame(rows, columns=['hash', 'filepath']).set_index('hash')
+        self.used_hashes = used
+
+    def fetch(self, *attrs, format=None):
+        return self.rows
+
+    def used(self):
+        external = FakeExternal(self.spec['stage'], [], [])
+        external.fetch = lambda *attrs, **kwargs: np.array(self.used_hashes)
+        return external
+
+
+@pytest.fixture
+def store(tmp_path):
+    (tmp_path / 'ab' / 'cd').mkdir(parents=True)
+    (tmp_path / '.quarantine').mkdir()
+    with h5py.File(tmp_path / 'ab' / 'ok.h5', 'w') as f:
+        f.create_dataset('vertices', data=np.zeros((4, 3)))
+    np.savez(tmp_path / 'ab' / 'cd' / 'ok.npz', edges=np.zeros((2, 2)))
+    (tmp_path / 'ab' / 'cd' / 'corrupt.h5').write_bytes(b'\x89HDF\r\n\x1a\n truncated')
+    (tmp_path / 'orphan.h5').write_bytes(b'')
+    (tmp_path / 'unused.h5').write_bytes(b'')
+    (tmp_path / 'new.h5').write_bytes(b'')
+    (tmp_path / '.quarantine' / 'old.h5').write_bytes(b'')
+    old = time.time() - 2 * 24 * 3600
+    for filepath in ['ab/ok.h5', 'ab/cd/ok.npz', 'ab/cd/corrupt.h5', 'orphan.h5', 'unused.h5']:
+        os.utime(tmp_path / filepath, (old, old))
+    return tmp_path
+
+
+def test_list_store_files_skips_hidden(store):
+    df = audit_utils.list_store_files(store, n_workers=2)
+    assert sorted(df['filepath']) == sorted(['ab/ok.h5', 'ab/cd/ok.npz', 'ab/cd/corrupt.h5', 'orphan.h5', 'unused.h5', 'new.h5'])
+
+
+def test_check_file_header(store):
+    assert audit_utils.check_file_header(store / 'ab' / 'ok.h5') is None
+    assert audit_utils.check_file_header(store / 'ab' / 'cd' / 'ok.npz') is None
+    assert audit_utils.check_file_header(store / 'ab' / 'cd' / 'corrupt.h5') is not None
+    assert audit_utils.check_file_header(store / 'missing.npz') is not None
+
+
+def test_audit_store(store):
+    external = FakeExternal(store, [
+        ('h1', 'ab/ok.h5'), ('h2', 'ab/cd/ok.npz'), ('h3', 'ab/cd/corrupt.h5'), ('h4', 'missing.h5'), ('h5', 'unused.h5'),
+    ], used=['h1', 'h2', 'h3', 'h4'])
+    report = audit_utils.audit_store(external, n_workers=1)
+    statuses = dict(zip(report['filepath'], report['status']))
+    # new.h5 is not referenced but too recent to be reported
+    assert statuses == {
+        'ab/ok.h5': 'ok',
+        'ab/cd/ok.npz': 'ok',
+        'ab/cd/corrupt.h5': 'corrupt',
+        'missing.h5': 'missing',
+        'orphan.h5': 'orphaned',
+        'unused.h5': 'orphaned',
+    }
+    assert report.set_index('filepath').loc['ab/cd/corrupt.h5', 'error'] is not None
+
+
+def test_quarantine_files(store):
+    quarantine_dir = audit_utils.quarantine_files(store, ['orphan.h5', 'ab/cd/corrupt.h5', 'missing.h5'], n_workers=2)
+    assert quarantine_dir.parent == store / '.quarantine'
+    assert (quarantine_dir / 'ab' / 'cd' / 'corrupt.h5').exists() and (quarantine_dir / 'orphan.h5').exists()
+    assert not (store / 'orphan.h5').exists()
+    assert 'orphan.h5' not in set(audit_utils.list_store_files(store)['filepath'])
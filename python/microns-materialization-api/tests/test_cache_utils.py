@@ -0,0 +1,143 @@
+"""
+Tests of utils.cache_utils on caches in a temporary directory.
+"""
+import os
+import time
+
+import numpy as np
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+cache_utils = pytest.importorskip('microns_materialization_api.utils.cache_utils')
+
+
+class FakeRelation:
+    """
+    Stands in for a DataJoint query expression, counting the fetches that reach the database.
+    """
+    def __init__(self, sql, df):
+        self.sql = sql
+        self.df = df
+        self.n_fetches = 0
+
+    def make_sql(self):
+        return self.sql
+
+    def fetch(self, format='array', limit=None):
+        self.n_fetches += 1
+        df = self.df.iloc[:limit]
+        return df if format == 'frame' else df.reset_index().to_records(index=False)
+
+
+@pytest.fixture
+def rel():
+    df = pd.DataFrame({
+        'ver': [343.0, 343.0, 661.0],
+        'segment_id': np.array([1, 2, 2], dtype=np.uint64),
+        'n_synapses': [10, 0, 7],
+    }).set_index(['ver', 'segment_id'])
+    return FakeRelation('SELECT * FROM `segment`', df)
+
+
+def test_query_cache_hits_after_first_fetch(tmp_path, rel):
+    cache = cache_utils.QueryCache(tmp_path)
+    first = cache.fetch(rel, stamp=1)
+    second = cache.fetch(rel, stamp=1)
+    assert rel.n_fetches == 1 and (cache.hits, cache.misses) == (1, 1)
+    pd.testing.assert_frame_equal(first, rel.df)
+    pd.testing.assert_frame_equal(second, rel.df)
+
+
+def test_query_cache_key_depends_on_query_stamp_and_arguments(tmp_path, rel):
+    cache = cache_utils.QueryCache(tmp_path)
+    cache.fetch(rel, stamp=1)
+    cache.fetch(rel, stamp=2)
+    assert len(cache.fetch(rel, stamp=2, limit=1)) == 1
+    cache.fetch(FakeRelation('SELECT * FROM `nucleus`', rel.df), stamp=2)
+    assert cache.misses == 4 and len(cache.entries()) == 4
+
+
+def test_query_cache_arrays(tmp_path, rel):
+    cache = cache_utils.QueryCache(tmp_path)
+    first = cache.fetch(rel, format='array')
+    second = cache.fetch(rel, format='array')
+    assert rel.n_fetches == 1
+    assert np.array_equal(first, second) and first.dtype == second.dtype
+
+
+def test_query_cache_evicts_least_recently_used(tmp_path, rel):
+    cache = cache_utils.QueryCache(tmp_path)
+    for stamp in range(3):
+        cache.fetch(rel, stamp=stamp)
+    for i, (filepath, _, _) in enumerate(cache.entries()):
+        os.utime(filepath, (time.time() - 100 + i, time.time() - 100 + i))
+    size = max(size for _, size, _ in cache.entries())
+    cache.max_bytes = 2 * size
+    cache.fetch(rel, stamp=0)
+    cache.fetch(rel, stamp=3)
+    assert len(cache.entries()) == 2
+    assert rel.n_fetches == 4
+    cache.fetch(rel, stamp=0)
+    assert rel.n_fetches == 4
+    cache.clear()
+    assert cache.entries() == []
+
+
+@pytest.fixture
+def source_files(tmp_path):
+    source_dir = tmp_path / 'store'
+    source_dir.mkdir()
+    filepaths = []
+    for i in range(4):
+        filepath = source_dir / f'{i}.h5'
+        filepath.write_bytes(bytes([i]) * 1000)
+        filepaths.append(filepath)
+    return filepaths
+
+
+def test_file_cache_copies_on_miss(tmp_path, source_files):
+    cache = cache_utils.FileCache(tmp_path / 'cache')
+    cached = cache.get(source_files[0])
+    assert cached.read_bytes() == source_files[0].read_bytes() and cached.suffix == '.h5'
+    assert cache.get(source_files[0]) == cached
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'bytes_copied': 1000, 'n_evicted': 0}
+    assert list(cached.parent.glob('.*.tmp')) == []
+
+
+def test_file_cache_copies_changed_source(tmp_path, source_files):
+    cache = cache_utils.FileCache(tmp_path / 'cache')
+    cached = cache.get(source_files[0])
+    source_files[0].write_bytes(b'changed')
+    recached = cache.get(source_files[0])
+    assert recached != cached and recached.read_bytes() == b'changed'
+    assert cache.misses == 2
+
+
+def test_file_cache_evicts_least_recently_used(tmp_path, source_files):
+    cache = cache_utils.FileCache(tmp_path / 'cache', min_age=0)
+    cached = [cache.get(filepath) for filepath in source_files[:3]]
+    for i, filepath in enumerate(cached):
+        os.utime(filepath, (time.time() - 100 + i, time.time() - 100 + i))
+    cache.get(source_files[0])
+    cache.evict(max_bytes=2500)
+    assert [filepath for filepath, _, _ in cache.entries()] == [cached[2], cached[0]]
+    assert cache.size == 2000 and cache.n_evicted == 1
+
+
+def test_file_cache_keeps_recently_accessed_files(tmp_path, source_files):
+    cache = cache_utils.FileCache(tmp_path / 'cache', max_bytes=1500, min_age=60)
+    cached = [cache.get(filepath) for filepath in source_files]
+    assert all(filepath.exists() for filepath in cached)
+    os.utime(cached[0], (time.time() - 120, time.time() - 120))
+    cache.evict()
+    assert not cached[0].exists() and all(filepath.exists() for filepath in cached[1:])
+    cache.clear()
+    assert cache.entries() == []
+
+
+def test_file_cache_prefetch(tmp_path, source_files):
+    cache = cache_utils.FileCache(tmp_path / 'cache')
+    stats = cache.prefetch(source_files + [tmp_path / 'missing.h5'], n_workers=2)
+    assert stats['misses'] == len(source_files)
+    assert sorted(filepath.read_bytes() for filepath, _, _ in cache.entries()) == sorted(filepath.read_bytes() for filepath in source_files)
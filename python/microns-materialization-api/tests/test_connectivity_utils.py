@@ -0,0 +1,88 @@
+"""
+Tests of utils.connectivity_utils on small edge lists.
+"""
+import numpy as np
+import pytest
+
+sparse = pytest.importorskip('scipy.sparse')
+connectivity_utils = pytest.importorskip('microns_materialization_api.utils.connectivity_utils')
+
+
+@pytest.fixture
+def edges():
+    rng = np.random.default_rng(0)
+    segment_ids = np.array([7, 30, 2**63 + 5, 12, 900], dtype=np.uint64)
+    pre = rng.choice(segment_ids, 200)
+    post = rng.choice(segment_ids, 200)
+    sizes = rng.integers(1, 1000, 200)
+    return pre, post, sizes
+
+
+def dense(segment_ids, pre, post, weights):
+    matrix = np.zeros((len(segment_ids), len(segment_ids)))
+    np.add.at(matrix, (np.searchsorted(segment_ids, pre), np.searchsorted(segment_ids, post)), weights)
+    return matrix
+
+
+def test_build_connectome_sums_duplicate_edges(edges):
+    pre, post, sizes = edges
+    arrays = connectivity_utils.build_connectome(pre, post, np.ones(len(pre)), sizes)
+    connectome = connectivity_utils.Connectome(arrays)
+    assert np.array_equal(connectome.segment_ids, np.unique(np.concatenate([pre, post])))
+    assert np.array_equal(connectome.counts.toarray(), dense(connectome.segment_ids, pre, post, 1))
+    assert np.array_equal(connectome.sizes.toarray(), dense(connectome.segment_ids, pre, post, sizes))
+    assert arrays['counts'].dtype == np.uint32 and arrays['sizes'].dtype == np.uint64
+
+
+def test_build_connectome_csc_matches_csr(edges):
+    pre, post, sizes = edges
+    connectome = connectivity_utils.Connectome(connectivity_utils.build_connectome(pre, post, np.ones(len(pre)), sizes))
+    assert connectome.counts_csc.has_sorted_indices
+    assert np.array_equal(connectome.counts_csc.toarray(), connectome.counts.toarray())
+    assert np.array_equal(connectome.sizes_csc.toarray(), connectome.sizes.toarray())
+
+
+def test_partial_aggregates_equal_single_edges(edges):
+    pre, post, sizes = edges
+    single = connectivity_utils.build_connectome(pre, post, np.ones(len(pre)), sizes)
+    half = len(pre) // 2
+    chunks = [connectivity_utils.build_connectome(pre[s], post[s], np.ones(len(pre[s])), sizes[s]) for s in [slice(None, half), slice(half, None)]]
+    rows = [np.repeat(c['segment_ids'], np.diff(c['indptr'])) for c in chunks]
+    aggregated = connectivity_utils.build_connectome(
+        np.concatenate(rows),
+        np.concatenate([c['segment_ids'][c['indices']] for c in chunks]),
+        np.concatenate([c['counts'] for c in chunks]),
+        np.concatenate([c['sizes'] for c in chunks]),
+    )
+    for key in single:
+        assert np.array_equal(aggregated[key], single[key])
+
+
+def test_save_and_load_memory_maps(tmp_path, edges):
+    pre, post, sizes = edges
+    arrays = connectivity_utils.build_connectome(pre, post, np.ones(len(pre)), sizes)
+    filepath = tmp_path / 'connectome.npz'
+    connectivity_utils.Connectome.save(filepath, arrays)
+    loaded = connectivity_utils.Connectome.load(filepath)
+    assert all(isinstance(array, np.memmap) for array in loaded.arrays.values())
+    for key, array in arrays.items():
+        assert loaded.arrays[key].dtype == array.dtype
+        assert np.array_equal(loaded.arrays[key], array)
+    assert np.array_equal(loaded.counts.toarray(), connectivity_utils.Connectome(arrays).counts.toarray())
+
+
+def test_load_empty_connectome(tmp_path):
+    arrays = connectivity_utils.build_connectome([], [], [], [])
+    filepath = tmp_path / 'connectome.npz'
+    connectivity_utils.Connectome.save(filepath, arrays)
+    loaded = connectivity_utils.Connectome.load(filepath)
+    assert loaded.shape == (0, 0) and loaded.counts.nnz == 0
+    assert np.array_equal(loaded.index([1, 2]), [-1, -1])
+
+
+def test_index_marks_missing_segments(edges):
+    pre, post, sizes = edges
+    connectome = connectivity_utils.Connectome(connectivity_utils.build_connectome(pre, post, np.ones(len(pre)), sizes))
+    query = np.array([12, 1, 2**63 + 5, 2**64 - 1, 7], dtype=np.uint64)
+    expected = [1, -1, 4, -1, 0]
+    assert np.array_equal(connectome.index(query), expected)
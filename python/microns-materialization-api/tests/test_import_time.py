@@ -0,0 +1,30 @@
+"""
+Import time budget of the schema modules, measured in fresh interpreters (see utils.benchmark_utils.benchmark_import_time).
+
+Importing a schema module connects to the database, so the tests are skipped without one.
+    The budget in seconds is set by MICRONS_IMPORT_TIME_BUDGET.
+"""
+import os
+
+import pytest
+
+dj = pytest.importorskip('datajoint')
+benchmark_utils = pytest.importorskip('microns_materialization_api.utils.benchmark_utils')
+
+import_time_budget = float(os.getenv('MICRONS_IMPORT_TIME_BUDGET', 1))
+
+
+@pytest.fixture(scope='module')
+def database():
+    if dj.config['database.user'] is None:
+        pytest.skip('no database credentials configured')
+    try:
+        dj.conn()
+    except Exception as e:
+        pytest.skip(f'no database connection: {e}')
+
+
+@pytest.mark.parametrize('module', ['microns_materialization_api.schemas.minnie65_materialization'])
+def test_import_time(database, module):
+    import_s, df = benchmark_utils.benchmark_import_time(module)
+    assert import_s <= import_time_budget, f'Importing {module} took {import_s:.2f} s, over the budget of {import_time_budget} s. Slowest modules:\n{df.head(15).to_string()}'
@@ -0,0 +1,62 @@
+"""
+Tests of utils.lineage_utils on a small lineage table.
+"""
+import numpy as np
+import pytest
+
+pd = pytest.importorskip('pandas')
+lineage_utils = pytest.importorskip('microns_materialization_api.utils.lineage_utils')
+
+
+@pytest.fixture
+def lineage():
+    # nucleus 3 is missing from 117.0 and merged with nucleus 1 in 661.0
+    rows = [
+        (117.0, 1, 864691135000000001, False, False, False),
+        (117.0, 2, 864691135000000002, False, False, False),
+        (343.0, 1, 864691135000000011, True, False, False),
+        (343.0, 2, 864691135000000002, False, False, False),
+        (343.0, 3, 864691135000000003, False, False, False),
+        (661.0, 1, 864691135000000021, True, False, True),
+        (661.0, 2, 864691135000000002, False, True, False),
+        (661.0, 3, 864691135000000021, True, False, True),
+    ]
+    df = pd.DataFrame(rows, columns=['ver', 'nucleus_id', 'segment_id', 'segment_changed', 'split', 'merge'])
+    return lineage_utils.NucleusLineage(df.sample(frac=1, random_state=0))
+
+
+def test_segments(lineage):
+    assert list(lineage.vers) == [117.0, 343.0, 661.0]
+    assert lineage.segments([3, 1, 99]).tolist() == [
+        [0, 864691135000000003, 864691135000000021],
+        [864691135000000001, 864691135000000011, 864691135000000021],
+        [0, 0, 0],
+    ]
+    assert lineage.segments([2], vers=661.0).tolist() == [[864691135000000002]]
+
+
+def test_flag(lineage):
+    assert lineage.flag('merge', [1, 2, 3, 99], vers=[661.0]).ravel().tolist() == [True, False, True, False]
+    assert lineage.flag('segment_changed', [1, 99]).tolist() == [[False, True, True], [False, False, False]]
+
+
+def test_unknown_version_raises(lineage):
+    with pytest.raises(AssertionError):
+        lineage.segments([1], vers=1.0)
+
+
+def test_nuclei(lineage):
+    segment_ids, nucleus_ids = lineage.nuclei([864691135000000021, 864691135000000002, 5], 661.0)
+    assert sorted(zip(segment_ids.tolist(), nucleus_ids.tolist())) == [
+        (864691135000000002, 2), (864691135000000021, 1), (864691135000000021, 3),
+    ]
+    segment_ids, nucleus_ids = lineage.nuclei([864691135000000021], 117.0)
+    assert len(segment_ids) == len(nucleus_ids) == 0
+
+
+def test_nuclei_inverts_segments(lineage):
+    for ver in lineage.vers:
+        segments = lineage.segments(lineage.nucleus_ids, vers=ver).ravel()
+        segment_ids, nucleus_ids = lineage.nuclei(np.unique(segments[segments > 0]), ver)
+        assert sorted(nucleus_ids.tolist()) == lineage.nucleus_ids[segments > 0].tolist()
+        assert np.array_equal(lineage.segments(nucleus_ids, vers=ver).ravel(), segment_ids)
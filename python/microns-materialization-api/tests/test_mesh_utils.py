@@ -0,0 +1,66 @@
+"""
+Tests of utils.mesh_utils on small meshes written to a temporary directory.
+"""
+import numpy as np
+import pytest
+
+trimesh = pytest.importorskip('trimesh')
+mesh_utils = pytest.importorskip('microns_materialization_api.utils.mesh_utils')
+
+
+@pytest.fixture
+def mesh_file(tmp_path):
+    mesh = trimesh.creation.icosphere(subdivisions=2)
+    filepath = tmp_path / 'mesh.h5'
+    mesh_utils.write_mesh_h5(filepath, mesh.vertices, mesh.faces)
+    return filepath, mesh
+
+
+def test_load_trimesh_returns_processed_trimesh(mesh_file):
+    filepath, mesh = mesh_file
+    loaded = mesh_utils.load_trimesh(filepath, cache=mesh_utils.LRUCache(max_bytes=2**30))
+    assert isinstance(loaded, trimesh.Trimesh)
+    assert np.allclose(loaded.vertices, mesh.vertices)
+    assert np.array_equal(loaded.faces, mesh.faces)
+
+
+def test_load_trimesh_edits_do_not_reach_the_cache(mesh_file):
+    filepath, mesh = mesh_file
+    cache = mesh_utils.LRUCache(max_bytes=2**30)
+    first = mesh_utils.load_trimesh(filepath, cache=cache)
+    first.vertices[:, 0] += 1000
+    assert np.allclose(mesh_utils.load_trimesh(filepath, cache=cache).vertices, mesh.vertices)
+
+
+def test_decimate_reaches_the_target(mesh_file):
+    _, mesh = mesh_file
+    vertices, faces = mesh_utils.decimate(mesh.vertices, mesh.faces, n_faces=len(mesh.faces) // 4)
+    assert 0 < len(faces) <= len(mesh.faces) // 4
+    assert faces.max() < len(vertices)
+
+
+@pytest.mark.parametrize('vertices, faces', [
+    (np.zeros((3, 3)), np.array([[0, 1, 2], [0, 2, 1]])),
+    (np.zeros((0, 3)), np.zeros((0, 3), dtype=int)),
+])
+def test_decimate_degenerate_mesh_is_unchanged(vertices, faces):
+    with np.errstate(all='raise'):
+        result_vertices, result_faces = mesh_utils.decimate(vertices, faces, n_faces=1)
+    assert np.array_equal(result_vertices, vertices)
+    assert np.array_equal(result_faces, faces)
+
+
+@pytest.mark.parametrize('chunk_size', [10, 10**6])
+def test_mesh_stats_match_trimesh(tmp_path, chunk_size):
+    mesh = trimesh.creation.icosphere(subdivisions=3, radius=1000)
+    # shuffled vertices make the faces of a chunk reference vertices far apart
+    order = np.random.default_rng(0).permutation(len(mesh.vertices))
+    vertices, faces = mesh.vertices[order], np.argsort(order)[mesh.faces]
+    filepath = tmp_path / 'mesh.h5'
+    mesh_utils.write_mesh_h5(filepath, vertices, faces)
+    stats = mesh_utils.mesh_stats(filepath, chunk_size=chunk_size)
+    assert stats['n_vertices'] == len(mesh.vertices) and stats['n_faces'] == len(mesh.faces)
+    assert stats['area'] == pytest.approx(mesh.area)
+    assert stats['volume'] == pytest.approx(mesh.volume)
+    assert [stats[f'centroid_{a}'] for a in 'xyz'] == pytest.approx(list(mesh.centroid), abs=1e-6)
+    assert [stats[f'bbox_max_{a}'] for a in 'xyz'] == pytest.approx(list(mesh.bounds[1]))
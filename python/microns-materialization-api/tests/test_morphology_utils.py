@@ -0,0 +1,60 @@
+"""
+Tests of utils.morphology_utils on small skeletons.
+"""
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+pytest.importorskip('scipy.sparse')
+morphology_utils = pytest.importorskip('microns_materialization_api.utils.morphology_utils')
+
+
+@pytest.fixture
+def skeleton():
+    # a root with three branches of lengths 3, 4 and 5 + 12, and one vertex not connected to the root
+    vertices = np.array([
+        [0, 0, 0],
+        [3, 0, 0],
+        [0, 4, 0],
+        [0, 0, 5],
+        [0, 0, 17],
+        [100, 100, 100],
+    ])
+    edges = np.array([[1, 0], [2, 0], [3, 0], [4, 3]])
+    return vertices, edges
+
+
+def test_skeleton_metrics(skeleton):
+    metrics = morphology_utils.skeleton_metrics(*skeleton, root=0)
+    assert set(metrics) == set(morphology_utils.skeleton_metric_names)
+    assert metrics['n_vertices'] == 6 and metrics['n_edges'] == 4
+    assert metrics['cable_length'] == pytest.approx(24)
+    assert metrics['n_branch_points'] == 1
+    assert metrics['n_end_points'] == 3
+    assert metrics['max_path_length'] == pytest.approx(17)
+    assert metrics['mean_path_length'] == pytest.approx((0 + 3 + 4 + 5 + 17) / 5)
+    assert metrics['radial_extent'] == pytest.approx(17)
+
+
+def test_skeleton_metrics_depend_on_root(skeleton):
+    metrics = morphology_utils.skeleton_metrics(*skeleton, root=4)
+    assert metrics['max_path_length'] == pytest.approx(21)
+    assert metrics['radial_extent'] == pytest.approx(np.sqrt(4**2 + 17**2))
+    assert metrics['n_branch_points'] == 1
+
+
+def test_skeleton_metrics_of_empty_skeleton():
+    metrics = morphology_utils.skeleton_metrics(np.zeros((0, 3)), np.zeros((0, 2)))
+    assert metrics == dict.fromkeys(morphology_utils.skeleton_metric_names, 0)
+
+
+def test_compute_skeleton_metrics_from_files(tmp_path, skeleton):
+    vertices, edges = skeleton
+    filepath = tmp_path / 'skeleton.h5'
+    with h5py.File(filepath, 'w') as f:
+        f.create_dataset('vertices', data=vertices)
+        f.create_dataset('edges', data=edges)
+        f.create_dataset('root', data=4)
+    results = morphology_utils.compute_skeleton_metrics([filepath, tmp_path / 'missing.h5'], n_workers=1)
+    assert results[0] == morphology_utils.skeleton_metrics(vertices, edges, root=4)
+    assert results[1] is None
@@ -0,0 +1,70 @@
+"""
+Tests of utils.pack_utils on small skeleton files written to a temporary directory.
+"""
+import json
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+pack_utils = pytest.importorskip('microns_materialization_api.utils.pack_utils')
+
+
+def write_h5_skeleton(filepath, n_vertices, rng, root=0, meta=None):
+    with h5py.File(filepath, 'w') as f:
+        f.create_dataset('vertices', data=rng.random((n_vertices, 3)))
+        f.create_dataset('edges', data=np.stack([np.arange(1, n_vertices), np.arange(n_vertices - 1)], axis=1))
+        f.create_dataset('root', data=root)
+        f.create_dataset('meta', data=json.dumps(meta or {}))
+    return filepath
+
+
+def write_npz_skeleton(filepath, n_vertices, rng):
+    np.savez(filepath, vertices=rng.random((n_vertices, 3)), edges=np.stack([np.arange(1, n_vertices), np.arange(n_vertices - 1)], axis=1))
+    return filepath
+
+
+@pytest.fixture
+def skeleton_files(tmp_path):
+    rng = np.random.default_rng(0)
+    return {
+        'skeleton_obj': [(f'h5_{i}', write_h5_skeleton(tmp_path / f'{i}.h5', n, rng, meta={'i': i})) for i, n in enumerate([5, 1, 12])],
+        'axon_skeleton': [(f'npz_{i}', write_npz_skeleton(tmp_path / f'{i}.npz', n, rng)) for i, n in enumerate([3, 8])],
+    }
+
+
+def test_pack_round_trip(tmp_path, skeleton_files):
+    filepath = tmp_path / 'pack.h5'
+    members = pack_utils.write_skeleton_pack(filepath, skeleton_files, n_workers=2, chunk_rows=4, flush_every=2)
+    pack = pack_utils.SkeletonPack(filepath)
+    assert sorted(pack.names) == sorted(skeleton_files)
+    assert len(pack) == 5
+    for name, items in skeleton_files.items():
+        assert list(pack.ids(name)) == [skeleton_id for skeleton_id, _ in items]
+        for (skeleton_id, source), (member_id, idx) in zip(items, members[name]):
+            assert member_id == skeleton_id
+            expected = pack_utils.read_skeleton_file(source)
+            arrays = pack.get(name, idx)
+            assert np.array_equal(arrays['vertices'], expected['vertices'])
+            assert np.array_equal(arrays['edges'], expected['edges'])
+            assert arrays['root'] == expected['root']
+    assert pack.meta('skeleton_obj', 2) == {'i': 2}
+    assert pack.meta('axon_skeleton', 0) == {}
+
+
+def test_unreadable_files_are_skipped(tmp_path, skeleton_files):
+    skeleton_files['skeleton_obj'].insert(1, ('missing', tmp_path / 'missing.h5'))
+    members = pack_utils.write_skeleton_pack(tmp_path / 'pack.h5', skeleton_files, n_workers=2)
+    assert [skeleton_id for skeleton_id, _ in members['skeleton_obj']] == ['h5_0', 'h5_1', 'h5_2']
+    assert [idx for _, idx in members['skeleton_obj']] == [0, 1, 2]
+
+
+def test_open_skeleton_pack_reopens_rewritten_pack(tmp_path, skeleton_files):
+    filepath = tmp_path / 'pack.h5'
+    pack_utils.write_skeleton_pack(filepath, skeleton_files, n_workers=1)
+    first = pack_utils.open_skeleton_pack(str(filepath))
+    assert pack_utils.open_skeleton_pack(str(filepath)) is first
+    pack_utils.write_skeleton_pack(filepath, {'skeleton_obj': skeleton_files['skeleton_obj'][:1]}, n_workers=1)
+    second = pack_utils.open_skeleton_pack(str(filepath))
+    assert second is not first
+    assert len(second) == 1
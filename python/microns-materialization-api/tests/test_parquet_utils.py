@@ -0,0 +1,57 @@
+"""
+Tests of utils.parquet_utils on small tables written to a temporary directory.
+"""
+import numpy as np
+import pytest
+
+pd = pytest.importorskip('pandas')
+pq = pytest.importorskip('pyarrow.parquet')
+parquet_utils = pytest.importorskip('microns_materialization_api.utils.parquet_utils')
+
+
+def chunk_df(keys):
+    return pd.DataFrame({'ver': 343.0, 'segment_id': np.repeat(keys, 3).astype(np.uint64), 'x': np.arange(3 * len(keys), dtype=np.float32)})
+
+
+def test_write_and_read_dataset(tmp_path):
+    partition = parquet_utils.ParquetPartition(tmp_path, {'ver': '343.00'}, row_group_size=4)
+    paths = [partition.write(chunk_df(keys), keys) for keys in [[1, 2], [3]]]
+    partition.mark_complete()
+    assert partition.path == tmp_path / 'ver=343.00'
+    assert [p.name for p in paths] == ['part-00000.parquet', 'part-00001.parquet']
+    assert list(partition.path.glob('*.tmp')) == []
+    assert pq.ParquetFile(paths[0]).metadata.num_row_groups == 2
+    assert 'ver' not in pq.read_schema(paths[0]).names
+    df = pd.read_parquet(tmp_path)
+    assert sorted(df['segment_id']) == [1, 1, 1, 2, 2, 2, 3, 3, 3]
+    assert set(df['ver'].astype(str)) == {'343.00'}
+
+
+def test_manifest_resumes_export(tmp_path):
+    partition = parquet_utils.ParquetPartition(tmp_path, {'ver': '343.00'})
+    partition.write(chunk_df([1, 2]), np.array([1, 2], dtype=np.uint64))
+    resumed = parquet_utils.ParquetPartition(tmp_path, {'ver': '343.00'})
+    assert resumed.exported_keys == {1, 2} and not resumed.complete
+    assert resumed.write(chunk_df([3]), [3]).name == 'part-00001.parquet'
+    resumed.mark_complete()
+    assert parquet_utils.ParquetPartition(tmp_path, {'ver': '343.00'}).complete
+
+
+def test_clear(tmp_path):
+    partition = parquet_utils.ParquetPartition(tmp_path, {'ver': '343.00'})
+    partition.write(chunk_df([1]), [1])
+    partition.mark_complete()
+    partition.clear()
+    assert list(partition.path.glob('*.parquet')) == []
+    reopened = parquet_utils.ParquetPartition(tmp_path, {'ver': '343.00'})
+    assert reopened.exported_keys == set() and not reopened.complete
+
+
+@pytest.mark.parametrize('counts, chunks', [
+    ([2, 2, 2, 2], [[0, 1], [2, 3]]),
+    ([1, 9, 1, 1], [[0], [1], [2, 3]]),
+    ([5, 1], [[0], [1]]),
+    ([], []),
+])
+def test_chunk_keys_by_size(counts, chunks):
+    assert parquet_utils.chunk_keys_by_size(range(len(counts)), counts, chunk_size=4) == chunks
@@ -0,0 +1,85 @@
+"""
+Tests of utils.recompress_utils on small HDF5 files written to a temporary directory.
+"""
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+pd = pytest.importorskip('pandas')
+recompress_utils = pytest.importorskip('microns_materialization_api.utils.recompress_utils')
+
+
+@pytest.fixture
+def h5_file(tmp_path):
+    filepath = tmp_path / 'file.h5'
+    rng = np.random.default_rng(0)
+    with h5py.File(filepath, 'w') as f:
+        f.attrs['version'] = 2
+        f.create_dataset('vertices', data=np.round(rng.random((5000, 3)) * 100, 1))
+        f.create_dataset('faces', data=np.tile(np.arange(3000), (3, 1)).T)
+        f.create_dataset('root', data=7)
+        f.create_dataset('meta', data='{"a": 1}')
+        group = f.create_group('annotations')
+        group.attrs['scale'] = np.nan
+        values = rng.random(2000)
+        values[::3] = np.nan
+        group.create_dataset('values', data=values).attrs['unit'] = 'nm'
+    return filepath
+
+
+def test_h5_equal(tmp_path, h5_file):
+    copy = tmp_path / 'copy.h5'
+    with h5py.File(h5_file, 'r') as src, h5py.File(copy, 'w') as dst:
+        recompress_utils.copy_h5(src, dst, compression='lzf')
+    with h5py.File(h5_file, 'r') as a, h5py.File(copy, 'r') as b:
+        # values and attrs hold NaN, which compare equal to their copy
+        assert recompress_utils.h5_equal(a, b)
+        assert b['vertices'].compression == 'lzf' and b['root'].compression is None
+    with h5py.File(copy, 'a') as f:
+        f['annotations/values'][1] += 1
+    with h5py.File(h5_file, 'r') as a, h5py.File(copy, 'r') as b:
+        assert not recompress_utils.h5_equal(a, b)
+    with h5py.File(copy, 'a') as f:
+        del f['annotations/values']
+    with h5py.File(h5_file, 'r') as a, h5py.File(copy, 'r') as b:
+        assert not recompress_utils.h5_equal(a, b)
+
+
+def test_h5_equal_compares_dtypes(tmp_path):
+    with h5py.File(tmp_path / 'a.h5', 'w') as a, h5py.File(tmp_path / 'b.h5', 'w') as b:
+        a.create_dataset('x', data=np.arange(10, dtype=np.int64))
+        b.create_dataset('x', data=np.arange(10, dtype=np.int32))
+        assert not recompress_utils.h5_equal(a, b)
+
+
+def test_recompress_file_replaces_smaller_file(h5_file):
+    with h5py.File(h5_file, 'r') as f:
+        before = {name: f[name][()] for name in ['vertices', 'faces']}
+    result = recompress_utils.recompress_file(h5_file, compression='gzip')
+    assert result['status'] == 'replaced', result['error']
+    assert result['bytes_after'] < result['bytes_before']
+    assert result['contents_hash'] is not None
+    with h5py.File(h5_file, 'r') as f:
+        assert f['vertices'].compression == 'gzip'
+        assert all(np.array_equal(f[name][()], array) for name, array in before.items())
+        assert np.isnan(f['annotations'].attrs['scale'])
+    assert list(h5_file.parent.glob('.*.tmp')) == []
+
+
+@pytest.mark.parametrize('kwargs, status', [({'dry_run': True}, 'dry_run'), ({'compression': None}, 'larger')])
+def test_recompress_file_keeps_original(h5_file, kwargs, status):
+    assert recompress_utils.recompress_file(h5_file, compression='gzip')['status'] == 'replaced'
+    before = h5_file.read_bytes()
+    result = recompress_utils.recompress_file(h5_file, **kwargs)
+    assert result['status'] == status, result['error']
+    assert result['contents_hash'] is None
+    assert h5_file.read_bytes() == before
+    assert list(h5_file.parent.glob('.*.tmp')) == []
+
+
+def test_recompress_files_reports_errors(tmp_path, h5_file):
+    report = recompress_utils.recompress_files([h5_file, tmp_path / 'missing.h5'], n_workers=1, compression='gzip')
+    assert report['status'].tolist() == ['replaced', 'error']
+    assert report['error'].iloc[1] is not None
+    summary = recompress_utils.summarize(report)
+    assert summary.loc['replaced', 'n_files'] == 1
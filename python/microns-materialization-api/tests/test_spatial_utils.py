@@ -0,0 +1,109 @@
+"""
+Tests of utils.spatial_utils against brute force search on random points.
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip('scipy.spatial')
+spatial_utils = pytest.importorskip('microns_materialization_api.utils.spatial_utils')
+
+BOUNDS = np.array([[0, 0, 0], [100_000, 60_000, 40_000]])
+
+
+@pytest.fixture(params=['grid', 'kdtree'])
+def index(request, tmp_path):
+    rng = np.random.default_rng(0)
+    ids = (rng.permutation(10**6)[:2000] + 2**40).astype(np.uint64)
+    points = rng.random((2000, 3)) * (BOUNDS[1] - BOUNDS[0]) + BOUNDS[0]
+    chunks = [(ids[i:i + 300], points[i:i + 300]) for i in range(0, 2000, 300)]
+    index = spatial_utils.GridIndex.build(tmp_path / 'index.npz', lambda: iter(chunks[::-1]), BOUNDS, cell_size=7_000)
+    if request.param == 'grid':
+        index.kdtree_max_points = 0
+    return index
+
+
+@pytest.fixture
+def centers():
+    rng = np.random.default_rng(1)
+    # include centers on the boundary and outside of the grid
+    return np.concatenate([rng.random((20, 3)) * (BOUNDS[1] - BOUNDS[0]), [BOUNDS[0], BOUNDS[1], [-50_000, 30_000, 20_000]]])
+
+
+def brute_force_distances(index, center):
+    return np.linalg.norm(np.asarray(index.points, dtype=np.float64) - center, axis=1)
+
+
+def test_build_sorts_points_by_cell(index, tmp_path):
+    assert len(index) == 2000
+    assert index.offsets[0] == 0 and index.offsets[-1] == 2000
+    assert np.all(np.diff(index.offsets) >= 0)
+    assert len(np.unique(index.ids)) == 2000
+    reloaded = spatial_utils.GridIndex.load(tmp_path / 'index.npz')
+    assert np.array_equal(reloaded.ids, index.ids)
+
+
+def test_query_radius(index, centers):
+    ids, distances = index.query_radius(centers, 9_000, return_distances=True)
+    for center, result, d in zip(centers, ids, distances):
+        expected = brute_force_distances(index, center)
+        assert set(result) == set(index.ids[expected <= 9_000])
+        assert np.all(np.diff(d) >= 0)
+        assert np.allclose(d, np.sort(expected[expected <= 9_000]))
+    assert np.array_equal(index.count_radius(centers, 9_000), [len(result) for result in ids])
+
+
+def test_query_radius_per_center(index, centers):
+    radius = np.linspace(0, 20_000, len(centers))
+    for center, r, result in zip(centers, radius, index.query_radius(centers, radius)):
+        assert set(result) == set(index.ids[brute_force_distances(index, center) <= r])
+
+
+@pytest.mark.parametrize('k', [1, 7])
+def test_query_knn(index, centers, k):
+    ids, distances = index.query_knn(centers, k=k)
+    assert ids.shape == distances.shape == (len(centers), k)
+    for center, result, d in zip(centers, ids, distances):
+        expected = brute_force_distances(index, center)
+        order = np.argsort(expected)[:k]
+        assert np.allclose(d, expected[order])
+        assert set(result) == set(index.ids[order])
+
+
+def test_query_knn_with_fewer_points_than_k(tmp_path):
+    points = np.array([[1_000, 1_000, 1_000], [50_000, 50_000, 30_000]])
+    index = spatial_utils.GridIndex.build(tmp_path / 'index.npz', lambda: iter([([5, 6], points)]), BOUNDS, cell_size=7_000)
+    for max_points in [0, index.kdtree_max_points]:
+        index.kdtree_max_points = max_points
+        ids, distances = index.query_knn([0, 0, 0], k=3)
+        assert list(ids[0]) == [5, 6, 0]
+        assert np.isinf(distances[0, 2])
+
+
+def test_query_box(index):
+    lo = np.array([[10_000, 5_000, 0], [-np.inf, -np.inf, 20_000], [200_000, 0, 0]])
+    hi = np.array([[30_000, 45_000, 12_345], [np.inf, np.inf, 21_000], [300_000, 10_000, 10_000]])
+    points = np.asarray(index.points)
+    for l, h, result in zip(lo, hi, index.query_box(lo, hi)):
+        assert set(result) == set(index.ids[np.all((points >= l) & (points <= h), axis=1)])
+
+
+def test_voxels_to_nm():
+    assert np.array_equal(spatial_utils.voxels_to_nm([[1, 2, 3]]), [[4, 8, 120]])
+
+
+def test_kdtree_and_grid_agree(index, centers):
+    grid = spatial_utils.GridIndex(index.arrays)
+    grid.kdtree_max_points = 0
+    kdtree = spatial_utils.GridIndex(index.arrays)
+    assert not grid.use_kdtree and kdtree.use_kdtree
+    assert np.array_equal(grid.count_radius(centers, 12_000), kdtree.count_radius(centers, 12_000))
+    for a, b in zip(grid.query_radius(centers, 12_000), kdtree.query_radius(centers, 12_000)):
+        assert set(a) == set(b)
+    assert np.allclose(grid.query_knn(centers, k=3)[1], kdtree.query_knn(centers, k=3)[1])
+
+
+def test_density(index):
+    radius = 10_000
+    center = (BOUNDS[0] + BOUNDS[1]) / 2
+    count = index.count_radius(center, radius)[0]
+    assert index.density(center, radius)[0] == pytest.approx(count / (4 / 3 * np.pi * (radius * 1e-6) ** 3))
@@ -0,0 +1,46 @@
+"""
+Tests of utils.summary_utils on small summary tables.
+"""
+import numpy as np
+import pytest
+
+pd = pytest.importorskip('pandas')
+summary_utils = pytest.importorskip('microns_materialization_api.utils.summary_utils')
+
+NULLABLE_ATTRS = ['n_presyn', 'n_vertices']
+PRESENCE_ATTRS = ['has_meshwork']
+
+
+@pytest.fixture
+def existing():
+    return pd.DataFrame({
+        'segment_id': [1, 2, 3, 4],
+        'n_presyn': [10, np.nan, np.nan, 5],
+        'n_vertices': [100, 200, np.nan, 300],
+        'has_meshwork': [1, 1, 0, 0],
+    })
+
+
+def test_rows_to_write(existing):
+    df = pd.DataFrame({
+        'segment_id': [1, 2, 3, 4, 5],
+        # 1 is complete, 2 gained synapses, 3 is still incomplete, 4 gained a meshwork, 5 is new
+        'n_presyn': [11, 7, np.nan, 5, np.nan],
+        'n_vertices': [100, 200, np.nan, 300, 50],
+        'has_meshwork': [1, 1, 0, 1, 0],
+    })
+    is_new, is_updated = summary_utils.rows_to_write(df, existing, NULLABLE_ATTRS, PRESENCE_ATTRS)
+    assert is_new.tolist() == [False, False, False, False, True]
+    assert is_updated.tolist() == [False, True, False, True, False]
+
+    is_new, is_updated = summary_utils.rows_to_write(df, existing, NULLABLE_ATTRS, PRESENCE_ATTRS, refresh_incomplete=False)
+    assert is_new.tolist() == [False, False, False, False, True]
+    assert not is_updated.any()
+
+
+def test_rows_to_write_into_empty_table(existing):
+    df = existing.copy()
+    is_new, is_updated = summary_utils.rows_to_write(df, existing.iloc[:0], NULLABLE_ATTRS, PRESENCE_ATTRS)
+    assert is_new.all() and not is_updated.any()
+    is_new, is_updated = summary_utils.rows_to_write(df, existing, NULLABLE_ATTRS, PRESENCE_ATTRS)
+    assert not is_new.any() and not is_updated.any()
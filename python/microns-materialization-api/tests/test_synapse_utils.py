@@ -0,0 +1,48 @@
+"""
+Tests of utils.synapse_utils on small synapse tables.
+"""
+import numpy as np
+import pytest
+
+pd = pytest.importorskip('pandas')
+synapse_utils = pytest.importorskip('microns_materialization_api.utils.synapse_utils')
+
+
+@pytest.fixture
+def synapses():
+    # 1 and 2 are primary segments, 8 and 9 are not
+    return pd.DataFrame({
+        'synapse_id': [10, 11, 12, 13, 14],
+        'pre_seg_id': np.array([1, 2, 1, 8, 9], dtype=np.uint64),
+        'post_seg_id': np.array([2, 1, 8, 2, 1], dtype=np.uint64),
+    }), [1, 2]
+
+
+def test_to_primary_secondary_lists_synapses_under_each_primary(synapses):
+    df, primary_seg_ids = synapses
+    result = synapse_utils.to_primary_secondary(df, primary_seg_ids)
+    rows = set(zip(result['synapse_id'], result['primary_seg_id'], result['secondary_seg_id'], result['prepost']))
+    assert rows == {
+        (10, 1, 2, 'presyn'), (10, 2, 1, 'postsyn'),
+        (11, 2, 1, 'presyn'), (11, 1, 2, 'postsyn'),
+        (12, 1, 8, 'presyn'),
+        (13, 2, 8, 'postsyn'),
+        (14, 1, 9, 'postsyn'),
+    }
+
+
+def test_to_pre_post_keeps_one_row_per_synapse(synapses):
+    df, primary_seg_ids = synapses
+    result = synapse_utils.to_pre_post(synapse_utils.to_primary_secondary(df, primary_seg_ids), primary_seg_ids)
+    assert set(result.columns) == set(df.columns)
+    result = result.sort_values('synapse_id').reset_index(drop=True)
+    pd.testing.assert_frame_equal(result[df.columns], df)
+
+
+def test_to_pre_post_does_not_need_both_copies(synapses):
+    df, primary_seg_ids = synapses
+    info = synapse_utils.to_primary_secondary(df, primary_seg_ids)
+    # a chunk of the rows of one primary segment, e.g. one restriction of a batched fetch
+    chunks = [info[info['primary_seg_id'] == seg_id] for seg_id in primary_seg_ids]
+    result = pd.concat([synapse_utils.to_pre_post(chunk, primary_seg_ids) for chunk in chunks])
+    assert sorted(result['synapse_id']) == sorted(df['synapse_id'])
@@ -0,0 +1,599 @@
+"""
+Offline benchmark of the minnie65 makers, run against a disposable MySQL server with synthetic stand-ins for CAVE and cloud-volume.
+
+The stand-ins replace, for the duration of the benchmark:
+    cave_client: a FakeCAVEclient serving synthetic nucleus_detection_v0 and synapses_pni_2 tables (see utils.synthetic_utils)
+    meshparty.trimesh_io.download_meshes: writes synthetic mesh .h5 files
+    pcg_skel.pcg_skeleton, pcg_skel.pcg_meshwork: return synthetic skeletons and meshwork objects
+
+Everything else (method validation, makers, inserts, external stores, the axon/dendrite split) is the code under test,
+    so CLOUDVOLUME_TOKEN is not needed, but meshparty, pcg-skel, caveclient and cloud-volume must be installed as for production.
+
+The database is a datajoint/mysql container started with docker and removed afterwards, or a server given with --db-host,
+    which must not have the minnie65 materialization schemas (they are dropped at the end). Stores are in a temporary directory.
+    The schema modules connect on import, so this module is outside of the minnie_materialization package and imports it
+    only after configuring DataJoint.
+
+Each maker is populated in turn and its keys per second, database time (all queries of the DataJoint connection),
+    peak RSS and stage times (see utils.metrics_utils) are written to a JSON file named after the time and git commit,
+    so runs can be compared between commits:
+
+    python -m microns_materialization.minnie65_benchmark run --n-nuclei 200 --mesh-scale 0.1
+    python -m microns_materialization.minnie65_benchmark compare <baseline.json> <candidate.json>
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from unittest import mock
+
+import datajoint as dj
+import datajoint_plus as djp
+import numpy as np
+import pandas as pd
+
+from microns_materialization_api.config import externals
+from microns_materialization_api.utils.benchmark_utils import PeakRSS
+from microns_materialization_api.utils.metrics_utils import \
+    collector as metrics_collector
+from microns_materialization_api.utils.metrics_utils import stage
+from microns_materialization_api.utils.synthetic_utils import (
+    nucleus_table, sample_sizes, synapse_table, synthetic_meshwork,
+    synthetic_skeleton, voxel_resolution, write_synthetic_mesh)
+
+logger = djp.getLogger(__name__)
+
+default_results_dir = Path(os.getenv('MICRONS_BENCHMARK_DIR', Path.home() / '.cache' / 'microns-materialization' / 'benchmarks'))
+
+# schemas created by the benchmark, dropped in this order
+schema_names = ('microns_minnie65_materialization_v3', 'microns_minnie65_materialization')
+
+# makers compared between runs. The other makers of the pipeline are populated to provide their inputs and are also reported.
+benchmarked_makers = (
+    'Nucleus.CAVE',
+    'Synapse.CAVE2',
+    'Mesh.MeshParty',
+    'Skeleton.PCGSkeletonMaker',
+    'Skeleton.MeshworkAxonDendriteSkeletonMaker',
+)
+
+# metrics compared between runs, as (column, True if higher is better)
+compared_metrics = (
+    ('keys_per_s', True),
+    ('db_s_per_key', False),
+    ('peak_rss_bytes', False),
+)
+
+
+class SyntheticDataset:
+    """
+    Synthetic CAVE tables of one materialization version, and the meshes, skeletons and meshwork objects of their segments.
+
+    Objects of a segment are generated from a seed derived from the segment id, so they are the same in every run.
+    """
+    def __init__(self, n_nuclei=100, ver=1, synapse_scale=0.1, mesh_scale=0.1, skeleton_scale=1., seed=0):
+        """
+        :param n_nuclei: (int) number of nuclei, and about the number of segments
+        :param ver: (int) materialization version
+        :param synapse_scale, mesh_scale, skeleton_scale: (float) multiply the median sizes of utils.synthetic_utils.size_distributions
+        :param seed: (int) seed of the tables and objects
+        """
+        self.ver = ver
+        self.synapse_scale = synapse_scale
+        self.mesh_scale = mesh_scale
+        self.skeleton_scale = skeleton_scale
+        self.seed = seed
+        self.tables = {
+            'nucleus_detection_v0': nucleus_table(n_nuclei, rng=seed),
+        }
+        self.tables['synapses_pni_2'] = synapse_table(self.tables['nucleus_detection_v0']['pt_root_id'], scale=synapse_scale, rng=seed + 1)
+        self._indices = {}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(n_nuclei={len(self.tables["nucleus_detection_v0"])}, n_synapses={len(self.tables["synapses_pni_2"])}, ver={self.ver})'
+
+    @property
+    def segment_ids(self):
+        segment_ids = self.tables['nucleus_detection_v0']['pt_root_id'].unique()
+        return segment_ids[segment_ids != 0]
+
+    def _index(self, table, column):
+        if (table, column) not in self._indices:
+            self._indices[table, column] = self.tables[table].groupby(column).indices
+        return self._indices[table, column]
+
+    def query_table(self, table, filter_equal_dict=None):
+        """
+        :returns: pandas.DataFrame of the rows of a table matching all values of filter_equal_dict, as CAVE does
+        """
+        df = self.tables[table]
+        rows = np.arange(len(df))
+        for column, value in (filter_equal_dict or {}).items():
+            rows = np.intersect1d(rows, self._index(table, column).get(value, []))
+        return df.iloc[rows].reset_index(drop=True)
+
+    def rng(self, segment_id, kind):
+        return np.random.default_rng([self.seed, int(segment_id), kind])
+
+    def root_point(self, segment_id):
+        df = self.query_table('nucleus_detection_v0', {'pt_root_id': segment_id})
+        return df['pt_position'].values[0] * voxel_resolution if len(df) else None
+
+    def download_meshes(self, seg_ids, target_dir, cv_path=None, **kwargs):
+        """
+        Stands in for meshparty.trimesh_io.download_meshes. Writes <target_dir>/<segment_id>.h5 for each segment.
+        """
+        for segment_id in seg_ids:
+            rng = self.rng(segment_id, 0)
+            n_vertices = sample_sizes('mesh_vertices', 1, scale=self.mesh_scale, rng=rng)[0]
+            write_synthetic_mesh(Path(target_dir) / f'{segment_id}.h5', n_vertices, origin=self.root_point(segment_id), rng=rng)
+
+    def pcg_skeleton(self, root_id, client=None, root_point=None, **kwargs):
+        """
+        Stands in for pcg_skel.pcg_skeleton.
+        """
+        rng = self.rng(root_id, 1)
+        n_vertices, n_mesh_vertices = [sample_sizes(name, 1, scale=self.skeleton_scale, rng=rng)[0] for name in ('skeleton_vertices', 'level2_vertices')]
+        origin = None if root_point is None else np.asarray(root_point) * voxel_resolution
+        return synthetic_skeleton(n_vertices, n_mesh_vertices=n_mesh_vertices, origin=origin, rng=rng)[0]
+
+    def pcg_meshwork(self, root_id, client=None, root_point=None, synapse_table='synapses_pni_2', **kwargs):
+        """
+        Stands in for pcg_skel.pcg_meshwork, with the synapses of the segment as pre_syn and post_syn annotations.
+        """
+        rng = self.rng(root_id, 2)
+        n_vertices = sample_sizes('skeleton_vertices', 1, scale=self.skeleton_scale, rng=rng)[0]
+        origin = None if root_point is None else np.asarray(root_point) * voxel_resolution
+        pre_syn = self.query_table(synapse_table, {'pre_pt_root_id': root_id})
+        post_syn = self.query_table(synapse_table, {'post_pt_root_id': root_id})
+        return synthetic_meshwork(root_id, n_vertices, pre_syn=pre_syn, post_syn=post_syn, origin=origin, rng=rng)
+
+
+class _FakeMaterializationClient:
+    def __init__(self, dataset, datastack, latency=0.):
+        self.dataset = dataset
+        self.datastack_name = datastack
+        self.version = dataset.ver
+        self.latency = latency
+
+    def get_version_metadata(self):
+        time_stamp = datetime(2021, 1, 1) + timedelta(days=int(self.version))
+        return {
+            'datastack': self.datastack_name,
+            'id': int(self.version),
+            'valid': True,
+            'version': int(self.version),
+            'time_stamp': time_stamp.strftime('%Y-%m-%d %H:%M:%S'),
+            'expires_on': (time_stamp + timedelta(days=30)).strftime('%Y-%m-%d %H:%M:%S'),
+        }
+
+    def query_table(self, table, filter_equal_dict=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.dataset.query_table(table, filter_equal_dict)
+
+
+class _FakeInfoClient:
+    def segmentation_source(self):
+        return 'graphene://https://synthetic.invalid/segmentation/table/minnie3_v1'
+
+
+class FakeCAVEclient:
+    """
+    Stands in for caveclient.CAVEclient, with the attributes used by the import methods.
+    """
+    def __init__(self, dataset, datastack='minnie65_phase3_v1', latency=0.):
+        """
+        :param dataset: SyntheticDataset
+        :param datastack: (str) datastack name
+        :param latency: (float) seconds slept by each query_table call, to model the round trip to CAVE
+        """
+        self.materialize = _FakeMaterializationClient(dataset, datastack, latency=latency)
+        self.info = _FakeInfoClient()
+
+
+@contextlib.contextmanager
+def synthetic_sources(module, dataset, latency=0.):
+    """
+    Replaces cave_client of module, meshparty.trimesh_io.download_meshes, pcg_skel.pcg_skeleton and pcg_skel.pcg_meshwork
+        with the stand-ins of dataset within the block.
+
+    :param module: the module defining cave_client, i.e. minnie65_materialization
+    :param dataset: SyntheticDataset
+    :param latency: (float) see FakeCAVEclient
+    """
+    import pcg_skel
+    from meshparty import trimesh_io
+
+    def cave_client(datastack, ver=None):
+        with stage('cave_client'):
+            return FakeCAVEclient(dataset, datastack, latency=latency)
+
+    with mock.patch.object(module, 'cave_client', cave_client), \
+            mock.patch.object(trimesh_io, 'download_meshes', dataset.download_meshes), \
+            mock.patch.object(pcg_skel, 'pcg_skeleton', dataset.pcg_skeleton), \
+            mock.patch.object(pcg_skel, 'pcg_meshwork', dataset.pcg_meshwork):
+        yield
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_mysql(host, user, password, timeout=120.):
+    """
+    Retries connecting to a MySQL server until it accepts connections or timeout seconds have passed.
+    """
+    import pymysql
+    address, _, port = host.partition(':')
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            pymysql.connect(host=address, port=int(port or 3306), user=user, password=password).close()
+            return
+        except pymysql.err.OperationalError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'MySQL server at {host} did not accept connections within {timeout} s.')
+            time.sleep(1)
+
+
+@contextlib.contextmanager
+def local_mysql(image='datajoint/mysql:5.7', password='benchmark', timeout=120.):
+    """
+    Starts a disposable MySQL server in a docker container and removes it on exit.
+
+    :param image: (str) docker image
+    :param password: (str) root password
+    :param timeout: (float) seconds to wait for the server
+
+    :yields: (str) host as "127.0.0.1:<port>"
+    """
+    port = _free_port()
+    name = f'microns-benchmark-{uuid.uuid4().hex[:8]}'
+    subprocess.run(['docker', 'run', '-d', '--rm', '--name', name, '-p', f'127.0.0.1:{port}:3306', '-e', f'MYSQL_ROOT_PASSWORD={password}', image], check=True, capture_output=True)
+    logger.info(f'Started MySQL container {name} on port {port}.')
+    try:
+        host = f'127.0.0.1:{port}'
+        wait_for_mysql(host, 'root', password, timeout=timeout)
+        yield host
+    finally:
+        subprocess.run(['docker', 'stop', name], capture_output=True)
+        logger.info(f'Removed MySQL container {name}.')
+
+
+def configure(host, user, password, store_dir):
+    """
+    Points DataJoint at the benchmark server and the stores of the minnie65 schema at store_dir.
+        Must be called before the schema modules are imported, since they connect and register their stores on import.
+    """
+    if 'microns_materialization_api.schemas.minnie65_materialization' in sys.modules:
+        raise RuntimeError('The minnie65 schema module was imported before the benchmark configured DataJoint.')
+    dj.config['database.host'] = host
+    dj.config['database.user'] = user
+    dj.config['database.password'] = password
+    dj.config['safemode'] = False
+    for store in externals.minnie65_materialization:
+        path = Path(store_dir) / store
+        path.mkdir(parents=True, exist_ok=True)
+        externals.minnie65_materialization[store] = djp.make_store_dict(path)
+
+
+def check_empty_server(connection):
+    """
+    Raises if the server has any of the schemas the benchmark creates, so it never runs against a server in use.
+    """
+    existing = [name for name in schema_names if connection.query('SHOW DATABASES LIKE %s', args=(name,)).fetchone()]
+    if existing:
+        raise RuntimeError(f'Server {connection.conn_info["host"]} already has schemas {existing}. Run the benchmark on an empty server.')
+
+
+def create_legacy_schema():
+    """
+    Declares the tables of the legacy schema microns_minnie65_materialization referenced by the MatV1 parts,
+        with the primary keys of the originals and no data, so the minnie65 schema can be declared on an empty server.
+    """
+    legacy = dj.Schema(schema_names[1])
+
+    @legacy
+    class Materialization(dj.Manual):
+        definition = """
+        ver : decimal(6,2) # materialization version
+        """
+
+    @legacy
+    class Nucleus(dj.Manual):
+        definition = """
+        nucleus_id : int unsigned # id of segmented nucleus.
+        """
+
+        class Info(dj.Part):
+            definition = """
+            -> Materialization
+            -> master
+            segment_id : bigint unsigned # id of the segment under the nucleus centroid
+            """
+
+    @legacy
+    class Synapse(dj.Manual):
+        definition = """
+        primary_seg_id : bigint unsigned # id of the primary segment
+        secondary_seg_id : bigint unsigned # id of the segment synaptically paired to the primary segment
+        synapse_id : bigint unsigned # synapse index within the segmentation
+        """
+
+
+def drop_schemas(connection):
+    for name in schema_names:
+        connection.query(f'DROP DATABASE IF EXISTS `{name}`')
+
+
+class QueryTimer:
+    """
+    Counts the queries of a DataJoint connection and their wall time, including fetching results (cursors are buffered).
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.n_queries = 0
+        self.seconds = 0.
+
+    def _query(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._original(*args, **kwargs)
+        finally:
+            self.n_queries += 1
+            self.seconds += time.perf_counter() - start
+
+    def __enter__(self):
+        self._original = self.connection.query
+        self.connection.query = self._query
+        return self
+
+    def __exit__(self, *exc):
+        del self.connection.query
+
+
+def _stage_totals(table_name):
+    return {row['stage']: row for row in metrics_collector.summary() if row['table_name'] == table_name}
+
+
+def benchmark_populate(maker, restriction={}):
+    """
+    Populates a maker with reserved jobs, as the production drivers do, and measures it.
+
+    :returns: dict with maker, n_keys, n_errors, errors (first 5 messages), seconds, keys_per_s, db_s, db_s_per_key,
+        n_queries, peak_rss_bytes, rss_increase_bytes and stages (seconds, bytes and rows per stage, from utils.metrics_utils)
+    """
+    before = _stage_totals(maker.class_name)
+    with QueryTimer(dj.conn()) as timer, PeakRSS() as rss:
+        start = time.perf_counter()
+        errors = maker.populate(restriction, reserve_jobs=True, suppress_errors=True)
+        seconds = time.perf_counter() - start
+    after = _stage_totals(maker.class_name)
+    stages = {
+        name: {k: row[k] - before.get(name, {}).get(k, 0) for k in ('n_calls', 'n_errors', 'seconds', 'n_bytes', 'n_rows')}
+        for name, row in after.items()
+    }
+    n_keys = stages.get('make', {}).get('n_calls', 0)
+    result = {
+        'maker': maker.class_name,
+        'n_keys': n_keys,
+        'n_errors': len(errors),
+        'errors': [str(e) for _, e in errors[:5]],
+        'seconds': seconds,
+        'keys_per_s': n_keys / seconds if seconds else np.nan,
+        'db_s': timer.seconds,
+        'db_s_per_key': timer.seconds / n_keys if n_keys else np.nan,
+        'n_queries': timer.n_queries,
+        'peak_rss_bytes': rss.peak_bytes,
+        'rss_increase_bytes': rss.peak_bytes - rss.start_bytes,
+        'stages': stages,
+    }
+    logger.info(f'{maker.class_name}: {n_keys} keys ({len(errors)} errors) in {seconds:.1f} s, {result["keys_per_s"]:.2f} keys/s, {timer.seconds:.1f} s in {timer.n_queries} queries.')
+    return result
+
+
+def run_pipeline(dataset, compress_meshes=False, latency=0.):
+    """
+    Updates the methods and populates the makers of the pipeline on the configured server, with the stand-ins of dataset.
+
+    :returns: list of the results of benchmark_populate, one per maker, in the order populated
+    """
+    from .minnie_materialization import minnie65_materialization as m65
+
+    steps = [
+        (m65.ImportMethod.MaterializationVer, m65.Materialization.CAVE),
+        (m65.ImportMethod.NucleusSegment, m65.Nucleus.CAVE),
+        (None, m65.Segment.Nucleus),
+        (m65.ImportMethod.Synapse3, m65.Synapse.CAVE2),
+        (m65.ImportMethod.MeshPartyMesh3 if compress_meshes else m65.ImportMethod.MeshPartyMesh2, m65.Mesh.MeshParty),
+        (m65.ImportMethod.PCGSkeleton, m65.Skeleton.PCGSkeletonMaker),
+        (m65.ImportMethod.PCGMeshwork, m65.Meshwork.PCGMeshworkMaker),
+        (m65.MakeMethod.MeshworkAxonDendriteSkeleton, m65.Skeleton.MeshworkAxonDendriteSkeletonMaker),
+    ]
+    results = []
+    with synthetic_sources(m65, dataset, latency=latency):
+        for method, maker in steps:
+            if method is m65.MakeMethod.MeshworkAxonDendriteSkeleton:
+                method.update_method()
+            elif method is not None:
+                method.update_method(ver=dataset.ver)
+            results.append(benchmark_populate(maker))
+    metrics_collector.flush()
+    return results
+
+
+def git_commit(path=None):
+    """
+    :returns: (str) commit of the git checkout containing path, with "-dirty" appended if it has uncommitted changes,
+        or "" if path is not in a git checkout
+    """
+    cwd = Path(__file__).parent if path is None else Path(path)
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cwd, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    return commit + ('-dirty' if dirty else '')
+
+
+def run_benchmark(n_nuclei=100, ver=1, synapse_scale=0.1, mesh_scale=0.1, skeleton_scale=1., compress_meshes=False, latency=0., seed=0,
+                  db_host=None, db_user='root', db_password='benchmark', image='datajoint/mysql:5.7', keep=False, results_dir=None):
+    """
+    Runs the pipeline on synthetic data against a disposable server and saves the results.
+
+    :param n_nuclei, ver, synapse_scale, mesh_scale, skeleton_scale, seed: see SyntheticDataset
+    :param compress_meshes: (bool) download meshes with ImportMethod.MeshPartyMesh3 instead of MeshPartyMesh2
+    :param latency: (float) seconds slept by each CAVE query, see FakeCAVEclient
+    :param db_host: (str) host of an empty MySQL server. If None, a docker container of image is started and removed afterwards.
+    :param db_user, db_password: (str) credentials of the server
+    :param image: (str) docker image of the server
+    :param keep: (bool) keep the schemas on db_host
+    :param results_dir: (str or pathlib.Path) directory of the results. Defaults to default_results_dir.
+
+    :returns: dict of the results, also saved by save_results
+    """
+    logger.info('Benchmark initialized.')
+    dataset = SyntheticDataset(n_nuclei=n_nuclei, ver=ver, synapse_scale=synapse_scale, mesh_scale=mesh_scale, skeleton_scale=skeleton_scale, seed=seed)
+    logger.info(f'Generated {dataset}.')
+    with contextlib.ExitStack() as stack:
+        if db_host is None:
+            db_host = stack.enter_context(local_mysql(image=image, password=db_password))
+        store_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='microns-benchmark-'))
+        configure(db_host, db_user, db_password, store_dir)
+        connection = dj.conn()
+        check_empty_server(connection)
+        try:
+            create_legacy_schema()
+            start = time.perf_counter()
+            makers = run_pipeline(dataset, compress_meshes=compress_meshes, latency=latency)
+            seconds = time.perf_counter() - start
+        finally:
+            if not keep:
+                drop_schemas(connection)
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'params': {
+            'n_nuclei': n_nuclei, 'ver': ver, 'synapse_scale': synapse_scale, 'mesh_scale': mesh_scale, 'skeleton_scale': skeleton_scale,
+            'compress_meshes': compress_meshes, 'latency': latency, 'seed': seed,
+        },
+        'dataset': {'n_nuclei': len(dataset.tables['nucleus_detection_v0']), 'n_segments': len(dataset.segment_ids), 'n_synapses': len(dataset.tables['synapses_pni_2'])},
+        'seconds': seconds,
+        'makers': makers,
+    }
+    results['filepath'] = str(save_results(results, results_dir))
+    return results
+
+
+def save_results(results, results_dir=None):
+    """
+    Writes results to <results_dir>/<timestamp>_<commit>.json.
+
+    :returns: pathlib.Path of the file
+    """
+    results_dir = Path(default_results_dir if results_dir is None else results_dir)
+    results_dir.mkdir(parents=True, exist_ok=True)
+    stem = datetime.strptime(results['timestamp'], '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d_%H-%M-%S')
+    filepath = results_dir / f'{stem}_{results["commit"] or "nocommit"}.json'
+    filepath.write_text(json.dumps(results, indent=2, default=lambda x: x.item() if isinstance(x, np.generic) else str(x)))
+    logger.info(f'Saved results to {filepath}.')
+    return filepath
+
+
+def load_results(filepath):
+    """
+    :returns: dict of the results in a file written by save_results
+    """
+    return json.loads(Path(filepath).read_text())
+
+
+def results_frame(results):
+    """
+    :returns: pandas.DataFrame with one row per maker and the scalar metrics of benchmark_populate as columns
+    """
+    return pd.DataFrame([{k: v for k, v in m.items() if k not in ('errors', 'stages')} for m in results['makers']]).set_index('maker')
+
+
+def compare_results(baseline, candidate, threshold=0.1):
+    """
+    Compares the metrics of compared_metrics of two runs, for each maker of benchmarked_makers.
+
+    Runs are only comparable if they used the same params (scale, seed, ...), which is checked.
+
+    :param baseline, candidate: dicts of results, e.g. from load_results
+    :param threshold: (float) relative change in the worse direction flagged as a regression
+
+    :returns: pandas.DataFrame with one row per maker and metric, with columns baseline, candidate, change (relative) and regression
+    """
+    if baseline['params'] != candidate['params']:
+        raise ValueError(f'Runs used different params: {baseline["params"]} and {candidate["params"]}.')
+    base, cand = results_frame(baseline), results_frame(candidate)
+    rows = []
+    for maker in [m for m in benchmarked_makers if m in base.index and m in cand.index]:
+        for metric, higher_is_better in compared_metrics:
+            b, c = base.loc[maker, metric], cand.loc[maker, metric]
+            change = (c - b) / b if b else np.nan
+            rows.append({
+                'maker': maker,
+                'metric': metric,
+                'baseline': b,
+                'candidate': c,
+                'change': change,
+                'regression': bool(-change > threshold if higher_is_better else change > threshold),
+            })
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='run the benchmark and save the results')
+    run.add_argument('--n-nuclei', type=int, default=100)
+    run.add_argument('--ver', type=int, default=1)
+    run.add_argument('--synapse-scale', type=float, default=0.1)
+    run.add_argument('--mesh-scale', type=float, default=0.1)
+    run.add_argument('--skeleton-scale', type=float, default=1.)
+    run.add_argument('--compress-meshes', action='store_true')
+    run.add_argument('--latency', type=float, default=0., help='seconds slept by each CAVE query')
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--db-host', help='empty MySQL server to use instead of a docker container')
+    run.add_argument('--db-user', default='root')
+    run.add_argument('--db-password', default='benchmark')
+    run.add_argument('--image', default='datajoint/mysql:5.7')
+    run.add_argument('--keep', action='store_true', help='keep the schemas on --db-host')
+    run.add_argument('--results-dir')
+
+    compare = subparsers.add_parser('compare', help='compare two results files and exit with status 1 on regressions')
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+    compare.add_argument('--threshold', type=float, default=0.1)
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        results = run_benchmark(
+            n_nuclei=args.n_nuclei, ver=args.ver, synapse_scale=args.synapse_scale, mesh_scale=args.mesh_scale, skeleton_scale=args.skeleton_scale,
+            compress_meshes=args.compress_meshes, latency=args.latency, seed=args.seed, db_host=args.db_host, db_user=args.db_user,
+            db_password=args.db_password, image=args.image, keep=args.keep, results_dir=args.results_dir,
+        )
+        print(results_frame(results)[['n_keys', 'n_errors', 'seconds', 'keys_per_s', 'db_s', 'n_queries', 'peak_rss_bytes']].to_string())
+        print(f'Saved to {results["filepath"]}')
+    elif args.command == 'compare':
+        df = compare_results(load_results(args.baseline), load_results(args.candidate), threshold=args.threshold)
+        print(df.to_string(index=False))
+        if df['regression'].any():
+            sys.exit(1)
@@ -8,12 +8,35 @@ import datajoint as dj
 import datajoint_plus as djp
 import numpy as np
 import pandas as pd
-import pcg_skel
-from meshparty import trimesh_io
 
 # Schema creation
+from microns_materialization_api.config import externals
+from microns_materialization_api.utils.audit_utils import (audit_store,
+                                                           quarantine_files)
+from microns_materialization_api.utils.connectivity_utils import \
+    build_connectome
+from microns_materialization_api.utils.filepath_utils import (
+    fetch_filepaths, migrate_to_sharded_layout, shard_dir)
+from microns_materialization_api.utils.mesh_utils import (build_mesh_lods,
+                                                          compress_mesh_file,
+                                                          compute_mesh_stats)
+from microns_materialization_api.utils.metrics_utils import (file_size,
+                                                             instrumented,
+                                                             stage)
+from microns_materialization_api.utils.morphology_utils import \
+    compute_skeleton_metrics
+from microns_materialization_api.utils.pack_utils import write_skeleton_pack
+from microns_materialization_api.utils.profile_utils import profiling
+from microns_materialization_api.utils.recompress_utils import (
+    recompress_files, summarize as summarize_recompression, update_external_contents)
+from microns_materialization_api.utils.parquet_utils import (ParquetPartition,
+                                                             chunk_keys_by_size)
 from microns_materialization_api.utils.skeleton_utils import \
     convert_skeleton_to_nodes_edges
+from microns_materialization_api.utils.spatial_utils import (GridIndex,
+                                                             voxels_to_nm)
+from microns_materialization_api.utils.summary_utils import rows_to_write
+from microns_materialization_api.utils.synapse_utils import to_pre_post
 
 from microns_materialization_api.schemas import \
     minnie65_materialization as m65mat
@@ -25,7 +48,6 @@ logger = djp.getLogger(__name__)
 
 # Utils
 from microns_utils.adapter_utils import adapt_mesh_hdf5
-from microns_utils.ap_utils import set_CAVEclient
 from microns_utils.filepath_utils import (append_timestamp_to_filepath,
                                           get_file_modification_time)
 from microns_utils.misc_utils import wrap
@@ -35,18 +57,128 @@ from microns_utils.version_utils import \
 # TODO: Deal with filter out unrestricted
 
 import os
-cvt = os.getenv('CLOUDVOLUME_TOKEN')
-assert cvt is not None, 'No cloudvolume token found'
+
+
+def cave_client(datastack, ver=None):
+    """
+    Returns a CAVEclient authenticated with CLOUDVOLUME_TOKEN.
+
+    caveclient and cloudvolume are imported and the token is checked on the first call, not on import of this module.
+    """
+    from microns_utils.ap_utils import set_CAVEclient
+    cvt = os.getenv('CLOUDVOLUME_TOKEN')
+    assert cvt is not None, 'No cloudvolume token found'
+    with stage('cave_client'):
+        return set_CAVEclient(datastack, ver, caveclient_kws={'auth_token': cvt})
 
 
 class Tag(m65mat.Tag):
     pass
 
 
+class MeshPartyMeshMethod:
+    """
+    update_method and run shared by ImportMethod.MeshPartyMesh2 and ImportMethod.MeshPartyMesh3, which download meshes with meshparty.
+        Subclasses change the downloaded file in process_file before it is timestamped.
+    """
+    @classmethod
+    def method_row(cls, ver=None, download_meshes_kwargs=None):
+        """
+        :param ver: materialization version. If None, the latest version.
+        :param download_meshes_kwargs: (dict) passed to meshparty.trimesh_io.download_meshes, on top of the defaults below
+
+        :returns: dict of the attributes of the method row
+        """
+        datastack = 'minnie65_phase3_v1'
+        download_meshes_kwargs = {
+            'overwrite': False,
+            'n_threads': 10,
+            'verbose': False,
+            'stitch_mesh_chunks': True,
+            'merge_large_components': False,
+            'remove_duplicate_vertices': True,
+            'map_gs_to_https': True,
+            'fmt': "hdf5",
+            'save_draco': False,
+            'chunk_size': None,
+            'progress': False,
+            **(download_meshes_kwargs or {}),
+        }
+        client = cave_client(datastack, ver)
+        return {
+            'description' : '',
+            'meshparty_version': cpvfd('meshparty'),
+            'cloudvolume_version': cpvfd('cloud-volume'),
+            'caveclient_version': cpvfd('caveclient'),
+            'datastack': datastack,
+            'ver': ver if ver is not None else client.materialize.version,
+            'cloudvolume_path': client.info.segmentation_source(),
+            'download_meshes_kwargs': json.dumps(download_meshes_kwargs),
+            'target_dir': config.externals['minnie65_meshes']['location'],
+        }
+
+    @classmethod
+    def update_method(cls, ver=None, download_meshes_kwargs=None, **kwargs):
+        cls.Log('info', f'Updating method for {cls.class_name}.')
+        cls.insert1(cls.method_row(ver=ver, download_meshes_kwargs=download_meshes_kwargs), insert_to_master=True, skip_duplicates=True)
+
+    def process_file(self, filepath, params):
+        """
+        Changes the downloaded mesh file in place. Does nothing by default.
+        """
+        pass
+
+    def run(self, **kwargs):
+        params = (self & kwargs).fetch1()
+        self.Log('info', f'Running {self.class_name} with params {params}.')
+
+        # INITIALIZE & VALIDATE
+        client = cave_client(params['datastack'], params['ver'])
+        packages = {
+            'meshparty_version': 'meshparty',
+            'caveclient_version': 'caveclient',
+            'cloudvolume_version': 'cloud-volume'
+        }
+        self.master.validate_method(
+            names=list(packages.keys()) + ['cloudvolume_path', 'datastack', 'materialization_version'],
+            method_values=[params[k] for k in packages.keys()] + [params['cloudvolume_path'], params['datastack'], params['ver']],
+            current_values=[cpvfd(v) for v in packages.values()] + [client.info.segmentation_source(), client.materialize.datastack_name, client.materialize.version]
+        )
+
+        # IMPORT DATA
+        segment_id = kwargs['segment_id']
+        target_dir = shard_dir(params['target_dir'], f'{segment_id}.h5')
+
+        filepath = Path(target_dir).joinpath(str(segment_id)).with_suffix('.h5')
+
+        from meshparty import trimesh_io
+        with stage('download') as st:
+            trimesh_io.download_meshes(seg_ids=wrap(segment_id), target_dir=target_dir, cv_path=params['cloudvolume_path'], **json.loads(params['download_meshes_kwargs']))
+            st.add(n_bytes=file_size(filepath))
+
+        self.process_file(filepath, params)
+
+        # append timestamp to filepath 
+        with stage('rename'):
+            ts_computed = get_file_modification_time(filepath, timezone='US/Central', fmt="%Y-%m-%d_%H:%M:%S")
+            filepath = append_timestamp_to_filepath(filepath, ts_computed, return_filepath=True)
+        
+        # get mesh data
+        with stage('read'):
+            n_vertices, n_faces, info_dict = adapt_mesh_hdf5(filepath=filepath, parse_filepath_stem=True, filepath_has_timestamp=True, separator='__', as_lengths=True)
+        assert kwargs['segment_id'] == info_dict['segment_id'], 'segment_id in filepath does not match provided segment_id.' # sanity check
+        
+        info_dict['ts_computed'] = str(info_dict.pop('timestamp'))
+        info_dict['mesh'] = info_dict.pop('filepath')
+
+        return {'n_vertices': n_vertices, 'n_faces': n_faces, **info_dict}
+
+
 class ImportMethod(m65mat.ImportMethod):
     @classmethod
     def run(cls, key):
-        return cls.r1p(key).run(**key)
+        with stage('run'):
+            return cls.r1p(key).run(**key)
 
     @classmethod
     def validate_method(cls, names, method_values, current_values):
@@ -68,7 +200,7 @@ class ImportMethod(m65mat.ImportMethod):
             datastack = 'minnie65_phase3_v1'
             
             # INSERT
-            client = set_CAVEclient(datastack, ver, caveclient_kws={'auth_token': cvt})
+            client = cave_client(datastack, ver)
             cls.insert1({
                 'caveclient_version': cpvfd('caveclient'),
                 'datastack': datastack,
@@ -80,7 +212,7 @@ class ImportMethod(m65mat.ImportMethod):
             self.Log('info', f'Running {self.class_name} with params {params}.')
 
             # INITIALIZE & VALIDATE
-            client = set_CAVEclient(params['datastack'], ver=params['ver'], caveclient_kws={'auth_token': cvt})
+            client = cave_client(params['datastack'], params['ver'])
             self.master.validate_method(
                 names=('caveclient version', 'datastack', 'materialization_version'),
                 method_values=(params['caveclient_version'], params['datastack'], params['ver']),
@@ -101,7 +233,7 @@ class ImportMethod(m65mat.ImportMethod):
             datastack = 'minnie65_phase3_v1'
 
             # INSERT
-            client = set_CAVEclient(datastack, ver, caveclient_kws={'auth_token': cvt})
+            client = cave_client(datastack, ver)
             cls.insert1({
                 'caveclient_version': cpvfd('caveclient'),
                 'datastack': datastack,
@@ -113,7 +245,7 @@ class ImportMethod(m65mat.ImportMethod):
             self.Log('info', f'Running {self.class_name} with params {params}.')
             
             # INITIALIZE & VALIDATE
-            client = set_CAVEclient(params['datastack'], ver=params['ver'], caveclient_kws={'auth_token': cvt})
+            client = cave_client(params['datastack'], params['ver'])
             self.master.validate_method(
                 names=('caveclient version', 'datastack', 'materialization_version'),
                 method_values=(params['caveclient_version'], params['datastack'], params['ver']),
@@ -121,7 +253,9 @@ class ImportMethod(m65mat.ImportMethod):
             )
 
             # IMPORT DATA
-            df = client.materialize.query_table('nucleus_detection_v0')
+            with stage('cave') as st:
+                df = client.materialize.query_table('nucleus_detection_v0')
+                st.add(n_rows=len(df))
             rename_dict = {
                 'id': 'nucleus_id',
                 'pt_root_id': 'segment_id',
@@ -145,82 +279,24 @@ class ImportMethod(m65mat.ImportMethod):
             self.Log('error', msg)
             raise Exception(msg)
 
-    class MeshPartyMesh2(m65mat.ImportMethod.MeshPartyMesh2):
+    class MeshPartyMesh2(MeshPartyMeshMethod, m65mat.ImportMethod.MeshPartyMesh2): pass
+    
+    class MeshPartyMesh3(MeshPartyMeshMethod, m65mat.ImportMethod.MeshPartyMesh3):
         @classmethod
-        def update_method(cls, ver=None, download_meshes_kwargs={}, **kwargs):
+        def update_method(cls, ver=None, download_meshes_kwargs=None, storage_kwargs=None, **kwargs):
             cls.Log('info', f'Updating method for {cls.class_name}.')
-            
-            # DEFAULTS
-            datastack = 'minnie65_phase3_v1'           
-            download_meshes_kwargs.setdefault('overwrite', False)
-            download_meshes_kwargs.setdefault('n_threads', 10)
-            download_meshes_kwargs.setdefault('verbose', False)
-            download_meshes_kwargs.setdefault('stitch_mesh_chunks', True)
-            download_meshes_kwargs.setdefault('merge_large_components', False)
-            download_meshes_kwargs.setdefault('remove_duplicate_vertices', True)
-            download_meshes_kwargs.setdefault('map_gs_to_https', True)
-            download_meshes_kwargs.setdefault('fmt', "hdf5")
-            download_meshes_kwargs.setdefault('save_draco', False)
-            download_meshes_kwargs.setdefault('chunk_size', None)
-            download_meshes_kwargs.setdefault('progress', False)
-
-            # INSERT
-            client = set_CAVEclient(datastack, ver, caveclient_kws={'auth_token': cvt})
+            storage_kwargs = {'vertex_decimals': 0, 'compression': 'gzip', 'compression_opts': 4, **(storage_kwargs or {})}
             cls.insert1(
-                {
-                    'description' : '',
-                    'meshparty_version': cpvfd('meshparty'),
-                    'cloudvolume_version': cpvfd('cloud-volume'),
-                    'caveclient_version': cpvfd('caveclient'),
-                    'datastack': datastack,
-                    'ver': ver if ver is not None else client.materialize.version,
-                    'cloudvolume_path': client.info.segmentation_source(),
-                    'download_meshes_kwargs': json.dumps(download_meshes_kwargs),
-                    'target_dir': config.externals['minnie65_meshes']['location'],
-                    
-                },
+                {**cls.method_row(ver=ver, download_meshes_kwargs=download_meshes_kwargs), 'storage_kwargs': json.dumps(storage_kwargs)},
                 insert_to_master=True, 
                 skip_duplicates=True, 
             )
 
-        def run(self, **kwargs):
-            params = (self & kwargs).fetch1()
-            self.Log('info', f'Running {self.class_name} with params {params}.')
-
-            # INITIALIZE & VALIDATE
-            client = set_CAVEclient(params['datastack'], params['ver'], caveclient_kws={'auth_token': cvt})
-            packages = {
-                'meshparty_version': 'meshparty',
-                'caveclient_version': 'caveclient',
-                'cloudvolume_version': 'cloud-volume'
-            }
-            self.master.validate_method(
-                names=list(packages.keys()) + ['cloudvolume_path', 'datastack', 'materialization_version'],
-                method_values=[params[k] for k in packages.keys()] + [params['cloudvolume_path'], params['datastack'], params['ver']],
-                current_values=[cpvfd(v) for v in packages.values()] + [client.info.segmentation_source(), client.materialize.datastack_name, client.materialize.version]
-            )
-
-            # IMPORT DATA
-            segment_id = kwargs['segment_id']
-            target_dir = params['target_dir']
-
-            trimesh_io.download_meshes(seg_ids=wrap(segment_id), target_dir=target_dir, cv_path=params['cloudvolume_path'], **json.loads(params['download_meshes_kwargs']))
-
-            # make file path
-            filepath = Path(target_dir).joinpath(str(segment_id)).with_suffix('.h5')
-
-            # append timestamp to filepath 
-            ts_computed = get_file_modification_time(filepath, timezone='US/Central', fmt="%Y-%m-%d_%H:%M:%S")
-            filepath = append_timestamp_to_filepath(filepath, ts_computed, return_filepath=True)
-            
-            # get mesh data
-            n_vertices, n_faces, info_dict = adapt_mesh_hdf5(filepath=filepath, parse_filepath_stem=True, filepath_has_timestamp=True, separator='__', as_lengths=True)
-            assert kwargs['segment_id'] == info_dict['segment_id'], 'segment_id in filepath does not match provided segment_id.' # sanity check
-            
-            info_dict['ts_computed'] = str(info_dict.pop('timestamp'))
-            info_dict['mesh'] = info_dict.pop('filepath')
-
-            return {'n_vertices': n_vertices, 'n_faces': n_faces, **info_dict}
+        def process_file(self, filepath, params):
+            # compress in place
+            with stage('write') as st:
+                compress_mesh_file(filepath, filepath, **json.loads(params['storage_kwargs']))
+                st.add(n_bytes=file_size(filepath))
     
     class Synapse(m65mat.ImportMethod.Synapse):
         @classmethod
@@ -251,7 +327,7 @@ class ImportMethod(m65mat.ImportMethod):
         def update_method(cls, ver=None, datastack='minnie65_phase3_v1', **kwargs):
             cls.Log('info', f'Updating method for {cls.class_name}.')
             # INSERT
-            client = set_CAVEclient(datastack, ver, caveclient_kws={'auth_token': cvt})
+            client = cave_client(datastack, ver)
             cls.insert1({
                 'caveclient_version': cpvfd('caveclient'),
                 'datastack': datastack,
@@ -264,7 +340,7 @@ class ImportMethod(m65mat.ImportMethod):
             self.Log('info', f'Running {self.class_name} with params {params}.')
             
             # INITIALIZE & VALIDATE
-            client = set_CAVEclient(params['datastack'], ver=params['ver'], caveclient_kws={'auth_token': cvt})
+            client = cave_client(params['datastack'], params['ver'])
             self.master.validate_method(
                 names=('caveclient version', 'datastack', 'materialization_version', Tag.attr_name),
                 method_values=(params['caveclient_version'], params['datastack'], params['ver'], params[Tag.attr_name]),
@@ -275,7 +351,9 @@ class ImportMethod(m65mat.ImportMethod):
             primary_seg_id = int(kwargs['primary_seg_id'])
 
             # get synapses where primary segment is presynaptic
-            df_pre = client.materialize.query_table('synapses_pni_2', filter_equal_dict={'pre_pt_root_id': primary_seg_id})
+            with stage('cave') as st:
+                df_pre = client.materialize.query_table('synapses_pni_2', filter_equal_dict={'pre_pt_root_id': primary_seg_id})
+                st.add(n_rows=len(df_pre))
             df_pre = df_pre.rename(columns={'pre_pt_root_id':'primary_seg_id', 'post_pt_root_id': 'secondary_seg_id'})
             df_pre['prepost'] = 'presyn'
             df_pre.attrs = {} # needed because the attrs in the returned dataframe break pd.concat
@@ -286,7 +364,9 @@ class ImportMethod(m65mat.ImportMethod):
             # df_pre_as_post['prepost'] = 'postsyn'
 
             # get synapses where primary segment is postsynaptic
-            df_post = client.materialize.query_table('synapses_pni_2', filter_equal_dict={'post_pt_root_id': primary_seg_id})
+            with stage('cave') as st:
+                df_post = client.materialize.query_table('synapses_pni_2', filter_equal_dict={'post_pt_root_id': primary_seg_id})
+                st.add(n_rows=len(df_post))
             df_post = df_post.rename(columns={'post_pt_root_id':'primary_seg_id', 'pre_pt_root_id': 'secondary_seg_id'})
             df_post['prepost'] = 'postsyn'
 
@@ -336,7 +416,7 @@ class ImportMethod(m65mat.ImportMethod):
             pcg_meshwork_params.setdefault('root_point_resolution', [4,4,40])
 
             # INSERT
-            client = set_CAVEclient(datastack, ver, caveclient_kws={'auth_token': cvt})
+            client = cave_client(datastack, ver)
             cls.insert1(
                 {
                     'meshparty_version': cpvfd('meshparty'),
@@ -361,7 +441,7 @@ class ImportMethod(m65mat.ImportMethod):
             self.Log('info', f'Running {self.class_name} with params {params}.')
 
             # INITIALIZE & VALIDATE
-            client = set_CAVEclient(params['datastack'], ver=params['ver'], caveclient_kws={'auth_token': cvt})
+            client = cave_client(params['datastack'], params['ver'])
 
             # validate package dependencies
             packages = {
@@ -385,14 +465,18 @@ class ImportMethod(m65mat.ImportMethod):
             pcg_meshwork_params = json.loads(params['pcg_meshwork_params'])
 
             # check that segment has synapses
-            n_presyn = len(client.materialize.query_table(synapse_table, filter_equal_dict={'pre_pt_root_id': segment_id}))
-            n_postsyn = len(client.materialize.query_table(synapse_table, filter_equal_dict={'pre_pt_root_id': segment_id}))
+            with stage('cave') as st:
+                n_presyn = len(client.materialize.query_table(synapse_table, filter_equal_dict={'pre_pt_root_id': segment_id}))
+                n_postsyn = len(client.materialize.query_table(synapse_table, filter_equal_dict={'pre_pt_root_id': segment_id}))
+                st.add(n_rows=n_presyn + n_postsyn)
             if not (n_presyn > 0 or n_postsyn > 0):
                 self.Log('info', f'No synapses found for segment_id {segment_id} in {synapse_table}.')
                 return {'meshwork_obj': []}
 
             # check if segment has nucleus
-            nuc_df = client.materialize.query_table(nucleus_table, filter_equal_dict={'pt_root_id': segment_id})
+            with stage('cave') as st:
+                nuc_df = client.materialize.query_table(nucleus_table, filter_equal_dict={'pt_root_id': segment_id})
+                st.add(n_rows=len(nuc_df))
             if len(nuc_df) > 0: 
                 soma_centroid = nuc_df.pt_position.values[0]
             else: 
@@ -400,23 +484,28 @@ class ImportMethod(m65mat.ImportMethod):
                 soma_centroid = None
 
             # download meshwork obj
-            meshwork_obj = pcg_skel.pcg_meshwork(
-                root_id=segment_id,
-                client=client,
-                root_point=soma_centroid,
-                synapse_table=synapse_table,
-                **pcg_meshwork_params
-            )
+            import pcg_skel
+            with stage('download'):
+                meshwork_obj = pcg_skel.pcg_meshwork(
+                    root_id=segment_id,
+                    client=client,
+                    root_point=soma_centroid,
+                    synapse_table=synapse_table,
+                    **pcg_meshwork_params
+                )
 
             # make file path
-            filepath = Path(target_dir).joinpath(str(segment_id)).with_suffix('.h5')
+            filepath = shard_dir(target_dir, f'{segment_id}.h5').joinpath(str(segment_id)).with_suffix('.h5')
 
             # save meshwork file
-            meshwork_obj.save_meshwork(filepath)
+            with stage('write') as st:
+                meshwork_obj.save_meshwork(filepath)
+                st.add(n_bytes=file_size(filepath))
 
             # append timestamp to filepath 
-            ts_computed = get_file_modification_time(filepath, timezone='US/Central', fmt="%Y-%m-%d_%H:%M:%S")
-            filepath = append_timestamp_to_filepath(filepath, ts_computed, return_filepath=True)
+            with stage('rename'):
+                ts_computed = get_file_modification_time(filepath, timezone='US/Central', fmt="%Y-%m-%d_%H:%M:%S")
+                filepath = append_timestamp_to_filepath(filepath, ts_computed, return_filepath=True)
             
             return {
                 'segment_id': segment_id, 
@@ -438,7 +527,7 @@ class ImportMethod(m65mat.ImportMethod):
             pcg_skel_params.setdefault('root_point_resolution', [4,4,40])
 
             # INSERT
-            client = set_CAVEclient(datastack, ver, caveclient_kws={'auth_token': cvt})
+            client = cave_client(datastack, ver)
             cls.insert1(
                 {
                     'meshparty_version': cpvfd('meshparty'),
@@ -464,7 +553,7 @@ class ImportMethod(m65mat.ImportMethod):
             self.Log('info', f'Running {self.class_name} with params {params}.')
 
             # INITIALIZE & VALIDATE
-            client = set_CAVEclient(params['datastack'], ver=params['ver'], caveclient_kws={'auth_token': cvt})
+            client = cave_client(params['datastack'], params['ver'])
 
             # validate package dependencies
             packages = {
@@ -487,7 +576,9 @@ class ImportMethod(m65mat.ImportMethod):
             pcg_skel_params = json.loads(params['pcg_skel_params'])
 
             # check if segment has nucleus
-            nuc_df = client.materialize.query_table(nucleus_table, filter_equal_dict={'pt_root_id': segment_id})
+            with stage('cave') as st:
+                nuc_df = client.materialize.query_table(nucleus_table, filter_equal_dict={'pt_root_id': segment_id})
+                st.add(n_rows=len(nuc_df))
             if len(nuc_df) > 0: 
                 soma_centroid = nuc_df.pt_position.values[0]
             else:
@@ -495,22 +586,27 @@ class ImportMethod(m65mat.ImportMethod):
                 soma_centroid = None
 
             # download skeleton obj
-            skeleton_obj = pcg_skel.pcg_skeleton(
-                root_id=segment_id,
-                client=client,
-                root_point=soma_centroid,
-                **pcg_skel_params
-            )
+            import pcg_skel
+            with stage('download'):
+                skeleton_obj = pcg_skel.pcg_skeleton(
+                    root_id=segment_id,
+                    client=client,
+                    root_point=soma_centroid,
+                    **pcg_skel_params
+                )
 
             # make file path
-            filepath = Path(target_dir).joinpath(str(segment_id)).with_suffix('.h5')
+            filepath = shard_dir(target_dir, f'{segment_id}.h5').joinpath(str(segment_id)).with_suffix('.h5')
 
             # save skeleton file
-            skeleton_obj.write_to_h5(filepath)
+            with stage('write') as st:
+                skeleton_obj.write_to_h5(filepath)
+                st.add(n_bytes=file_size(filepath))
 
             # append timestamp to filepath 
-            ts_computed = get_file_modification_time(filepath, timezone='US/Central', fmt="%Y-%m-%d_%H:%M:%S")
-            filepath = append_timestamp_to_filepath(filepath, ts_computed, return_filepath=True)
+            with stage('rename'):
+                ts_computed = get_file_modification_time(filepath, timezone='US/Central', fmt="%Y-%m-%d_%H:%M:%S")
+                filepath = append_timestamp_to_filepath(filepath, ts_computed, return_filepath=True)
             
             return {
                 'segment_id': segment_id, 
@@ -523,7 +619,8 @@ class ImportMethod(m65mat.ImportMethod):
 class MakeMethod(m65mat.MakeMethod):
     @classmethod
     def run(cls, key):
-        return cls.r1p(key).run(**key)
+        with stage('run'):
+            return cls.r1p(key).run(**key)
     
     class MeshworkAxonDendriteSkeleton(m65mat.MakeMethod.MeshworkAxonDendriteSkeleton):
         @classmethod
@@ -539,9 +636,13 @@ class MakeMethod(m65mat.MakeMethod):
             assert params.get('tag') == Tag.version, 'Tag version mismatch'
             assert params.get('pcg_skel_version') == cpvfd('pcg-skel'), 'pcg-skel version mismatch'
 
-            meshwork_obj = (m65mat.Meshwork.PCGMeshwork & {'meshwork_id': meshwork_id}).fetch1('meshwork_obj')
+            # fetched rather than loaded by path, so the checksum of the file is verified before the split is computed
+            with stage('read'):
+                meshwork_obj = (m65mat.Meshwork.PCGMeshwork & {'meshwork_id': meshwork_id}).fetch1('meshwork_obj')
 
-            is_axon, score = pcg_skel.meshwork.algorithms.split_axon_by_synapses(meshwork_obj, meshwork_obj.anno.pre_syn.mesh_index, meshwork_obj.anno.post_syn.mesh_index)
+            import pcg_skel
+            with stage('compute'):
+                is_axon, score = pcg_skel.meshwork.algorithms.split_axon_by_synapses(meshwork_obj, meshwork_obj.anno.pre_syn.mesh_index, meshwork_obj.anno.post_syn.mesh_index)
             # This does ignore any edges with a vertex in the axon and another vertex in the dendrites indices
             axon_index_set = set(is_axon.to_skel_index.tolist())
             axon_edges = np.array([row for row in meshwork_obj.skeleton.edges if (row[0] in axon_index_set) and (row[1] in axon_index_set)])
@@ -553,11 +654,13 @@ class MakeMethod(m65mat.MakeMethod):
             axon_vertices, axon_edges = convert_skeleton_to_nodes_edges(axon_skeleton)
             dendrite_vertices, dendrite_edges = convert_skeleton_to_nodes_edges(dendrite_skeleton)
 
-            axon_skeleton_fp = Path(target_dir).joinpath(f'{meshwork_id}_axon_skeleton.npz')
-            dendrite_skeleton_fp = Path(target_dir).joinpath(f'{meshwork_id}_dendrite_skeleton.npz')
+            axon_skeleton_fp = shard_dir(target_dir, f'{meshwork_id}_axon_skeleton.npz').joinpath(f'{meshwork_id}_axon_skeleton.npz')
+            dendrite_skeleton_fp = shard_dir(target_dir, f'{meshwork_id}_dendrite_skeleton.npz').joinpath(f'{meshwork_id}_dendrite_skeleton.npz')
 
-            np.savez(axon_skeleton_fp, vertices=axon_vertices, edges=axon_edges)
-            np.savez(dendrite_skeleton_fp, vertices=dendrite_vertices, edges=dendrite_edges)
+            with stage('write') as st:
+                np.savez(axon_skeleton_fp, vertices=axon_vertices, edges=axon_edges)
+                np.savez(dendrite_skeleton_fp, vertices=dendrite_vertices, edges=dendrite_edges)
+                st.add(n_bytes=file_size(axon_skeleton_fp) + file_size(dendrite_skeleton_fp))
 
             return {
                 'meshwork_id': meshwork_id,
@@ -567,6 +670,161 @@ class MakeMethod(m65mat.MakeMethod):
                 'split_score': score
             }
 
+    class SynapseConnectome(m65mat.MakeMethod.SynapseConnectome):
+        @classmethod
+        def update_method(cls):
+            cls.insert1({Tag.attr_name: Tag.version,
+                         'target_dir': config.externals['minnie65_connectomes']['location'],
+            }, insert_to_master=True, skip_duplicates=True)
+
+        def run(self, ver, chunk_size=5_000_000, **kwargs):
+            params = (self & kwargs).fetch1()
+            target_dir = params.get('target_dir')
+            assert params.get(Tag.attr_name) == Tag.version, 'Tag version mismatch'
+
+            # aggregate edges per chunk of primary segments to bound memory
+            rel = Synapse.Info2 & {'ver': ver}
+            primary_seg_ids, counts = dj.U('primary_seg_id').aggr(rel, n='count(*)').fetch('primary_seg_id', 'n', order_by='primary_seg_id')
+            edges, n_synapses = [], 0
+            for chunk in chunk_keys_by_size(primary_seg_ids, counts, chunk_size):
+                with stage('fetch') as st:
+                    df = (rel & f'primary_seg_id in ({",".join(str(int(k)) for k in chunk)})').proj('prepost', 'synapse_size').fetch(format='frame').reset_index()
+                    st.add(n_rows=len(df))
+                df = to_pre_post(df, primary_seg_ids)
+                n_synapses += len(df)
+                edges.append(df.groupby(['pre_seg_id', 'post_seg_id']).synapse_size.agg(['count', 'sum']).reset_index())
+            self.Log('info', f'Building connectome from {n_synapses} synapses.')
+            edges = pd.concat(edges) if edges else pd.DataFrame(columns=['pre_seg_id', 'post_seg_id', 'count', 'sum'])
+            arrays = build_connectome(edges['pre_seg_id'], edges['post_seg_id'], edges['count'], edges['sum'])
+
+            filepath = Path(target_dir).joinpath(f'{ver}_{params["make_method"]}_connectome.npz')
+            with stage('write') as st:
+                np.savez(filepath, **arrays)
+                st.add(n_bytes=file_size(filepath))
+
+            return {
+                'ver': ver,
+                'make_method': params['make_method'],
+                'n_segments': len(arrays['segment_ids']),
+                'n_edges': len(arrays['counts']),
+                'n_synapses': n_synapses,
+                'connectome_obj': filepath,
+            }
+
+
+    class MeshLOD(m65mat.MakeMethod.MeshLOD):
+        @classmethod
+        def update_method(cls, fractions=(0.1, 0.01, 0.001)):
+            cls.insert1({Tag.attr_name: Tag.version,
+                         'fractions': json.dumps(sorted(fractions, reverse=True)),
+                         'target_dir': config.externals['minnie65_mesh_lods']['location'],
+            }, insert_to_master=True, skip_duplicates=True)
+
+        def run(self, mesh_ids, mesh_filepaths, n_workers=None, **kwargs):
+            """
+            Builds the levels of detail of many meshes in a process pool.
+
+            :returns: list of results in the order of mesh_ids, None for meshes that failed
+            """
+            params = (self & kwargs).fetch1()
+            target_dir = params.get('target_dir')
+            assert params.get(Tag.attr_name) == Tag.version, 'Tag version mismatch'
+
+            lod_filepaths = [Path(target_dir).joinpath(f'{mesh_id}_{params["make_method"]}_lod.h5') for mesh_id in mesh_ids]
+            with stage('write') as st:
+                levels = build_mesh_lods(mesh_filepaths, lod_filepaths, json.loads(params['fractions']), n_workers=n_workers)
+                st.add(n_bytes=sum(file_size(filepath) for filepath in lod_filepaths))
+            return [
+                None if l is None else {
+                    'mesh_id': mesh_id,
+                    'make_method': params['make_method'],
+                    'n_levels': len(l),
+                    'lod_obj': filepath,
+                    'levels': l,
+                }
+                for mesh_id, filepath, l in zip(mesh_ids, lod_filepaths, levels)
+            ]
+
+    class SkeletonPack(m65mat.MakeMethod.SkeletonPack):
+        @classmethod
+        def update_method(cls):
+            cls.insert1({Tag.attr_name: Tag.version,
+                         'target_dir': config.externals['minnie65_skeleton_packs']['location'],
+            }, insert_to_master=True, skip_duplicates=True)
+
+        def run(self, ver, n_workers=16, **kwargs):
+            """
+            Packs the PCG skeletons and axon/dendrite skeletons of the segments of a version into one file.
+            """
+            params = (self & kwargs).fetch1()
+            target_dir = params.get('target_dir')
+            assert params.get(Tag.attr_name) == Tag.version, 'Tag version mismatch'
+
+            segments = Segment.Nucleus & {'ver': ver}
+            pcg_df = fetch_filepaths(Skeleton.PCGSkeleton & (Skeleton.PCGSkeletonMaker & segments), 'skeleton_obj', order_by='skeleton_id')
+            ad_makers = ((Meshwork.PCGMeshworkMaker.proj() & segments) * Skeleton.MeshworkAxonDendriteSkeletonMaker.proj()).proj(skeleton_id='skeleton_make_id')
+            ad_df = fetch_filepaths(Skeleton.MeshworkAxonDendriteSkeleton & ad_makers, 'axon_skeleton', 'dendrite_skeleton', order_by='skeleton_id')
+            filepaths = {
+                'skeleton_obj': list(zip(pcg_df['skeleton_id'], pcg_df['skeleton_obj'])),
+                'axon_skeleton': list(zip(ad_df['skeleton_id'], ad_df['axon_skeleton'])),
+                'dendrite_skeleton': list(zip(ad_df['skeleton_id'], ad_df['dendrite_skeleton'])),
+            }
+
+            filepath = Path(target_dir).joinpath(f'{ver}_{params["make_method"]}_skeleton_pack.h5')
+            with stage('write') as st:
+                members = write_skeleton_pack(filepath, filepaths, n_workers=n_workers)
+                st.add(n_bytes=file_size(filepath))
+
+            return {
+                'ver': ver,
+                'make_method': params['make_method'],
+                'n_skeletons': sum(len(m) for m in members.values()),
+                'pack_obj': filepath,
+                'members': [{'skeleton_id': skeleton_id, 'attr_name': attr_name, 'idx': idx} for attr_name, m in members.items() for skeleton_id, idx in m],
+            }
+
+    class SynapseSpatialIndex(m65mat.MakeMethod.SynapseSpatialIndex):
+        @classmethod
+        def update_method(cls, cell_size=10_000):
+            cls.insert1({Tag.attr_name: Tag.version,
+                         'cell_size': cell_size,
+                         'target_dir': config.externals['minnie65_spatial_indexes']['location'],
+            }, insert_to_master=True, skip_duplicates=True)
+
+        def run(self, ver, chunk_size=5_000_000, **kwargs):
+            params = (self & kwargs).fetch1()
+            target_dir = params.get('target_dir')
+            assert params.get(Tag.attr_name) == Tag.version, 'Tag version mismatch'
+
+            rel = Synapse.Info2 & {'ver': ver}
+            primary_seg_ids, counts = dj.U('primary_seg_id').aggr(rel, n='count(*)').fetch('primary_seg_id', 'n', order_by='primary_seg_id')
+            chunks = chunk_keys_by_size(primary_seg_ids, counts, chunk_size)
+            bounds = dj.U().aggr(rel, **{f'{f}_{a}': f'{f}(synapse_{a})' for f in ('min', 'max') for a in 'xyz'}).fetch1()
+            bounds = voxels_to_nm([[bounds[f'{f}_{a}'] for a in 'xyz'] for f in ('min', 'max')])
+
+            def iter_chunks():
+                for chunk in chunks:
+                    with stage('fetch') as st:
+                        df = (rel & f'primary_seg_id in ({",".join(str(int(k)) for k in chunk)})').proj('prepost', 'synapse_x', 'synapse_y', 'synapse_z').fetch(format='frame').reset_index()
+                        st.add(n_rows=len(df))
+                    # keep one row per synapse
+                    df = to_pre_post(df, primary_seg_ids)
+                    yield df['synapse_id'].values, voxels_to_nm(df[['synapse_x', 'synapse_y', 'synapse_z']].values)
+
+            filepath = Path(target_dir).joinpath(f'{ver}_{params["make_method"]}_synapse_index.npz')
+            with stage('write') as st:
+                index = GridIndex.build(filepath, iter_chunks, bounds=bounds, cell_size=params['cell_size'])
+                st.add(n_bytes=file_size(filepath))
+            self.Log('info', f'Indexed {len(index)} synapses.')
+
+            return {
+                'ver': ver,
+                'make_method': params['make_method'],
+                'n_points': len(index),
+                'cell_size': params['cell_size'],
+                'spatial_index_obj': filepath,
+            }
+
 
 class Materialization(m65mat.Materialization):
     
@@ -585,18 +843,19 @@ class Materialization(m65mat.Materialization):
         @classmethod
         def fill_mat_v1(cls):
             cls.configure_logger()
-            mat_v1 = dj.create_virtual_module('mat_v1', 'microns_minnie65_materialization')
+            mat_v1 = m65mat.mat_v1
             rel = mat_v1.Materialization.CurrentVersion & [{'kind': 'MICrONS_Jul_2021'}, {'kind': 'MICrONS_Mar_2021'}, {'kind': 'release_Jun2021'}]
             cls.insert(rel.proj(..., name='kind'))
     
     class MatV1(m65mat.Materialization.MatV1):
         @property
         def key_source(self):
-            return dj.create_virtual_module('mat_v1', 'microns_minnie65_materialization').Materialization
+            return m65mat.mat_v1.Materialization
         
         def get(self, key):
             return (self.key_source & key).fetch1()
         
+        @instrumented
         def make(self, key):
             row = self.get(key)
             row.update({'time_stamp': row['timestamp'], 'datastack': 'minnie65_phase3_v1'})
@@ -609,6 +868,7 @@ class Materialization(m65mat.Materialization):
         def key_source(self):
             return ImportMethod.MaterializationVer - Materialization
         
+        @instrumented
         def make(self, key):
             result = {**key, **ImportMethod.run(key)}
             Materialization.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
@@ -624,22 +884,58 @@ class Nucleus(m65mat.Nucleus):
         @classmethod
         def fill(cls):
             cls.configure_logger()
-            m65mat_v1 = dj.create_virtual_module('mat_v1', 'microns_minnie65_materialization')
+            m65mat_v1 = m65mat.mat_v1
             with dj.conn().transaction:
                 cls.master.insert(m65mat_v1.Nucleus.Info, ignore_extra_fields=True, skip_duplicates=True)
                 cls.master.Info.insert(m65mat_v1.Nucleus.Info, ignore_extra_fields=True, skip_duplicates=True)
                 cls.insert(m65mat_v1.Nucleus.Info, ignore_extra_fields=True, skip_duplicates=True)
     
+    class Lineage(m65mat.Nucleus.Lineage): pass
+
+    class LineageMaker(m65mat.Nucleus.LineageMaker):
+        @property
+        def key_source(self):
+            return Materialization & Nucleus.CAVE
+
+        @instrumented
+        def make(self, key):
+            df = (Nucleus.Info & key).proj().fetch(format='frame').reset_index()
+            df['n_nuclei'] = df.groupby('segment_id')['nucleus_id'].transform('count')
+
+            prev_vers = (dj.U('ver') & (Nucleus.CAVE & f'ver < {key["ver"]}')).fetch('ver')
+            if len(prev_vers) > 0:
+                prev_ver = max(prev_vers)
+                prev_df = (Nucleus.Info & {'ver': prev_ver}).proj().fetch(format='frame').reset_index()
+                prev_df = prev_df.rename(columns={'segment_id': 'prev_segment_id'})[['nucleus_id', 'prev_segment_id']]
+                # nullable integers keep 64-bit segment ids exact where the nucleus is missing in prev_ver
+                prev_df['prev_segment_id'] = prev_df['prev_segment_id'].astype('UInt64')
+                df = df.merge(prev_df, on='nucleus_id', how='left')
+            else:
+                prev_ver = None
+                df['prev_segment_id'] = pd.Series(pd.NA, index=df.index, dtype='UInt64')
+
+            has_prev = df['prev_segment_id'].notna()
+            df['prev_ver'] = np.where(has_prev, prev_ver, None)
+            df['segment_changed'] = (has_prev & (df['prev_segment_id'] != df['segment_id'])).astype(int)
+            df['split'] = (has_prev & (df.groupby('prev_segment_id', dropna=False)['segment_id'].transform('nunique') > 1)).astype(int)
+            df['merge'] = (df.groupby('segment_id')['prev_segment_id'].transform('nunique') > 1).astype(int)
+            df['prev_segment_id'] = df['prev_segment_id'].astype(object).where(has_prev, None)
+
+            self.master.Lineage.insert(df.to_dict('records'), ignore_extra_fields=True, skip_duplicates=True)
+            self.insert1(key)
+
     class CAVE(m65mat.Nucleus.CAVE):
         @property
         def key_source(self):
             return ImportMethod.NucleusSegment & (Materialization & (Materialization.CAVE - Nucleus.Info.proj()))
         
+        @instrumented
         def make(self, key):
             df = ImportMethod.run(key)['df']
-            self.master.insert(df, ignore_extra_fields=True, skip_duplicates=True)
-            self.master.Info.insert(df, ignore_extra_fields=True, skip_duplicates=True)
-            self.insert(df, insert_to_master=True, ignore_extra_fields=True, skip_duplicates=True, insert_to_master_kws={'ignore_extra_fields': True, 'skip_duplicates': True})
+            with stage('insert', n_rows=3 * len(df)):
+                self.master.insert(df, ignore_extra_fields=True, skip_duplicates=True)
+                self.master.Info.insert(df, ignore_extra_fields=True, skip_duplicates=True)
+                self.insert(df, insert_to_master=True, ignore_extra_fields=True, skip_duplicates=True, insert_to_master_kws={'ignore_extra_fields': True, 'skip_duplicates': True})
 
 
 class Segment(m65mat.Segment):
@@ -655,10 +951,69 @@ class Segment(m65mat.Segment):
         def key_source(self):
             return Materialization & Nucleus.Info()
         
+        @instrumented
         def make(self, key):
             self.master.insert(Nucleus.Info & key, ignore_extra_fields=True, skip_duplicates=True)
             self.insert(Nucleus.Info & key, ignore_extra_fields=True, skip_duplicates=True)
 
+    class Summary(m65mat.Segment.Summary):
+        nullable_attrs = ['n_presyn', 'n_postsyn', 'n_vertices', 'n_faces', 'split_score']
+
+        @classmethod
+        def summarize(cls, ver):
+            """
+            Computes the summary statistics of all segments of a version, with one aggregation query per source table.
+
+            :param ver: materialization version
+
+            :returns: pandas.DataFrame with the attributes of Segment.Summary
+            """
+            key = {'ver': ver}
+            segments = dj.U('segment_id') & (Segment.Nucleus & key)
+            df = dj.U('ver', 'segment_id').aggr(Segment.Nucleus & key, n_nuclei='count(*)').fetch(format='frame').reset_index()
+
+            # synapses: segments excluded for having no synapse data count as imported with 0 synapses
+            syn_df = dj.U('primary_seg_id').aggr(Synapse.Info2 & key, n_presyn='sum(prepost="presyn")', n_postsyn='sum(prepost="postsyn")').fetch(format='frame').reset_index()
+            syn_df = syn_df.rename(columns={'primary_seg_id': 'segment_id'})
+            excluded = np.setdiff1d((dj.U('primary_seg_id') & Synapse.SegmentExclude).fetch('primary_seg_id'), syn_df['segment_id'].values)
+            syn_df = pd.concat([syn_df, pd.DataFrame({'segment_id': excluded, 'n_presyn': 0, 'n_postsyn': 0})], ignore_index=True)
+
+            # latest mesh and axon/dendrite skeleton of each segment
+            mesh_df = ((Mesh.MeshParty.proj() * Mesh.Object.proj('n_vertices', 'n_faces')) & segments).fetch(format='frame').reset_index()
+            mesh_df = mesh_df.sort_values('ts_computed').drop_duplicates('segment_id', keep='last')[['segment_id', 'n_vertices', 'n_faces']]
+            split_df = ((Meshwork.PCGMeshworkMaker.proj() & segments) * Skeleton.MeshworkAxonDendriteSkeletonMaker.proj() * Skeleton.MeshworkAxonDendriteSkeleton.proj('split_score', skeleton_make_id='skeleton_id')).fetch(format='frame').reset_index()
+            split_df = split_df.sort_values('ts_computed').drop_duplicates('segment_id', keep='last')[['segment_id', 'split_score']]
+
+            for other in (syn_df, mesh_df, split_df):
+                other['segment_id'] = other['segment_id'].astype(df['segment_id'].dtype)
+                df = df.merge(other, on='segment_id', how='left')
+            df['has_meshwork'] = np.isin(df['segment_id'].values, (dj.U('segment_id') & (Meshwork.PCGMeshworkMaker & segments)).fetch('segment_id')).astype(int)
+            df['has_pcg_skeleton'] = np.isin(df['segment_id'].values, (dj.U('segment_id') & (Skeleton.PCGSkeletonMaker & segments)).fetch('segment_id')).astype(int)
+            return df
+
+        @classmethod
+        def fill(cls, ver=None, refresh_incomplete=True):
+            """
+            Inserts summaries of the segments that do not have one yet.
+
+            :param ver: materialization version(s) to fill. If None, all versions in Segment.Nucleus.
+            :param refresh_incomplete: (bool) also replaces rows with NULL statistics or a missing meshwork or skeleton
+                if they are now available
+            """
+            cls.configure_logger()
+            vers = (dj.U('ver') & Segment.Nucleus).fetch('ver') if ver is None else wrap(ver)
+            for v in vers:
+                df = cls.summarize(v)
+                existing = (cls & {'ver': v}).fetch(format='frame').reset_index()
+                is_new, is_updated = rows_to_write(df, existing, cls.nullable_attrs, ['has_meshwork', 'has_pcg_skeleton'], refresh_incomplete=refresh_incomplete)
+                rows = df[is_new | is_updated].astype(object)
+                rows = rows.where(rows.notna(), None)
+                cls.Log('info', f'ver {v}: inserting {is_new.sum()} new and replacing {is_updated.sum()} updated segment summaries.')
+                with dj.conn().transaction:
+                    if is_updated.any():
+                        (cls & {'ver': v} & [{'segment_id': i} for i in df.loc[is_updated, 'segment_id']]).delete_quick()
+                    cls.insert(rows.to_dict('records'), ignore_extra_fields=True)
+
 
 class Exclusion(m65mat.Exclusion): pass
 
@@ -669,10 +1024,33 @@ class Synapse(m65mat.Synapse):
     
     class Info2(m65mat.Synapse.Info2): pass
 
+    class Edge(m65mat.Synapse.Edge): pass
+
+    class EdgeMaker(m65mat.Synapse.EdgeMaker):
+        _primary_seg_ids = {}
+
+        @property
+        def key_source(self):
+            # only complete versions, so the set of primary segments used for deduplication is final
+            return dj.U('ver', 'primary_seg_id') & ((Segment.Nucleus.proj(primary_seg_id='segment_id') & Synapse.complete) & Synapse.CAVE2.proj())
+
+        @classmethod
+        def primary_seg_ids(cls, ver):
+            if ver not in cls._primary_seg_ids:
+                cls._primary_seg_ids[ver] = (dj.U('primary_seg_id') & (Synapse.CAVE2 & {'ver': ver})).fetch('primary_seg_id')
+            return cls._primary_seg_ids[ver]
+
+        @instrumented
+        def make(self, key):
+            df = (Synapse.Info2 & key).fetch(format='frame').reset_index()
+            df = to_pre_post(df, self.primary_seg_ids(key['ver']))
+            self.master.Edge.insert(df, ignore_extra_fields=True, skip_duplicates=True)
+            self.insert1({**key, 'n_synapses': len(df)})
+
     class MatV1(m65mat.Synapse.MatV1):
         @classmethod
         def fill(cls):
-            m65mat_v1 = dj.create_virtual_module('mat_v1', 'microns_minnie65_materialization')
+            m65mat_v1 = m65mat.mat_v1
             with dj.conn().transaction:
                 cls.master.insert(m65mat_v1.Synapse, ignore_extra_fields=True, skip_duplicates=True)
                 cls.master.Info.insert(m65mat_v1.Synapse, ignore_extra_fields=True, skip_duplicates=True)
@@ -685,12 +1063,14 @@ class Synapse(m65mat.Synapse):
         def key_source(self):
             return dj.U('primary_seg_id', 'import_method') & ((Segment.Nucleus.proj(primary_seg_id='segment_id') - Synapse.Info - Synapse.SegmentExclude) * ImportMethod.Synapse2)
 
+        @instrumented
         def make(self, key):
             df = ImportMethod.run(key)['df']
             if len(df) > 0:
-                self.master.insert(df, ignore_extra_fields=True, skip_duplicates=True)
-                self.master.Info.insert(df, ignore_extra_fields=True, skip_duplicates=True)
-                self.insert(df, ignore_extra_fields=True)
+                with stage('insert', n_rows=3 * len(df)):
+                    self.master.insert(df, ignore_extra_fields=True, skip_duplicates=True)
+                    self.master.Info.insert(df, ignore_extra_fields=True, skip_duplicates=True)
+                    self.insert(df, ignore_extra_fields=True)
             else:
                 self.master.SegmentExclude.insert1({'primary_seg_id': key['primary_seg_id'], 'synapse_id': 0, Exclusion.hash_name: Exclusion.hash1({'reason': 'no synapse data'})}, skip_duplicates=True)
 
@@ -699,12 +1079,14 @@ class Synapse(m65mat.Synapse):
         def key_source(self):
             return dj.U('ver', 'primary_seg_id', 'import_method') &  ((Segment.Nucleus.proj(primary_seg_id='segment_id') - Synapse.SegmentExclude) * ImportMethod.Synapse3)
 
+        @instrumented
         def make(self, key):
             df = ImportMethod.run(key)['df']
             if len(df) > 0:
-                self.master.insert(df, ignore_extra_fields=True, skip_duplicates=True)
-                self.master.Info2.insert(df, ignore_extra_fields=True, skip_duplicates=True)
-                self.insert(df, ignore_extra_fields=True)
+                with stage('insert', n_rows=3 * len(df)):
+                    self.master.insert(df, ignore_extra_fields=True, skip_duplicates=True)
+                    self.master.Info2.insert(df, ignore_extra_fields=True, skip_duplicates=True)
+                    self.insert(df, ignore_extra_fields=True)
             else:
                 self.master.SegmentExclude.insert1({'primary_seg_id': key['primary_seg_id'], 'synapse_id': 0, Exclusion.hash_name: Exclusion.hash1({'reason': 'no synapse data'})}, skip_duplicates=True)
 
@@ -712,18 +1094,72 @@ class Synapse(m65mat.Synapse):
 class Mesh(m65mat.Mesh):
     
     class Object(m65mat.Mesh.Object): pass
+
+    class Stats(m65mat.Mesh.Stats):
+        @classmethod
+        def fill(cls, restriction={}, batch_size=1_000, n_workers=None, chunk_size=1_000_000):
+            """
+            Computes geometry statistics of the meshes in Mesh.Object that do not have them yet.
+
+            Mesh files are streamed in chunks of faces by a thread pool, one batch at a time, and each batch is bulk inserted.
+
+            :param restriction: restriction on Mesh.MeshParty (e.g. segments of a version)
+            :param batch_size: (int) number of meshes per batch
+            :param n_workers: (int) number of threads. Defaults to the number of CPUs.
+            :param chunk_size: (int) number of faces read at a time per mesh, which bounds memory to about
+                n_workers * chunk_size * 200 bytes
+            """
+            cls.configure_logger()
+            rel = (cls.master.Object & (Mesh.MeshParty & restriction)) - cls
+            df = fetch_filepaths(rel, 'mesh')
+            cls.Log('info', f'Computing stats of {len(df)} meshes.')
+            for start in range(0, len(df), batch_size):
+                batch = df.iloc[start:start + batch_size]
+                stats = compute_mesh_stats(batch['mesh'].tolist(), n_workers=n_workers, chunk_size=chunk_size)
+                rows = [{cls.master.hash_name: mesh_id, **s} for mesh_id, s in zip(batch[cls.master.hash_name], stats) if s is not None]
+                cls.insert(rows, ignore_extra_fields=True, skip_duplicates=True)
+                cls.Log('info', f'Inserted stats of {len(rows)} meshes ({len(batch) - len(rows)} failed), {min(start + batch_size, len(df))}/{len(df)} done.')
     
+    class LOD(m65mat.Mesh.LOD):
+        @classmethod
+        def fill(cls, make_method, restriction={}, batch_size=1_000, n_workers=None):
+            """
+            Builds the levels of detail of the meshes in Mesh.Object that do not have them yet.
+
+            :param make_method: (str) make method in MakeMethod.MeshLOD
+            :param restriction: restriction on Mesh.MeshParty (e.g. segments of a version)
+            :param batch_size: (int) number of meshes per batch
+            :param n_workers: (int) number of worker processes. Defaults to the number of CPUs.
+            """
+            cls.configure_logger()
+            method_key = {'make_method': make_method}
+            rel = (cls.master.Object & (Mesh.MeshParty & restriction)) - (cls & method_key)
+            df = fetch_filepaths(rel, 'mesh')
+            cls.Log('info', f'Building levels of detail of {len(df)} meshes.')
+            for start in range(0, len(df), batch_size):
+                batch = df.iloc[start:start + batch_size]
+                results = [r for r in MakeMethod.MeshLOD().run(batch[cls.master.hash_name].tolist(), batch['mesh'].tolist(), n_workers=n_workers, **method_key) if r is not None]
+                levels = [{**level, 'mesh_id': r['mesh_id'], 'make_method': make_method} for r in results for level in r['levels']]
+                with dj.conn().transaction:
+                    cls.insert(results, ignore_extra_fields=True, skip_duplicates=True)
+                    cls.master.LODLevel.insert(levels, skip_duplicates=True)
+                cls.Log('info', f'Inserted levels of detail of {len(results)} meshes ({len(batch) - len(results)} failed), {min(start + batch_size, len(df))}/{len(df)} done.')
+
+    class LODLevel(m65mat.Mesh.LODLevel): pass
+
     class MeshParty(m65mat.Mesh.MeshParty):
         @property
         def key_source(self):
-            return ((Segment & Segment.Nucleus & 'segment_id!= 0')  - Mesh.MeshParty.proj()) * ImportMethod.MeshPartyMesh2
+            return ((Segment & Segment.Nucleus & 'segment_id!= 0')  - Mesh.MeshParty.proj()) * (ImportMethod.MeshPartyMesh2.proj() + ImportMethod.MeshPartyMesh3.proj())
         
+        @instrumented
         def make(self, key):
             result = {**key, **ImportMethod.run(key)}
             result = {**{self.hash_name: self.hash1(result)}, **result}
-            self.master.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
-            self.master.Object.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
-            self.insert1(result, insert_to_master=True, skip_hashing=True, ignore_extra_fields=True, skip_duplicates=True, insert_to_master_kws={'ignore_extra_fields': True, 'skip_duplicates': True})
+            with stage('insert', n_rows=3):
+                self.master.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
+                self.master.Object.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
+                self.insert1(result, insert_to_master=True, skip_hashing=True, ignore_extra_fields=True, skip_duplicates=True, insert_to_master_kws={'ignore_extra_fields': True, 'skip_duplicates': True})
 
 
 class Meshwork(m65mat.Meshwork):
@@ -737,13 +1173,15 @@ class Meshwork(m65mat.Meshwork):
         def key_source(self):
             return ((Segment & Segment.Nucleus & 'segment_id!= 0')  - Meshwork.PCGMeshworkMaker.proj() - Meshwork.PCGMeshworkExclude.proj()) * ImportMethod.PCGMeshwork.get_latest_entries()
         
+        @instrumented
         def make(self, key):
             result = {**key, **ImportMethod.run(key)}
             if result['meshwork_obj']:
                 result = {**{self.hash_name: self.hash1(result)}, **result}
-                self.master.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
-                self.master.PCGMeshwork.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
-                self.insert1(result, insert_to_master=True, skip_hashing=True, ignore_extra_fields=True, skip_duplicates=True, insert_to_master_kws={'ignore_extra_fields': True, 'skip_duplicates': True})
+                with stage('insert', n_rows=3):
+                    self.master.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
+                    self.master.PCGMeshwork.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
+                    self.insert1(result, insert_to_master=True, skip_hashing=True, ignore_extra_fields=True, skip_duplicates=True, insert_to_master_kws={'ignore_extra_fields': True, 'skip_duplicates': True})
             else:
                 self.master.PCGMeshworkExclude.insert1({'segment_id': key['segment_id'], 'meshwork_id': 0, Exclusion.hash_name: Exclusion.hash1({'reason': 'no synapse data'}), 'ts_computed': str(datetime.now())}, ignore_extra_fields=True, skip_duplicates=True)
 
@@ -757,12 +1195,37 @@ class Skeleton(m65mat.Skeleton):
         def key_source(self):
             return ((Segment & Segment.Nucleus & 'segment_id!= 0')  - Skeleton.PCGSkeletonMaker.proj()) * ImportMethod.PCGSkeleton.get_latest_entries()
 
+        @instrumented
         def make(self, key):
             result = {**key, **ImportMethod.run(key)}
             result = {**{self.hash_name: self.hash1(result)}, **result}
-            self.master.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
-            self.master.PCGSkeleton.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
-            self.insert1(result, insert_to_master=True, skip_hashing=True, ignore_extra_fields=True, skip_duplicates=True, insert_to_master_kws={'ignore_extra_fields': True, 'skip_duplicates': True})
+            with stage('insert', n_rows=3):
+                self.master.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
+                self.master.PCGSkeleton.insert1(result, ignore_extra_fields=True, skip_duplicates=True)
+                self.insert1(result, insert_to_master=True, skip_hashing=True, ignore_extra_fields=True, skip_duplicates=True, insert_to_master_kws={'ignore_extra_fields': True, 'skip_duplicates': True})
+
+    class PCGSkeletonMetrics(m65mat.Skeleton.PCGSkeletonMetrics):
+        @classmethod
+        def fill(cls, restriction={}, batch_size=10_000, n_workers=None):
+            """
+            Computes metrics of the skeletons in Skeleton.PCGSkeleton that do not have them yet.
+
+            Skeleton files are read and processed in a process pool, one batch at a time, and each batch is bulk inserted.
+
+            :param restriction: restriction on Skeleton.PCGSkeletonMaker (e.g. segments of a version)
+            :param batch_size: (int) number of skeletons per batch
+            :param n_workers: (int) number of worker processes. Defaults to the number of CPUs.
+            """
+            cls.configure_logger()
+            rel = (cls.master.PCGSkeleton & (Skeleton.PCGSkeletonMaker & restriction)) - cls
+            df = fetch_filepaths(rel, 'skeleton_obj')
+            cls.Log('info', f'Computing metrics of {len(df)} skeletons.')
+            for start in range(0, len(df), batch_size):
+                batch = df.iloc[start:start + batch_size]
+                metrics = compute_skeleton_metrics(batch['skeleton_obj'].tolist(), n_workers=n_workers)
+                rows = [{cls.master.hash_name: skeleton_id, **m} for skeleton_id, m in zip(batch[cls.master.hash_name], metrics) if m is not None]
+                cls.insert(rows, skip_duplicates=True)
+                cls.Log('info', f'Inserted metrics of {len(rows)} skeletons ({len(batch) - len(rows)} failed), {min(start + batch_size, len(df))}/{len(df)} done.')
 
     class MeshworkAxonDendriteSkeletonError(m65mat.Skeleton.MeshworkAxonDendriteSkeletonError):
         pass
@@ -775,14 +1238,16 @@ class Skeleton(m65mat.Skeleton):
         def key_source(self):
             return Meshwork * (MakeMethod & MakeMethod.MeshworkAxonDendriteSkeleton) - self.master.MeshworkAxonDendriteSkeletonError
         
+        @instrumented
         def make(self, key):
             try:
                 result = MakeMethod.run(key)
                 result_hash = self.hash1(result)
                 result[self.master.hash_name] = result_hash
                 result[self.hash_name] = result_hash
-                self.master.MeshworkAxonDendriteSkeleton.insert1(result, ignore_extra_fields=True, insert_to_master=True)
-                self.insert1(result, ignore_extra_fields=True, skip_hashing=True)
+                with stage('insert', n_rows=3):
+                    self.master.MeshworkAxonDendriteSkeleton.insert1(result, ignore_extra_fields=True, insert_to_master=True)
+                    self.insert1(result, ignore_extra_fields=True, skip_hashing=True)
 
             except Exception as e:
                 error_table = self.master.MeshworkAxonDendriteSkeletonError
@@ -803,6 +1268,64 @@ class Skeleton(m65mat.Skeleton):
 
 
 
+class SkeletonPack(m65mat.SkeletonPack):
+
+    class Object(m65mat.SkeletonPack.Object): pass
+
+    class Member(m65mat.SkeletonPack.Member): pass
+
+    class SkeletonMaker(m65mat.SkeletonPack.SkeletonMaker):
+        @property
+        def key_source(self):
+            return (Materialization & Segment.Nucleus) * (MakeMethod & MakeMethod.SkeletonPack)
+
+        @instrumented
+        def make(self, key):
+            result = MakeMethod.run(key)
+            result[self.hash_name] = self.hash1(result)
+            with stage('insert', n_rows=3 + len(result['members'])):
+                self.master.Object.insert1(result, ignore_extra_fields=True, insert_to_master=True)
+                self.master.Member.insert([{**member, self.hash_name: result[self.hash_name]} for member in result['members']])
+                self.insert1(result, ignore_extra_fields=True, skip_hashing=True)
+            self.Log('info', f'Packed {result["n_skeletons"]} skeletons of version {key["ver"]}.')
+
+
+class SpatialIndex(m65mat.SpatialIndex):
+
+    class Object(m65mat.SpatialIndex.Object): pass
+
+    class SynapseMaker(m65mat.SpatialIndex.SynapseMaker):
+        @property
+        def key_source(self):
+            return Synapse.complete * (MakeMethod & MakeMethod.SynapseSpatialIndex)
+
+        @instrumented
+        def make(self, key):
+            result = MakeMethod.run(key)
+            result[self.hash_name] = self.hash1(result)
+            with stage('insert', n_rows=3):
+                self.master.Object.insert1(result, ignore_extra_fields=True, insert_to_master=True)
+                self.insert1(result, ignore_extra_fields=True, skip_hashing=True)
+
+
+class Connectome(m65mat.Connectome):
+
+    class Object(m65mat.Connectome.Object): pass
+
+    class SynapseMaker(m65mat.Connectome.SynapseMaker):
+        @property
+        def key_source(self):
+            return Synapse.complete * (MakeMethod & MakeMethod.SynapseConnectome)
+
+        @instrumented
+        def make(self, key):
+            result = MakeMethod.run(key)
+            result[self.hash_name] = self.hash1(result)
+            with stage('insert', n_rows=3):
+                self.master.Object.insert1(result, ignore_extra_fields=True, insert_to_master=True)
+                self.insert1(result, ignore_extra_fields=True, skip_hashing=True)
+
+
 class Queue(m65mat.Queue):
 
     class PCGMeshwork(m65mat.Queue.PCGMeshwork): pass
@@ -835,12 +1358,13 @@ def update_log_level(loglevel, update_root_level=True):
                     subobj.loglevel = loglevel
 
 
-def download_materialization(ver=None, download_synapses=False, download_meshes=False, loglevel=None, update_root_level=True):
+def download_materialization(ver=None, download_synapses=False, download_meshes=False, compress_meshes=False, loglevel=None, update_root_level=True):
     """
     Downloads materialization from CAVE.
 
     :param ver: (int) materialization version to download
         If None, latest materialization is downloaded.
+    :param compress_meshes: (bool) store downloaded meshes as compressed hdf5 with quantized vertices (ImportMethod.MeshPartyMesh3)
     :param loglevel: (str) Optional, desired log level to overwrite default
     :param update_root_level: (bool) updates root level with provided loglevel
     """
@@ -866,7 +1390,7 @@ def download_materialization(ver=None, download_synapses=False, download_meshes=
         makers += [Synapse.CAVE]
 
     if download_meshes:
-        methods += [ImportMethod.MeshPartyMesh2]
+        methods += [ImportMethod.MeshPartyMesh3 if compress_meshes else ImportMethod.MeshPartyMesh2]
         makers += [Mesh.MeshParty]
 
     for m, mk in zip(methods, makers):
@@ -874,13 +1398,19 @@ def download_materialization(ver=None, download_synapses=False, download_meshes=
         m.update_method(ver=ver)
         logger.info(f'Populating {mk.class_name}.')
         mk.populate(m.master & m.get_latest_entries(), reserve_jobs=True, order='random', suppress_errors=True)        
+
+    logger.info(f'Populating {Nucleus.LineageMaker.class_name}.')
+    Nucleus.LineageMaker.populate(reserve_jobs=True, suppress_errors=True)
         
 
-def download_meshwork_objects(restriction={}, loglevel=None, update_root_level=True):
+def download_meshwork_objects(restriction={}, profile=False, profile_kws=None, loglevel=None, update_root_level=True):
     """
     Downloads meshwork objects from cloud-volume.
 
     :param restriction: restriction to pass to populate
+    :param profile: (bool) profile each make() call and write the profiles over the thresholds (see utils.profile_utils).
+        Also enabled by MICRONS_PROFILE=true.
+    :param profile_kws: (dict) kwargs of utils.profile_utils.MakeProfiler, e.g. profile_dir, min_seconds, min_peak_bytes
     :param loglevel: (str) Optional, desired log level to overwrite default
     :param update_root_level: (bool) updates root level with provided loglevel
     """        
@@ -889,14 +1419,18 @@ def download_meshwork_objects(restriction={}, loglevel=None, update_root_level=T
     if loglevel is not None:
         update_log_level(loglevel=loglevel, update_root_level=update_root_level)
 
-    Meshwork.PCGMeshworkMaker.populate(restriction, reserve_jobs=True, order='random', suppress_errors=True)
+    with profiling(enabled=profile, **(profile_kws or {})):
+        Meshwork.PCGMeshworkMaker.populate(restriction, reserve_jobs=True, order='random', suppress_errors=True)
 
 
-def download_pcg_skeletons(restriction={}, loglevel=None, update_root_level=True):
+def download_pcg_skeletons(restriction={}, profile=False, profile_kws=None, loglevel=None, update_root_level=True):
     """
     Downloads meshwork objects from cloud-volume.
 
     :param restriction: restriction to pass to populate
+    :param profile: (bool) profile each make() call and write the profiles over the thresholds (see utils.profile_utils).
+        Also enabled by MICRONS_PROFILE=true.
+    :param profile_kws: (dict) kwargs of utils.profile_utils.MakeProfiler, e.g. profile_dir, min_seconds, min_peak_bytes
     :param loglevel: (str) Optional, desired log level to overwrite default
     :param update_root_level: (bool) updates root level with provided loglevel
     """        
@@ -905,4 +1439,345 @@ def download_pcg_skeletons(restriction={}, loglevel=None, update_root_level=True
     if loglevel is not None:
         update_log_level(loglevel=loglevel, update_root_level=update_root_level)
 
-    Skeleton.PCGSkeletonMaker.populate(restriction, reserve_jobs=True, order='random', suppress_errors=True)
+    with profiling(enabled=profile, **(profile_kws or {})):
+        Skeleton.PCGSkeletonMaker.populate(restriction, reserve_jobs=True, order='random', suppress_errors=True)
+
+
+def convert_synapse_edges(restriction={}, loglevel=None, update_root_level=True):
+    """
+    Converts Synapse.Info2 to Synapse.Edge, with one row per synapse, for versions with completed synapse imports.
+
+    :param restriction: restriction to pass to populate
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+    """
+    logger.info(f'Synapse edge conversion initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    Synapse.EdgeMaker.populate(restriction, reserve_jobs=True, order='random', suppress_errors=True)
+
+
+def make_mesh_lods(restriction={}, fractions=(0.1, 0.01, 0.001), batch_size=1_000, n_workers=None, loglevel=None, update_root_level=True):
+    """
+    Builds decimated levels of detail of all meshes in Mesh.Object that do not have them yet.
+
+    :param restriction: restriction on Mesh.MeshParty
+    :param fractions: (list) target fraction of the faces of each level
+    :param batch_size: (int) number of meshes per batch
+    :param n_workers: (int) number of worker processes. Defaults to the number of CPUs.
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+    """
+    logger.info(f'Mesh level of detail computation initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    MakeMethod.MeshLOD.update_method(fractions=fractions)
+    make_method = (MakeMethod.MeshLOD & {Tag.attr_name: Tag.version, 'fractions': json.dumps(sorted(fractions, reverse=True))}).fetch1('make_method')
+    Mesh.LOD.fill(make_method, restriction, batch_size=batch_size, n_workers=n_workers)
+
+
+def fill_mesh_stats(restriction={}, batch_size=1_000, n_workers=None, chunk_size=1_000_000, loglevel=None, update_root_level=True):
+    """
+    Computes geometry statistics of all meshes in Mesh.Object that do not have them yet.
+
+    :param restriction: restriction on Mesh.MeshParty
+    :param batch_size: (int) number of meshes per batch
+    :param n_workers: (int) number of threads. Defaults to the number of CPUs.
+    :param chunk_size: (int) number of faces read at a time per mesh
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+    """
+    logger.info(f'Mesh stats computation initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    Mesh.Stats.fill(restriction, batch_size=batch_size, n_workers=n_workers, chunk_size=chunk_size)
+
+
+def compute_pcg_skeleton_metrics(restriction={}, batch_size=10_000, n_workers=None, loglevel=None, update_root_level=True):
+    """
+    Computes morphology metrics of all skeletons in Skeleton.PCGSkeleton that do not have them yet.
+
+    :param restriction: restriction on Skeleton.PCGSkeletonMaker
+    :param batch_size: (int) number of skeletons per batch
+    :param n_workers: (int) number of worker processes. Defaults to the number of CPUs.
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+    """
+    logger.info(f'PCG skeleton metrics computation initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    Skeleton.PCGSkeletonMetrics.fill(restriction, batch_size=batch_size, n_workers=n_workers)
+
+
+def fill_segment_summaries(ver=None, loglevel=None, update_root_level=True):
+    """
+    Inserts or tops up Segment.Summary for the segments of each materialization version.
+
+    :param ver: materialization version(s) to fill. If None, all versions in Segment.Nucleus.
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+    """
+    logger.info(f'Segment summary fill initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    Segment.Summary.fill(ver=ver)
+
+
+def make_synapse_connectomes(restriction={}, loglevel=None, update_root_level=True):
+    """
+    Builds sparse synapse connectomes of the materialization versions with completed synapse imports.
+
+    :param restriction: restriction to pass to populate
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+    """
+    logger.info(f'Connectome build initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    MakeMethod.SynapseConnectome.update_method()
+    Connectome.SynapseMaker.populate(restriction, reserve_jobs=True, order='random', suppress_errors=True)
+
+
+def make_synapse_spatial_indexes(restriction={}, cell_size=10_000, loglevel=None, update_root_level=True):
+    """
+    Builds grid indexes of synapse centroids of the materialization versions with completed synapse imports.
+
+    :param restriction: restriction to pass to populate
+    :param cell_size: (float) size of a grid cell in nm
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+    """
+    logger.info(f'Synapse spatial index build initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    MakeMethod.SynapseSpatialIndex.update_method(cell_size=cell_size)
+    SpatialIndex.SynapseMaker.populate(restriction, reserve_jobs=True, order='random', suppress_errors=True)
+
+
+def pack_skeletons(restriction={}, loglevel=None, update_root_level=True):
+    """
+    Packs the PCG skeletons and axon/dendrite skeletons of each materialization version into one file.
+
+    :param restriction: restriction to pass to populate
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+    """
+    logger.info(f'Skeleton packing initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    MakeMethod.SkeletonPack.update_method()
+    SkeletonPack.SkeletonMaker.populate(restriction, reserve_jobs=True, order='random', suppress_errors=True)
+
+
+def shard_external_stores(stores=('minnie65_meshes', 'minnie65_meshwork', 'minnie65_pcg_skeletons', 'minnie65_meshwork_axon_dendrite_skeletons'), batch_size=10_000, n_workers=32, dry_run=False, limit=None, loglevel=None, update_root_level=True):
+    """
+    Moves existing files of external stores from the flat layout into the sharded layout used for new writes
+        and rewrites their paths in the external tables.
+
+    :param stores: (list) names of the stores to migrate
+    :param batch_size: (int) number of files moved and rewritten per batch
+    :param n_workers: (int) number of threads moving files
+    :param dry_run: (bool) only log the number of files that would be moved
+    :param limit: (int) max number of files to migrate per store
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+    """
+    logger.info(f'External store sharding initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    for store in wrap(stores):
+        migrate_to_sharded_layout(schema.external[store], batch_size=batch_size, n_workers=n_workers, dry_run=dry_run, limit=limit)
+
+
+def audit_external_stores(stores=('minnie65_meshes', 'minnie65_meshwork', 'minnie65_pcg_skeletons', 'minnie65_meshwork_axon_dendrite_skeletons'), n_workers=32, check_headers=True, min_age=24 * 3600, quarantine=False, report_dir=None, loglevel=None, update_root_level=True):
+    """
+    Reports missing, orphaned and corrupt files of external stores, and optionally moves orphaned files to quarantine.
+
+    :param stores: (list) names of the stores to audit
+    :param n_workers: (int) number of threads listing and moving files and of processes checking headers
+    :param check_headers: (bool) open the HDF5/npz headers of referenced files to find corrupt files
+    :param min_age: (float) files modified less than min_age seconds ago are not reported as orphaned
+    :param quarantine: (bool) move orphaned files to <store>/.quarantine/<date>
+    :param report_dir: (str) if provided, the report of each store is written to <report_dir>/<store>_audit_<date>.csv
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+
+    :returns: dict of reports (pandas.DataFrame) keyed by store
+    """
+    logger.info(f'External store audit initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    reports = {}
+    for store in wrap(stores):
+        external = schema.external[store]
+        report = audit_store(external, n_workers=n_workers, check_headers=check_headers, min_age=min_age)
+        if report_dir is not None:
+            filepath = Path(report_dir).joinpath(f'{store}_audit_{datetime.now().strftime("%Y-%m-%d_%H:%M:%S")}.csv')
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            report.to_csv(filepath, index=False)
+            logger.info(f'Audit report of {store} written to {filepath}.')
+        if quarantine:
+            quarantine_files(external.spec['stage'], report.loc[report.status == 'orphaned', 'filepath'].tolist(), n_workers=n_workers)
+        reports[store] = report
+    return reports
+
+
+def recompress_external_store(store, compression='gzip', compression_opts=None, shuffle=True, chunk_rows=2**16, batch_size=1_000, n_workers=None, n_repeats=1, limit=None, dry_run=False, report_dir=None, loglevel=None, update_root_level=True):
+    """
+    Rewrites the HDF5 files of an external store with a new chunking and compression filter, in batches.
+
+    Each file is rewritten in a process pool, verified to read back identically and swapped in atomically.
+        The size and checksum of the external rows of replaced files are then updated, so DataJoint fetches keep working.
+        Fetches of a file between its swap and the update of its batch fail the checksum and can be retried.
+
+    :param store: (str) one of "minnie65_meshes", "minnie65_meshwork" or "minnie65_pcg_skeletons"
+    :param compression: (str) "gzip", "lzf" or "blosc" (readers need the hdf5plugin package)
+    :param compression_opts: (int) gzip or blosc level
+    :param shuffle: (bool) apply the byte shuffle filter
+    :param chunk_rows: (int) rows per chunk
+    :param batch_size: (int) number of files rewritten before the external rows are updated
+    :param n_workers: (int) number of worker processes. Defaults to the number of CPUs.
+    :param n_repeats: (int) number of reads timed per file before and after
+    :param limit: (int) max number of files to rewrite, e.g. to measure the gain on a sample
+    :param dry_run: (bool) rewrite, verify and time files, but keep the originals
+    :param report_dir: (str) if provided, the per file report is written to <report_dir>/<store>_recompression_<date>.csv
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+
+    :returns: pandas.DataFrame with one row per file (see recompress_utils.recompress_file)
+    """
+    logger.info(f'External store recompression initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    read_functions = {'minnie65_meshes': 'mesh', 'minnie65_meshwork': 'meshwork', 'minnie65_pcg_skeletons': 'pcg_skeleton'}
+    assert store in read_functions, f'store must be one of {list(read_functions)}'
+    external = schema.external[store]
+    stage_dir = Path(external.spec['stage']).absolute()
+    rows = external.used().fetch('hash', 'filepath', format='frame', limit=limit).reset_index()
+
+    reports = []
+    for start in range(0, len(rows), batch_size):
+        batch = rows.iloc[start:start + batch_size]
+        report = recompress_files(
+            [stage_dir / filepath for filepath in batch['filepath']], n_workers=n_workers, compression=compression, compression_opts=compression_opts,
+            shuffle=shuffle, chunk_rows=chunk_rows, read_function=read_functions[store], n_repeats=n_repeats, dry_run=dry_run
+        )
+        report['hash'] = batch['hash'].values
+        update_external_contents(external, report)
+        for error in report.loc[report.status.isin(['error', 'mismatch']), ['filepath', 'status', 'error']].itertuples():
+            logger.warning(f'{error.filepath} not replaced: {error.status} {error.error}')
+        reports.append(report)
+        logger.info(f'{min(start + batch_size, len(rows))}/{len(rows)} files of {store} rewritten.')
+
+    report = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame()
+    if len(report):
+        logger.info(f'Recompression of {store}:\n{summarize_recompression(report).to_string()}')
+    if report_dir is not None:
+        filepath = Path(report_dir).joinpath(f'{store}_recompression_{datetime.now().strftime("%Y-%m-%d_%H:%M:%S")}.csv')
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        report.to_csv(filepath, index=False)
+        logger.info(f'Recompression report written to {filepath}.')
+    return report
+
+
+def export_datasets(ver):
+    """
+    Datasets written by export_materialization for one materialization version.
+
+    :param ver: materialization version
+
+    :returns: dict mapping dataset name to (restricted table, chunk attribute, filepath attributes)
+    """
+    segments = dj.U('segment_id') & (Segment.Nucleus & {'ver': ver})
+    meshworks = Meshwork.PCGMeshworkMaker.proj() & segments
+    return {
+        'nucleus_info': (Nucleus.Info & {'ver': ver}, 'nucleus_id', ()),
+        'segment': (Segment.Nucleus.proj() & {'ver': ver}, 'segment_id', ()),
+        'synapse_info2': (Synapse.Info2 & {'ver': ver}, 'primary_seg_id', ()),
+        'mesh': (Mesh.MeshParty.proj() * Mesh.Object & segments, 'segment_id', ('mesh',)),
+        'meshwork': (Meshwork.PCGMeshworkMaker.proj() * Meshwork.PCGMeshwork & segments, 'segment_id', ('meshwork_obj',)),
+        'pcg_skeleton': (Skeleton.PCGSkeletonMaker.proj() * Skeleton.PCGSkeleton & segments, 'segment_id', ('skeleton_obj',)),
+        'axon_dendrite_skeleton': (
+            meshworks * Skeleton.MeshworkAxonDendriteSkeletonMaker.proj() * Skeleton.MeshworkAxonDendriteSkeleton.proj(..., skeleton_make_id='skeleton_id'), 
+            'segment_id', 
+            ('axon_skeleton', 'dendrite_skeleton')
+        ),
+    }
+
+
+def export_materialization(ver=None, target_dir=None, datasets=None, chunk_size=1_000_000, row_group_size=100_000, incremental=True, loglevel=None, update_root_level=True):
+    """
+    Exports a materialization version to partitioned Parquet datasets.
+
+    Each dataset is written to <target_dir>/<dataset>/ver=<ver>/ in parts of about chunk_size rows, 
+        so memory is bounded by one chunk. Mesh, meshwork and skeleton datasets are manifests of 
+        the stored filepaths; the files themselves are not read.
+
+    :param ver: materialization version to export
+        If None, latest materialization is exported.
+    :param target_dir: (str or pathlib.Path) root directory of the datasets
+        If None, defaults to externals.minnie65_materialization_exports_path
+    :param datasets: (list) names of the datasets in export_datasets to export
+        If None, all datasets are exported.
+    :param chunk_size: (int) target number of rows per part file
+    :param row_group_size: (int) max number of rows per Parquet row group
+    :param incremental: (bool) 
+        If True: keeps parts already exported and only exports the remaining chunks
+        If False: removes existing parts and exports the version again
+    :param loglevel: (str) Optional, desired log level to overwrite default
+    :param update_root_level: (bool) updates root level with provided loglevel
+    """
+    logger.info(f'Materialization export initialized.')
+
+    if loglevel is not None:
+        update_log_level(loglevel=loglevel, update_root_level=update_root_level)
+
+    ver = (Materialization.latest if ver is None else Materialization & {'ver': ver}).fetch1('ver')
+    target_dir = Path(externals.minnie65_materialization_exports_path if target_dir is None else target_dir)
+
+    for name, (rel, chunk_attr, filepath_attrs) in export_datasets(ver).items():
+        if datasets is not None and name not in datasets:
+            continue
+        
+        partition = ParquetPartition(target_dir / name, {'ver': ver}, row_group_size=row_group_size)
+        if not incremental:
+            partition.clear()
+        elif partition.complete:
+            logger.info(f'{name} for ver {ver} already exported. Skipping.')
+            continue
+
+        # chunk by number of rows per key, skipping keys already exported
+        keys, counts = dj.U(chunk_attr).aggr(rel, n='count(*)').fetch(chunk_attr, 'n', order_by=chunk_attr)
+        exported_keys = partition.exported_keys
+        remaining = [(k, c) for k, c in zip(keys, counts) if int(k) not in exported_keys]
+        chunks = chunk_keys_by_size([k for k, _ in remaining], [c for _, c in remaining], chunk_size)
+        logger.info(f'Exporting {name} for ver {ver} in {len(chunks)} chunks.')
+
+        for chunk in chunks:
+            df = fetch_filepaths(rel & f'{chunk_attr} in ({",".join(str(int(k)) for k in chunk)})', *filepath_attrs)
+            filepath = partition.write(df, chunk)
+            logger.info(f'Wrote {len(df)} rows to {filepath}.')
+
+        partition.mark_complete()